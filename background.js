@@ -8,12 +8,66 @@ chrome.runtime.onInstalled.addListener(() => {
 chrome.alarms.onAlarm.addListener((alarm) => {
   if (alarm.name === 'keep-alive') {
     console.log('Service worker keep-alive ping');
+    if (Date.now() - rulesLoadedAt > RULES_REFRESH_MS) loadDocumentRules();
   }
 });
 
 // Create a keep-alive alarm (every 30 seconds)
 chrome.alarms.create('keep-alive', { periodInMinutes: 0.5 });
 
+// Local attach server
+const SERVER_URL = 'http://localhost:8765';
+// /attach runs as a queued job; its outcome arrives on the /events stream,
+// with GET /jobs/<id> polling as a fallback (slower while the stream is up)
+const JOB_POLL_INTERVAL_MS = 250;
+const JOB_POLL_FALLBACK_MS = 2000;
+const JOB_POLL_TIMEOUT_MS = 60000;
+const EVENTS_RETRY_MS = 5000;
+// The server may run on demand and exit when idle, so it is only contacted
+// for rules this often (and while attaching), and /events is only held open
+// while a job is being waited for
+const RULES_REFRESH_MS = 30 * 60 * 1000;
+
+// Native messaging host (outlook-attach-native-host.py), preferred over HTTP
+// when installed; the port is closed again after NATIVE_IDLE_MS without use
+const NATIVE_HOST = 'com.outlookattach.host';
+const NATIVE_IDLE_MS = 5 * 60 * 1000;
+
+// Document rules, kept in sync with the server's document-rules.json via GET /rules.
+// The built-in copy is used until the server has answered or when it is not running.
+let documentRules = [
+  { type: 'Faktura', pattern: '\\d{7}', flags: '' },
+  { type: 'Order', pattern: 'inköp|inkop', flags: 'i' },
+  { type: 'Orderbekräftelse', pattern: 'orderbekräftelse|orderbekr', flags: 'i' }
+].map(compileRule).filter(Boolean);
+let rulesLoadedAt = 0;
+
+function compileRule(rule) {
+  try {
+    return { type: rule.type, regex: new RegExp(rule.pattern, rule.flags || '') };
+  } catch (error) {
+    console.error('Invalid document rule:', rule, error);
+    return null;
+  }
+}
+
+function loadDocumentRules() {
+  serverRequest('GET', '/rules')
+    .then(data => {
+      const rules = (data.rules || []).map(compileRule).filter(Boolean);
+      rulesLoadedAt = Date.now();
+      if (rules.length > 0) {
+        documentRules = rules;
+        console.log('Loaded document rules from server:', rules.map(rule => rule.type));
+      }
+    })
+    .catch(() => {
+      // Server not running - keep the rules we have
+    });
+}
+
+loadDocumentRules();
+
 // Function to check if filename matches criteria
 function shouldProcessFile(filePath) {
   if (!filePath) return false;
@@ -21,32 +75,16 @@ function shouldProcessFile(filePath) {
   // Extract filename from path
   const filename = filePath.split('/').pop().split('\\').pop();
   
-  // Normalize to lowercase for comparison
-  const filenameLower = filename.toLowerCase();
-  
-  // Check if filename includes "Orderbekräftelse" (case-insensitive), any 7-digit number, or "Inköp"
-  const includesOrderbekraeftelse = filenameLower.includes('orderbekräftelse') || 
-                                     filenameLower.includes('orderbekr');
-  // Check for any 7-digit number (e.g., 1000322, 1000355, etc.)
-  // Match 7 consecutive digits anywhere in the filename
-  const includesOrderNumber = /\d{7}/.test(filename);
-  const includesInkop = filenameLower.includes('inköp') || filenameLower.includes('inkop');
-  
-  const shouldProcess = includesOrderbekraeftelse || includesOrderNumber || includesInkop;
+  // Same rules as the server uses to name the copy (first matching rule wins)
+  const matchedRule = documentRules.find(rule => rule.regex.test(filename));
+  const shouldProcess = Boolean(matchedRule);
   
   // Debug logging
   if (shouldProcess) {
-    console.log('File matches criteria:', filename, {
-      includesOrderbekraeftelse,
-      includesOrderNumber,
-      includesInkop
-    });
+    console.log('File matches criteria:', filename, { documentType: matchedRule.type });
   } else {
     console.log('File does not match criteria:', filename, {
-      includesOrderbekraeftelse,
-      includesOrderNumber,
-      includesInkop,
-      has7Digits: /\d{7}/.test(filename)
+      rules: documentRules.map(rule => rule.type)
     });
   }
   
@@ -130,7 +168,8 @@ function showConfirmationDialog(filePath, downloadId) {
       chrome.runtime.sendMessage({
         action: 'showConfirmation',
         filePath: filePath,
-        downloadId: downloadId
+        downloadId: downloadId,
+        needsFileAccess: fileAccessNeeded
       }).catch(() => {
         // Popup not open, user will see badge and click icon
       });
@@ -159,7 +198,7 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
     const entries = Array.from(pendingFiles.entries());
     if (entries.length > 0) {
       const [downloadId, filePath] = entries[0];
-      sendResponse({ filePath: filePath, downloadId: downloadId });
+      sendResponse({ filePath: filePath, downloadId: downloadId, needsFileAccess: fileAccessNeeded });
     } else {
       sendResponse({ filePath: null });
     }
@@ -178,7 +217,7 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
         pendingFiles.delete(request.downloadId);
       }
       // Send to server to open Outlook
-      sendToServer(filePath);
+      sendToServer(filePath, request.downloadId);
       sendResponse({ success: true });
     } else {
       console.error('File path not found for download ID:', request.downloadId);
@@ -200,22 +239,290 @@ chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
   }
 });
 
+// Native messaging: requests waiting for a reply, id -> { resolve, reject }
+const nativeRequests = new Map();
+let nativePort = null;
+let nativeUnavailable = false;
+let nativeNextId = 1;
+let nativeIdleTimer = null;
+
+function connectNative() {
+  if (nativePort || nativeUnavailable) return nativePort;
+  let port;
+  try {
+    port = chrome.runtime.connectNative(NATIVE_HOST);
+  } catch (error) {
+    nativeUnavailable = true;
+    return null;
+  }
+  let answered = false;
+  port.onMessage.addListener(message => {
+    answered = true;
+    const request = nativeRequests.get(message.id);
+    if (!request) return;
+    nativeRequests.delete(message.id);
+    request.resolve(message);
+    scheduleNativeIdle();
+  });
+  port.onDisconnect.addListener(() => {
+    const reason = chrome.runtime.lastError ? chrome.runtime.lastError.message : 'Native host exited';
+    if (nativePort === port) nativePort = null;
+    // A host that never answered is not installed (or cannot start): use HTTP
+    // from now on. Requests already sent to a working host are not retried
+    // over HTTP, since the attach may have happened.
+    if (!answered) nativeUnavailable = true;
+    nativeRequests.forEach(request => {
+      const error = new Error(reason);
+      error.hostUnavailable = !answered;
+      request.reject(error);
+    });
+    nativeRequests.clear();
+  });
+  nativePort = port;
+  return port;
+}
+
+function scheduleNativeIdle() {
+  clearTimeout(nativeIdleTimer);
+  nativeIdleTimer = setTimeout(() => {
+    if (nativePort && nativeRequests.size === 0) {
+      nativePort.disconnect();
+      nativePort = null;
+    }
+  }, NATIVE_IDLE_MS);
+}
+
+// Send a request to the native host; resolves with { id, status, body }
+function nativeRequest(method, path, body) {
+  return new Promise((resolve, reject) => {
+    const port = connectNative();
+    if (!port) {
+      const error = new Error('Native host not available');
+      error.hostUnavailable = true;
+      reject(error);
+      return;
+    }
+    const id = nativeNextId++;
+    nativeRequests.set(id, { resolve, reject });
+    clearTimeout(nativeIdleTimer);
+    port.postMessage({ id, method, path, body });
+  });
+}
+
+// JSON request to the server, through the native host when it is installed
+function serverRequest(method, path, body) {
+  return nativeRequest(method, path, body)
+    .then(reply => reply.body)
+    .catch(error => {
+      if (!error.hostUnavailable) throw error;
+      return fetch(`${SERVER_URL}${path}`, {
+        method,
+        headers: body ? { 'Content-Type': 'application/json' } : {},
+        body: body ? JSON.stringify(body) : undefined
+      }).then(response => response.json());
+    });
+}
+
+// Jobs waiting for their outcome: jobId -> callback(result)
+const jobWaiters = new Map();
+let eventsConnected = false;
+let eventsController = null;
+
+// Follow the server's /events stream while jobs are waiting and hand finished
+// jobs to their waiters. Service workers have no EventSource, so the stream
+// is read from fetch().
+function subscribeToEvents() {
+  if (eventsConnected || jobWaiters.size === 0) return;
+  eventsConnected = true;
+  eventsController = new AbortController();
+  fetch(`${SERVER_URL}/events`, { signal: eventsController.signal })
+    .then(response => {
+      if (!response.ok) throw new Error(`HTTP ${response.status}`);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      const read = () => reader.read().then(({ done, value }) => {
+        if (done) throw new Error('Event stream closed');
+        buffer += decoder.decode(value, { stream: true });
+        const messages = buffer.split('\n\n');
+        buffer = messages.pop();
+        messages.forEach(handleEventMessage);
+        return read();
+      });
+      return read();
+    })
+    .catch(() => {
+      eventsConnected = false;
+      eventsController = null;
+      if (jobWaiters.size > 0) setTimeout(subscribeToEvents, EVENTS_RETRY_MS);
+    });
+}
+
+// Close the stream once nothing is waiting, so an on-demand server can idle out
+function unsubscribeFromEvents() {
+  if (jobWaiters.size > 0 || !eventsController) return;
+  eventsController.abort();
+}
+
+function handleEventMessage(message) {
+  const data = message.split('\n')
+    .filter(line => line.startsWith('data:'))
+    .map(line => line.slice(5).trim())
+    .join('\n');
+  if (!data) return;
+  const event = JSON.parse(data);
+  const waiter = jobWaiters.get(event.jobId);
+  if (!waiter) return;
+  if (event.event === 'done' || event.event === 'failed') {
+    waiter(event.result);
+  } else if (event.event === 'cancelled') {
+    waiter({ success: false, message: 'Job cancelled' });
+  }
+}
+
+// Resolve with the result of a queued attach job once it finishes
+function waitForJob(jobId) {
+  const deadline = Date.now() + JOB_POLL_TIMEOUT_MS;
+  return new Promise(resolve => {
+    const finish = result => {
+      if (jobWaiters.get(jobId) !== finish) return;
+      jobWaiters.delete(jobId);
+      unsubscribeFromEvents();
+      resolve(result);
+    };
+    jobWaiters.set(jobId, finish);
+    subscribeToEvents();
+    pollJob(jobId, deadline, finish);
+  });
+}
+
+// Fallback for a missed or unavailable event stream
+function pollJob(jobId, deadline, finish) {
+  const delay = eventsConnected ? JOB_POLL_FALLBACK_MS : JOB_POLL_INTERVAL_MS;
+  setTimeout(() => {
+    if (!jobWaiters.has(jobId)) return;
+    fetch(`${SERVER_URL}/jobs/${jobId}`)
+      .then(response => response.json())
+      .then(job => {
+        if (job.state !== 'queued' && job.state !== 'running') {
+          finish(job.result || { success: false, message: `Job ${job.state}` });
+        } else if (Date.now() > deadline) {
+          finish({ success: false, message: 'Timed out waiting for Outlook' });
+        } else {
+          pollJob(jobId, deadline, finish);
+        }
+      })
+      .catch(() => finish({ success: false, message: 'Lost connection to local server' }));
+  }, delay);
+}
+
+// Optional host permission for reading downloads in uploadFile. It is only
+// requested once the fallback is needed; permissions.request needs a user
+// gesture, so the popup asks for it on the next confirm click.
+const FILE_ORIGINS = ['file:///*'];
+let fileAccessNeeded = false;
+
+// The server could not open the download by path (it runs as another user,
+// in a sandbox or on another machine): read the file through its file:// URL
+// and stream it to /attach/upload instead. Reading file:// URLs needs
+// "Allow access to file URLs" on the extension's details page and the
+// optional file:///* permission.
+function uploadFile(filePath, downloadId) {
+  const path = filePath.replace(/\\/g, '/');
+  const fileUrl = 'file://' + (path.startsWith('/') ? '' : '/') +
+    encodeURI(path).replace(/#/g, '%23').replace(/\?/g, '%3F');
+  const params = new URLSearchParams({ name: path.split('/').pop(), async: '1' });
+  if (downloadId != null) params.set('requestId', String(downloadId));
+  
+  return Promise.all([
+    chrome.extension.isAllowedFileSchemeAccess(),
+    chrome.permissions.contains({ origins: FILE_ORIGINS })
+  ]).then(([allowed, granted]) => {
+    if (!allowed) {
+      return { success: false, message: 'The server cannot read this file. Turn on "Allow access to ' +
+        'file URLs" on the extension\'s details page to send it from the browser instead.' };
+    }
+    if (!granted) {
+      // Offer the file again; confirming it grants the permission
+      fileAccessNeeded = true;
+      showConfirmationDialog(filePath, downloadId);
+      return { success: false, message: 'The server cannot read this file. Confirm it again to let ' +
+        'the extension read it.' };
+    }
+    fileAccessNeeded = false;
+    return fetch(fileUrl)
+      .then(response => response.blob())
+      .then(blob => fetch(`${SERVER_URL}/attach/upload?${params}`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/octet-stream' },
+        body: blob
+      }))
+      .then(response => response.json())
+      .then(data => {
+        if (data.duplicate) return null;
+        return data.jobId ? waitForJob(data.jobId) : data;
+      });
+  });
+}
+
+// Whether the server on localhost attaches new downloads itself (--watch)
+function serverIsWatching() {
+  return fetch(`${SERVER_URL}/status`, { headers: { 'Accept': 'application/json' } })
+    .then(response => response.json())
+    .then(status => Boolean(status.watching))
+    .catch(() => false);
+}
+
 // Function to send file path to local server
-function sendToServer(filePath) {  
-  const serverUrl = 'http://localhost:8765/attach';
+// downloadId doubles as the request ID, so the server answers a repeated
+// confirm of the same download with the first result instead of attaching again
+function sendToServer(filePath, downloadId) {  
+  const request = {
+    filePath: filePath,
+    requestId: downloadId != null ? String(downloadId) : undefined
+  };
   
-  // Send POST request to local server
-  fetch(serverUrl, {
-    method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-    },
-    body: JSON.stringify({ 
-      filePath: filePath
+  // The native host answers once the attach is done; over HTTP the attach
+  // runs as a queued job whose outcome is waited for. A server that watches
+  // the download folders has most likely attached this file already, so the
+  // request goes to it, where it is answered as a duplicate.
+  serverIsWatching()
+  .then(watching => {
+    if (watching) {
+      const error = new Error('Server watches downloads');
+      error.hostUnavailable = true;
+      throw error;
+    }
+    return nativeRequest('POST', '/attach', request);
+  })
+  .then(reply => reply.body)
+  .catch(error => {
+    if (!error.hostUnavailable) throw error;
+    return fetch(`${SERVER_URL}/attach`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ ...request, async: true })
     })
+    .then(response => response.json());
+  })
+  .then(data => {
+    if (data.duplicate) {
+      // A repeat of an attach already under way; it reports its own outcome
+      console.log('Duplicate attach request for job', data.jobId);
+      return null;
+    }
+    return data.jobId ? waitForJob(data.jobId) : data;
+  })
+  .then(data => {
+    if (data && !data.success && (data.message || '').startsWith('File not found')) {
+      return uploadFile(filePath, downloadId);
+    }
+    return data;
   })
-  .then(response => response.json())
   .then(data => {    
+    if (!data) return;
     if (data.success) {
       // Show success notification
       chrome.notifications.create({
@@ -3,7 +3,7 @@
 // Check if there's a pending file on load
 chrome.runtime.sendMessage({ action: 'getPendingFile' }, (response) => {
   if (response && response.filePath) {
-    showConfirmation(response.filePath, response.downloadId);
+    showConfirmation(response.filePath, response.downloadId, response.needsFileAccess);
   } else {
     // Show waiting message
     document.getElementById('waiting').classList.remove('hidden');
@@ -11,7 +11,7 @@ chrome.runtime.sendMessage({ action: 'getPendingFile' }, (response) => {
   }
 });
 
-function showConfirmation(filePath, downloadId) {
+function showConfirmation(filePath, downloadId, needsFileAccess) {
   document.getElementById('waiting').classList.add('hidden');
   document.getElementById('confirmation').classList.remove('hidden');
   
@@ -35,15 +35,22 @@ function showConfirmation(filePath, downloadId) {
 
   // Handle confirm button
   document.getElementById('confirmBtn').addEventListener('click', () => {
-    chrome.runtime.sendMessage({
-      action: 'confirmOutlook',
-      filePath: filePath,
-      downloadId: downloadId
-    }, (response) => {
-      if (chrome.runtime.lastError) {
-        console.error('Error:', chrome.runtime.lastError);
-      }
-      window.close();
+    // The server could not read an earlier file: ask for file access now,
+    // while there is a user gesture, so the extension can upload it
+    const fileAccess = needsFileAccess
+      ? chrome.permissions.request({ origins: ['file:///*'] }).catch(() => false)
+      : Promise.resolve(false);
+    fileAccess.then(() => {
+      chrome.runtime.sendMessage({
+        action: 'confirmOutlook',
+        filePath: filePath,
+        downloadId: downloadId
+      }, (response) => {
+        if (chrome.runtime.lastError) {
+          console.error('Error:', chrome.runtime.lastError);
+        }
+        window.close();
+      });
     });
   });
 }
@@ -51,7 +58,7 @@ function showConfirmation(filePath, downloadId) {
 // Listen for messages from background script
 chrome.runtime.onMessage.addListener((request, sender, sendResponse) => {
   if (request.action === 'showConfirmation') {
-    showConfirmation(request.filePath, request.downloadId);
+    showConfirmation(request.filePath, request.downloadId, request.needsFileAccess);
     sendResponse({ success: true });
   }
 });
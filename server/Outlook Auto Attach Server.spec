@@ -5,8 +5,8 @@ a = Analysis(
     ['outlook-attach-launcher.py'],
     pathex=[],
     binaries=[],
-    datas=[('outlook-attach-server.py', '.')],
-    hiddenimports=['tkinter', 'json', 'http.server', 'subprocess', 'platform', 'shutil', 'tempfile', 'datetime', 'socket', 'threading', 'importlib.util', 'win32com.client'],
+    datas=[('outlook-attach-server.py', '.'), ('document-rules.json', '.')],
+    hiddenimports=['tkinter', 'json', 'http.server', 'subprocess', 'platform', 'shutil', 'tempfile', 'datetime', 'socket', 'threading', 'importlib.util', 'argparse', 'concurrent.futures', 'asyncio', 'email.utils', 'queue', 'time', 'hashlib', 'ctypes', 'ctypes.util', 'errno', 'fcntl', 'msvcrt', 'uuid', 'itertools', 'bisect', 'cProfile', 'heapq', 'random', 'urllib.parse', 'stat', 'select', 'struct', 'sqlite3', 'zlib', 'win32com.client', 'pythoncom', 'win32con', 'win32event', 'win32file', 'pywintypes'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -0,0 +1,647 @@
+#!/usr/bin/env python3
+"""
+Outlook Auto Attach Benchmarks
+Measures the server in-process with Outlook automation stubbed out, so the
+numbers are comparable across macOS, Windows and Linux build agents.
+
+Usage:
+    python3 attach-benchmarks.py engines [--requests N] [--clients N]
+    python3 attach-benchmarks.py applescript [--calls N]      (macOS only)
+    python3 attach-benchmarks.py copy [--size-mb N] [--dir PATH]
+    python3 attach-benchmarks.py classify [--names FILE] [--count N] [--extra-rules N]
+    python3 attach-benchmarks.py load [--requests N] [--clients N] [--latency S]
+                                      [--failure-rate F] [--output DIR] [--compare FILE]
+    python3 attach-benchmarks.py native [--requests N] [--latency S] [--preflight]
+"""
+
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+
+def load_server_module():
+    """Load outlook-attach-server.py the same way the launcher does."""
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    server_file = os.path.join(base_path, "outlook-attach-server.py")
+    spec = importlib.util.spec_from_file_location("outlook_attach_server", server_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def percentile(samples, pct):
+    """Return the pct percentile of samples (nearest-rank)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def print_table(rows, columns):
+    """Print rows (dicts) as an aligned text table."""
+    widths = [max(len(name), *(len(str(row[key])) for row in rows)) for name, key in columns]
+    print("  ".join(name.ljust(width) for (name, _), width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[key]).ljust(width) for (_, key), width in zip(columns, widths)))
+
+
+class CountingConnection(http.client.HTTPConnection):
+    """HTTPConnection that counts TCP connects, including automatic reconnects."""
+
+    connects = 0
+    connects_lock = threading.Lock()
+
+    def connect(self):
+        with CountingConnection.connects_lock:
+            CountingConnection.connects += 1
+        super().connect()
+
+
+def run_clients(port, requests_per_client, clients, path, body):
+    """Send requests from several client threads, each reusing one connection object."""
+    latencies = []
+    latencies_lock = threading.Lock()
+    headers = {'Content-Type': 'application/json'} if body else {}
+
+    def client():
+        conn = CountingConnection('127.0.0.1', port, timeout=10)
+        local = []
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            conn.request('POST' if body else 'GET', path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            local.append(time.perf_counter() - start)
+        conn.close()
+        with latencies_lock:
+            latencies.extend(local)
+
+    CountingConnection.connects = 0
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return latencies, CountingConnection.connects, elapsed
+
+
+def bench_engines(args):
+    """Compare the threaded HTTPServer engine with the asyncio keep-alive engine."""
+    server_module = load_server_module()
+    server_module.configure_journal(None)
+
+    # Transport only: skip the copy and Outlook automation
+    def stub_attach_request(body, trace=None):
+        return 200, {'success': True, 'message': 'stubbed'}, None
+    server_module.ATTACH_ROUTES['/attach'] = stub_attach_request
+
+    body = json.dumps({'filePath': '/tmp/Faktura-1000322.pdf'}).encode('utf-8')
+    rows = []
+    for engine in server_module.ENGINES:
+        for path, payload in (('/status', None), ('/attach', body)):
+            httpd = server_module.create_server(('127.0.0.1', 0), engine=engine,
+                                                max_workers=args.clients + 1)
+            httpd.log_message = lambda *a, **k: None
+            if hasattr(httpd, 'RequestHandlerClass'):
+                httpd.RequestHandlerClass.log_message = lambda *a, **k: None
+            port = httpd.server_address[1]
+            thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+            thread.start()
+            try:
+                latencies, connects, elapsed = run_clients(
+                    port, args.requests // args.clients, args.clients, path, payload
+                )
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+            rows.append({
+                'engine': engine,
+                'path': path,
+                'requests': len(latencies),
+                'connections': connects,
+                'req_s': f"{len(latencies) / elapsed:.0f}",
+                'p50': f"{percentile(latencies, 50) * 1000:.2f}",
+                'p95': f"{percentile(latencies, 95) * 1000:.2f}",
+                'p99': f"{percentile(latencies, 99) * 1000:.2f}",
+            })
+
+    print_table(rows, [
+        ('engine', 'engine'), ('path', 'path'), ('requests', 'requests'),
+        ('connections', 'connections'), ('req/s', 'req_s'),
+        ('p50 ms', 'p50'), ('p95 ms', 'p95'), ('p99 ms', 'p99'),
+    ])
+
+
+def bench_applescript(args):
+    """Compare spawning osascript per call with the warm AppleScript runner."""
+    if platform.system() != 'Darwin':
+        print("The applescript benchmark needs macOS (osascript)")
+        return 1
+    server_module = load_server_module()
+
+    # A no-op handler isolates process spawn and compile cost from Outlook itself
+    source = 'on ping(value)\n    return value\nend ping\n'
+    spawn_latencies = []
+    for _ in range(args.calls):
+        start = time.perf_counter()
+        subprocess.run(
+            ['osascript', '-e', source + 'on run argv\n    return ping(item 1 of argv)\nend run', 'x'],
+            capture_output=True, check=True
+        )
+        spawn_latencies.append(time.perf_counter() - start)
+
+    runner = server_module.AppleScriptRunner(source)
+    start = time.perf_counter()
+    runner.call('ping', 'x')
+    runner_startup = time.perf_counter() - start
+    runner_latencies = []
+    for _ in range(args.calls):
+        start = time.perf_counter()
+        runner.call('ping', 'x')
+        runner_latencies.append(time.perf_counter() - start)
+    runner.close()
+
+    rows = []
+    for name, latencies in (('osascript spawn', spawn_latencies), ('warm runner', runner_latencies)):
+        rows.append({
+            'path': name,
+            'calls': len(latencies),
+            'mean': f"{sum(latencies) / len(latencies) * 1000:.1f}",
+            'p50': f"{percentile(latencies, 50) * 1000:.1f}",
+            'p95': f"{percentile(latencies, 95) * 1000:.1f}",
+        })
+    print_table(rows, [('path', 'path'), ('calls', 'calls'), ('mean ms', 'mean'),
+                       ('p50 ms', 'p50'), ('p95 ms', 'p95')])
+    saving = (sum(spawn_latencies) - sum(runner_latencies)) / args.calls
+    print(f"\nRunner startup (first call, includes compile): {runner_startup * 1000:.1f} ms")
+    print(f"Saving per attach: {saving * 1000:.1f} ms")
+
+
+def bench_copy(args):
+    """Time each copy strategy of clone_file on one large file."""
+    server_module = load_server_module()
+    work_dir = tempfile.mkdtemp(prefix='attach-copy-bench-', dir=args.dir)
+    try:
+        source = os.path.join(work_dir, 'scan.pdf')
+        with open(source, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        rows = []
+        for strategy in list(server_module.COPY_STRATEGIES) + ['auto']:
+            target = os.path.join(work_dir, f'copy-{strategy}.pdf')
+            try:
+                result = server_module.clone_file(
+                    source, target, None if strategy == 'auto' else [strategy]
+                )
+            except OSError as e:
+                rows.append({'requested': strategy, 'used': f'unavailable ({e.strerror or e})',
+                             'ms': '-', 'mb_s': '-'})
+                continue
+            rows.append({
+                'requested': strategy,
+                'used': result.strategy,
+                'ms': f"{result.seconds * 1000:.2f}",
+                'mb_s': f"{result.bytes / (1024 * 1024) / max(result.seconds, 1e-9):.0f}",
+            })
+            os.remove(target)
+        print(f"{args.size_mb} MB file in {work_dir}")
+        print_table(rows, [('strategy', 'requested'), ('used', 'used'),
+                           ('ms', 'ms'), ('MB/s', 'mb_s')])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def legacy_classify(original_name):
+    """The substring checks create_unique_file_copy used before the rule engine."""
+    original_lower = original_name.lower()
+    if re.search(r'\d{7}', original_name):
+        return "Faktura"
+    if 'inköp' in original_lower or 'inkop' in original_lower:
+        return "Order"
+    return "Orderbekräftelse"
+
+
+def synthetic_download_names(count, seed=1):
+    """Generate download names shaped like the ones the extension sees."""
+    rng = random.Random(seed)
+    shapes = [
+        lambda: f"Faktura {rng.randint(1000000, 1999999)}.pdf",
+        lambda: f"Inköpsorder {rng.randint(1, 99999)}.pdf",
+        lambda: f"Orderbekräftelse_{rng.randint(1, 99999)}.pdf",
+        lambda: f"Order-{rng.randint(100, 999)}-{rng.randint(1000000, 9999999)} (1).pdf",
+        lambda: f"IMG_{rng.randint(1000, 9999)}.jpeg",
+        lambda: f"report-{rng.randint(2019, 2026)}-q{rng.randint(1, 4)}.xlsx",
+        lambda: "".join(rng.choice("abcdefghij_- ") for _ in range(rng.randint(8, 60))) + ".pdf",
+    ]
+    return [rng.choice(shapes)() for _ in range(count)]
+
+
+def bench_classify(args):
+    """Time document classification over a corpus of download names."""
+    server_module = load_server_module()
+    if args.names:
+        with open(args.names, 'r', encoding='utf-8') as f:
+            names = [line.strip() for line in f if line.strip()]
+    else:
+        names = synthetic_download_names(args.count)
+
+    config = json.loads(json.dumps(server_module.DEFAULT_DOCUMENT_RULES))
+    if os.path.exists(server_module.DOCUMENT_RULES_FILE):
+        with open(server_module.DOCUMENT_RULES_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    for i in range(args.extra_rules):
+        config['rules'].append({'type': f'Extra{i}', 'pattern': f'extra-document-{i}-[a-z]+', 'flags': 'i'})
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False, encoding='utf-8') as f:
+        json.dump(config, f)
+        rules_path = f.name
+    try:
+        rules = server_module.DocumentRules(rules_path)
+    finally:
+        os.remove(rules_path)
+    rules.path = None
+
+    mismatches = sum(
+        1 for name in names if legacy_classify(name) != rules.classify(name).document_type
+    ) if not args.extra_rules else '-'
+
+    rows = []
+    for label, classify in (('legacy substring checks', legacy_classify),
+                            (f'rule engine ({len(rules.rules)} rules)', rules.classify)):
+        start = time.perf_counter()
+        for name in names:
+            classify(name)
+        elapsed = time.perf_counter() - start
+        rows.append({
+            'classifier': label,
+            'names': len(names),
+            'total': f"{elapsed * 1000:.1f}",
+            'per_name': f"{elapsed / len(names) * 1e9:.0f}",
+        })
+    print_table(rows, [('classifier', 'classifier'), ('names', 'names'),
+                       ('total ms', 'total'), ('ns/name', 'per_name')])
+    print(f"\nNames classified differently from the legacy checks: {mismatches}")
+
+
+def make_download_files(directory, count, seed=1):
+    """
+    Write count files with download-like names and sizes: mostly small PDFs,
+    some multi-megabyte scans (log-normal, median ~200 KB, capped at 20 MB).
+    """
+    rng = random.Random(seed)
+    paths = []
+    for i, name in enumerate(synthetic_download_names(count, seed)):
+        size = int(min(20 * 1024 * 1024, max(10 * 1024, rng.lognormvariate(12.2, 1.2))))
+        path = os.path.join(directory, f"{i:04d} {name}")
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def latency_row(route, latencies, errors, elapsed):
+    """Summarize one route's latencies as a result row (milliseconds)."""
+    return {
+        'route': route,
+        'requests': len(latencies),
+        'errors': errors,
+        'req_s': round(len(latencies) / elapsed, 1),
+        'p50': round(percentile(latencies, 50) * 1000, 2),
+        'p95': round(percentile(latencies, 95) * 1000, 2),
+        'p99': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def bench_load(args):
+    """Mixed /attach and /status load against the simulated Outlook backend."""
+    server_module = load_server_module()
+    work_dir = tempfile.mkdtemp(prefix='attach-load-')
+    try:
+        files = make_download_files(work_dir, args.files)
+        docs_dir = os.path.join(work_dir, 'businessnxtdocs')
+        server_module.get_businessnxtdocs_dir = lambda: docs_dir
+        server_module.DEDUP_ENABLED = not args.no_dedup
+        server_module.configure_backend('simulated', args.latency, args.latency / 2,
+                                        args.failure_rate, seed=1)
+        # Repeated picks of the same file must each run the pipeline
+        server_module._idempotency_cache = server_module.IdempotencyCache(window=0)
+        # Journal the run under work_dir, not into the user's attach history
+        server_module.configure_journal(os.path.join(work_dir, 'journal.db'))
+
+        httpd = server_module.create_server(('127.0.0.1', 0), engine=args.engine,
+                                            max_workers=args.workers)
+        httpd.log_message = lambda *a, **k: None
+        if hasattr(httpd, 'RequestHandlerClass'):
+            httpd.RequestHandlerClass.log_message = lambda *a, **k: None
+        port = httpd.server_address[1]
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+
+        latencies = {'/attach': [], '/status': []}
+        errors = {'/attach': 0, '/status': 0}
+        statuses = {}
+        copies = []
+        lock = threading.Lock()
+        per_client = args.requests // args.clients
+
+        def client(seed):
+            rng = random.Random(seed)
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            for _ in range(per_client):
+                if rng.random() < args.status_ratio:
+                    route, method, body = '/status', 'GET', None
+                else:
+                    body = json.dumps({'filePath': rng.choice(files)}).encode('utf-8')
+                    route, method = '/attach', 'POST'
+                start = time.perf_counter()
+                conn.request(method, route, body=body, headers={'Content-Type': 'application/json'})
+                response = conn.getresponse()
+                payload = response.read()
+                elapsed = time.perf_counter() - start
+                data = json.loads(payload) if route == '/attach' and payload else {}
+                with lock:
+                    latencies[route].append(elapsed)
+                    key = f"{route} {response.status}"
+                    statuses[key] = statuses.get(key, 0) + 1
+                    if response.status != 200 or (route == '/attach' and not data.get('success')):
+                        errors[route] += 1
+                    if 'copy' in data and not data.get('duplicate'):
+                        copies.append(data['copy'])
+            conn.close()
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        httpd.shutdown()
+        httpd.server_close()
+    finally:
+        server_module.configure_journal(None)
+        server_module.flush_document_stores()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    rows = [latency_row(route, latencies[route], errors[route], elapsed)
+            for route in ('/attach', '/status') if latencies[route]]
+    copied_bytes = sum(c['bytes'] for c in copies)
+    copy_seconds = sum(c['seconds'] for c in copies)
+    strategies = {}
+    for c in copies:
+        strategies[c['strategy']] = strategies.get(c['strategy'], 0) + 1
+    result = {
+        'benchmark': 'load',
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'settings': {
+            'engine': args.engine, 'workers': args.workers, 'clients': args.clients,
+            'requests': per_client * args.clients, 'status_ratio': args.status_ratio,
+            'latency': args.latency, 'failure_rate': args.failure_rate,
+            'files': args.files, 'dedup': not args.no_dedup,
+        },
+        'elapsed': round(elapsed, 3),
+        'routes': rows,
+        'statuses': statuses,
+        'copy': {
+            'copies': len(copies),
+            'bytes': copied_bytes,
+            'seconds': round(copy_seconds, 4),
+            'mb_s': round(copied_bytes / (1024 * 1024) / max(copy_seconds, 1e-9), 1),
+            'strategies': strategies,
+        },
+    }
+
+    print(f"{result['settings']['requests']} requests from {args.clients} clients in {elapsed:.1f} s "
+          f"({args.engine} engine, simulated Outlook {args.latency * 1000:.0f} ms)")
+    print_table(rows, [('route', 'route'), ('requests', 'requests'), ('errors', 'errors'),
+                       ('req/s', 'req_s'), ('p50 ms', 'p50'), ('p95 ms', 'p95'), ('p99 ms', 'p99')])
+    print(f"\nResponses: {statuses}")
+    print(f"Copy I/O: {len(copies)} copies, {copied_bytes / (1024 * 1024):.1f} MB in "
+          f"{copy_seconds * 1000:.0f} ms, strategies {strategies}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = {row['route']: row for row in json.load(f)['routes']}
+        compare_rows = []
+        for row in rows:
+            base = baseline.get(row['route'])
+            if base is None:
+                continue
+            compare_row = {'route': row['route']}
+            for key in ('req_s', 'p50', 'p95', 'p99'):
+                change = (row[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+                compare_row[key] = f"{base[key]} -> {row[key]} ({change:+.0f}%)"
+            compare_rows.append(compare_row)
+        print(f"\nCompared with {args.compare}:")
+        print_table(compare_rows, [('route', 'route'), ('req/s', 'req_s'), ('p50 ms', 'p50'),
+                                   ('p95 ms', 'p95'), ('p99 ms', 'p99')])
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        path = os.path.join(args.output, f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        print(f"\nSaved results to {path}")
+
+
+class NativeHostClient:
+    """Plays Chrome's side of native messaging against outlook-attach-native-host.py."""
+
+    def __init__(self, env):
+        host = os.path.join(os.path.dirname(os.path.abspath(__file__)), "outlook-attach-native-host.py")
+        self.process = subprocess.Popen([sys.executable, host], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+        self.next_id = 1
+
+    def request(self, method, path, body=None):
+        """Send one request and wait for its reply; returns (status, body)."""
+        message = {'id': self.next_id, 'method': method, 'path': path, 'body': body}
+        self.next_id += 1
+        payload = json.dumps(message).encode('utf-8')
+        self.process.stdin.write(struct.pack('=I', len(payload)) + payload)
+        self.process.stdin.flush()
+        length, = struct.unpack('=I', self.process.stdout.read(4))
+        reply = json.loads(self.process.stdout.read(length))
+        return reply['status'], reply['body']
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait(timeout=10)
+
+
+class HTTPServiceClient:
+    """Runs outlook-attach-service.py on a free port and talks to it like the extension's fetch()."""
+
+    def __init__(self, env, engine, preflight=False):
+        service = os.path.join(os.path.dirname(os.path.abspath(__file__)), "outlook-attach-service.py")
+        self.process = subprocess.Popen(
+            [sys.executable, service, '--port', '0', '--report-ready', '--engine', engine,
+             '--log-file', os.path.join(env['HOME'], 'service.log')],
+            stdout=subprocess.PIPE, text=True, env=env
+        )
+        port = json.loads(self.process.stdout.readline())['port']
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        self.preflight = preflight
+
+    def request(self, method, path, body=None):
+        """Send one request (after a CORS preflight if enabled); returns (status, body)."""
+        if self.preflight and method == 'POST':
+            self.conn.request('OPTIONS', path, headers={'Origin': 'chrome-extension://benchmark',
+                                                        'Access-Control-Request-Method': 'POST'})
+            self.conn.getresponse().read()
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        self.conn.request(method, path, body=payload, headers={'Content-Type': 'application/json'})
+        response = self.conn.getresponse()
+        data = response.read()
+        if response.getheader('Content-Type', '').startswith('application/json'):
+            return response.status, json.loads(data)
+        return response.status, {'text': data.decode('utf-8', 'replace')}
+
+    def close(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.wait(timeout=10)
+
+
+def bench_native(args):
+    """Native messaging host vs localhost HTTP: cold start and per-request latency."""
+    work_dir = tempfile.mkdtemp(prefix='attach-native-')
+    try:
+        files = make_download_files(work_dir, args.files)
+        # Both transports run the real pipeline in a child process, with
+        # simulated Outlook, copies under work_dir and duplicates not merged;
+        # the host runs in its default mode (no forwarding to a server)
+        env = dict(os.environ, HOME=work_dir, USERPROFILE=work_dir,
+                   OUTLOOK_ATTACH_BACKEND='simulated',
+                   OUTLOOK_ATTACH_SIMULATED_LATENCY=str(args.latency),
+                   OUTLOOK_ATTACH_SIMULATED_JITTER='0',
+                   OUTLOOK_ATTACH_IDEMPOTENCY_WINDOW='0')
+        env.pop('OUTLOOK_ATTACH_NATIVE_FORWARD', None)
+        transports = [('native', lambda: NativeHostClient(env))]
+        for engine in ('threaded', 'asyncio'):
+            transports.append((f"http {engine}", lambda engine=engine: HTTPServiceClient(env, engine)))
+            if args.preflight:
+                transports.append((f"http {engine} +preflight",
+                                   lambda engine=engine: HTTPServiceClient(env, engine, preflight=True)))
+
+        rows = []
+        for name, make_client in transports:
+            start = time.perf_counter()
+            client = make_client()
+            try:
+                client.request('GET', '/status')
+                cold = time.perf_counter() - start
+                for route, method in (('/status', 'GET'), ('/attach', 'POST')):
+                    latencies = []
+                    errors = 0
+                    route_start = time.perf_counter()
+                    for i in range(args.requests):
+                        body = {'filePath': files[i % len(files)]} if method == 'POST' else None
+                        request_start = time.perf_counter()
+                        status, data = client.request(method, route, body)
+                        latencies.append(time.perf_counter() - request_start)
+                        if status != 200 or (method == 'POST' and not data.get('success')):
+                            errors += 1
+                    row = latency_row(route, latencies, errors, time.perf_counter() - route_start)
+                    row.update(transport=name, cold=round(cold * 1000, 1))
+                    rows.append(row)
+            finally:
+                client.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{args.requests} sequential requests per route and transport "
+          f"(simulated Outlook {args.latency * 1000:.0f} ms)")
+    print_table(rows, [('transport', 'transport'), ('route', 'route'), ('cold start ms', 'cold'),
+                       ('errors', 'errors'), ('req/s', 'req_s'), ('p50 ms', 'p50'),
+                       ('p95 ms', 'p95'), ('p99 ms', 'p99')])
+
+    if args.output:
+        result = {
+            'benchmark': 'native',
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'platform': platform.platform(),
+            'settings': {'requests': args.requests, 'files': args.files,
+                         'latency': args.latency, 'preflight': args.preflight},
+            'routes': rows,
+        }
+        os.makedirs(args.output, exist_ok=True)
+        path = os.path.join(args.output, f"native-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        print(f"\nSaved results to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Outlook Auto Attach benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    engines = subparsers.add_parser('engines', help="threaded vs asyncio engine, connections and latency")
+    engines.add_argument('--requests', type=int, default=2000, help="total requests per run")
+    engines.add_argument('--clients', type=int, default=4, help="concurrent client threads")
+    engines.set_defaults(func=bench_engines)
+
+    applescript = subparsers.add_parser('applescript', help="osascript spawn vs warm AppleScript runner")
+    applescript.add_argument('--calls', type=int, default=50, help="calls per path")
+    applescript.set_defaults(func=bench_applescript)
+
+    copy = subparsers.add_parser('copy', help="clone_file strategies on one large file")
+    copy.add_argument('--size-mb', type=int, default=200, help="size of the test file")
+    copy.add_argument('--dir', default=None, help="directory to test in (default: system temp)")
+    copy.set_defaults(func=bench_copy)
+
+    classify = subparsers.add_parser('classify', help="document rule engine over a name corpus")
+    classify.add_argument('--names', default=None, help="file with one download name per line")
+    classify.add_argument('--count', type=int, default=200000, help="synthetic names when --names is not given")
+    classify.add_argument('--extra-rules', type=int, default=0, help="add N extra rules to check scaling")
+    classify.set_defaults(func=bench_classify)
+
+    load = subparsers.add_parser('load', help="mixed /attach and /status load with simulated Outlook")
+    load.add_argument('--requests', type=int, default=1000, help="total requests")
+    load.add_argument('--clients', type=int, default=8, help="concurrent client connections")
+    load.add_argument('--status-ratio', type=float, default=0.2, help="fraction of requests to /status")
+    load.add_argument('--latency', type=float, default=0.05, help="seconds per simulated Outlook attach")
+    load.add_argument('--failure-rate', type=float, default=0.0, help="fraction of simulated attaches that fail")
+    load.add_argument('--files', type=int, default=50, help="distinct download files to attach")
+    load.add_argument('--no-dedup', action='store_true', help="copy every attach instead of deduplicating")
+    load.add_argument('--engine', default='threaded', help="server engine (threaded or asyncio)")
+    load.add_argument('--workers', type=int, default=16,
+                      help="server worker threads (attaches beyond workers - 1 get 503)")
+    load.add_argument('--output', default='benchmark-results', help="directory to save the JSON result in")
+    load.add_argument('--compare', default=None, help="earlier result JSON to compare against")
+    load.set_defaults(func=bench_load)
+
+    native = subparsers.add_parser('native', help="native messaging host vs localhost HTTP")
+    native.add_argument('--requests', type=int, default=200, help="sequential requests per route")
+    native.add_argument('--files', type=int, default=20, help="distinct download files to attach")
+    native.add_argument('--latency', type=float, default=0.0, help="seconds per simulated Outlook attach")
+    native.add_argument('--preflight', action='store_true',
+                        help="also run HTTP with a CORS preflight before each POST")
+    native.add_argument('--output', default='benchmark-results', help="directory to save the JSON result in")
+    native.set_defaults(func=bench_native)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,14 +5,19 @@ Simple GUI application to start/stop the server
 Version: 1.0.1
 """
 
+import time
+LAUNCH_TIME = time.perf_counter()
+
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import threading
-import http.server
+import itertools
+import errno
 import sys
 import os
 import socket
 import urllib.request
+from collections import deque
 from datetime import datetime
 
 # Import server functionality from outlook-attach-server.py
@@ -33,59 +38,144 @@ def get_server_file_path():
     
     return server_file
 
-# Import server code
-try:
-    import importlib.util
-    server_file_path = get_server_file_path()
-    spec = importlib.util.spec_from_file_location(
-        "outlook_attach_server",
-        server_file_path
-    )
-    server_module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(server_module)
-except Exception as e:
-    # If import fails, show error and exit
-    import traceback
-    error_msg = f"Failed to load server module: {e}\n{traceback.format_exc()}"
-    print(error_msg, file=sys.stderr)
-    # Try to show error dialog (might not work if tkinter isn't loaded)
-    try:
-        import tkinter.messagebox
-        root = tk.Tk()
-        root.withdraw()
-        tkinter.messagebox.showerror("Error", f"Failed to start application:\n{e}")
-    except:
-        pass
-    sys.exit(1)
+# The server module is loaded on first use, after the window is up
+server_module = None
+GUIAttachHandler = None
+_server_module_lock = threading.Lock()
+
+
+def load_server_module():
+    """Load outlook-attach-server.py once and return it; safe to call off the Tk thread."""
+    global server_module, GUIAttachHandler
+    with _server_module_lock:
+        if server_module is None:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location(
+                "outlook_attach_server",
+                get_server_file_path()
+            )
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            GUIAttachHandler = make_gui_handler(module.AttachHandler)
+            server_module = module
+        return server_module
+
 
-PORT = server_module.PORT
-BaseAttachHandler = server_module.AttachHandler
+def make_gui_handler(base_handler):
+    """Create the GUI-aware request handler class on top of the server's AttachHandler."""
+    
+    class GUIAttachHandler(base_handler):
+        """HTTP request handler that logs to GUI."""
+        
+        def log_message(self, format, *args):
+            """Override to log to GUI as well as stderr."""
+            timestamp = datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")
+            message = f"{timestamp} {format % args}"
+            # Log to stderr (original behavior)
+            sys.stderr.write(message + "\n")
+            # Also send to GUI log if callback is set
+            if hasattr(self.server, 'log_callback'):
+                self.server.log_callback(message)
+    
+    return GUIAttachHandler
 
-# Create GUI-aware handler that logs to GUI
-class GUIAttachHandler(BaseAttachHandler):
-    """HTTP request handler that logs to GUI."""
-    
-    def log_message(self, format, *args):
-        """Override to log to GUI as well as stderr."""
-        timestamp = datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")
-        message = f"{timestamp} {format % args}"
-        # Log to stderr (original behavior)
-        sys.stderr.write(message + "\n")
-        # Also send to GUI log if callback is set
-        if hasattr(self.server, 'log_callback'):
-            self.server.log_callback(message)
 
+# Activity log: messages wait in a ring buffer until the GUI drains them every
+# LOG_TICK_MS; the Text widget shows at most LOG_WIDGET_LINES, trimmed in
+# blocks of LOG_TRIM_LINES, and the full history goes to a searchable file
+LOG_BUFFER_LINES = 10000
+LOG_TICK_MS = 100
+LOG_WIDGET_LINES = 500
+LOG_TRIM_LINES = 100
+LOG_HISTORY_MAX_BYTES = 5 * 1024 * 1024
+LOG_SEARCH_RESULTS = 500
+
+
+class LogHistory:
+    """
+    Append-only activity history on disk, rotated to a single .1 file once it
+    passes max_bytes. Searching reads the files line by line, so the history
+    never has to be held in memory or in the log widget.
+    """
+    
+    def __init__(self, path=None, max_bytes=LOG_HISTORY_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pending = []
+    
+    def open(self, path):
+        """Set the history file; lines appended before this are written to it now."""
+        with self.lock:
+            self.path = path
+            pending, self.pending = self.pending, []
+        if pending:
+            self.append("".join(pending))
+    
+    def append(self, text):
+        """Append already formatted lines (held back until a path is set)."""
+        with self.lock:
+            if self.path is None:
+                self.pending.append(text)
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(text)
+            except OSError as e:
+                sys.stderr.write(f"Could not write activity history: {e}\n")
+    
+    def search(self, term, limit=LOG_SEARCH_RESULTS):
+        """Return the last `limit` lines (oldest first) containing term, case-insensitively."""
+        term = term.lower()
+        matches = deque(maxlen=limit)
+        with self.lock:
+            if self.path is None:
+                return []
+            for path in (self.path + ".1", self.path):
+                try:
+                    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                        for line in f:
+                            if term in line.lower():
+                                matches.append(line)
+                except FileNotFoundError:
+                    continue
+        return list(matches)
 
 class ServerLauncher:
     def __init__(self, root):
         self.root = root
         self.root.title("Outlook Auto Attach Server")
-        self.root.geometry("500x400")
+        self.root.geometry("500x520")
         self.root.resizable(False, False)
         
         self.server_running = False
         self.server_instance = None
         self.server_thread = None
+        self.event_subscription = None
+        self.engine_var = tk.StringVar()
+        self.diagnostics_var = tk.BooleanVar(value=False)
+        self.prewarm_var = tk.BooleanVar(value=False)
+        self.watch_var = tk.BooleanVar(value=False)
+        self.search_var = tk.StringVar()
+        
+        # Activity log: appended to from any thread, drained by flush_log on the Tk thread
+        self.log_buffer = deque(maxlen=LOG_BUFFER_LINES)
+        self.log_sequence = itertools.count(1)
+        self.log_last_drained = 0
+        self.log_widget_lines = 0
+        self.log_history = LogHistory()
+        
+        # Thread running httpd.shutdown(); on_closing waits for it before destroying the window
+        self.stop_thread = None
+        
+        # Set by the event subscription from any thread; flush_log drains on its next tick
+        self.events_pending = threading.Event()
+        
+        # Set while the in-process server's socket is bound; test_connection skips the port probe then
+        self.server_ready = threading.Event()
         
         # Center window
         self.center_window()
@@ -93,15 +183,13 @@ class ServerLauncher:
         # Create UI
         self.create_ui()
         
-        # Check if server is already running
-        self.check_server_status()
-        
-        # Auto-start server if not already running (after a short delay to ensure UI is ready)
-        if not self.server_running:
-            self.root.after(500, self.auto_start_server)
-        
         # Handle window close
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        
+        self.root.after(LOG_TICK_MS, self.flush_log)
+        
+        # Load the server module once the window is showing, then auto-start
+        self.root.after_idle(self.load_server_in_background)
     
     def center_window(self):
         """Center the window on screen."""
@@ -139,11 +227,51 @@ class ServerLauncher:
         
         self.port_label = ttk.Label(
             status_frame,
-            text=f"Port: {PORT}",
+            text="Port: -",
             font=("Helvetica", 10)
         )
         self.port_label.grid(row=1, column=0, sticky=tk.W, pady=(5, 0))
         
+        engine_frame = ttk.Frame(status_frame)
+        engine_frame.grid(row=1, column=1, sticky=tk.E, padx=(20, 0), pady=(5, 0))
+        ttk.Label(engine_frame, text="Engine:", font=("Helvetica", 10)).grid(row=0, column=0)
+        self.engine_combo = ttk.Combobox(
+            engine_frame,
+            textvariable=self.engine_var,
+            values=(),
+            state=tk.DISABLED,
+            width=9
+        )
+        self.engine_combo.grid(row=0, column=1, padx=(5, 0))
+        
+        self.last_attach_label = ttk.Label(
+            status_frame,
+            text="Last attach: -",
+            font=("Helvetica", 10)
+        )
+        self.last_attach_label.grid(row=2, column=0, columnspan=2, sticky=tk.W, pady=(5, 0))
+        
+        self.diagnostics_check = ttk.Checkbutton(
+            status_frame,
+            text="Trace and profile requests",
+            variable=self.diagnostics_var
+        )
+        self.diagnostics_check.grid(row=3, column=0, columnspan=2, sticky=tk.W, pady=(5, 0))
+        
+        self.prewarm_check = ttk.Checkbutton(
+            status_frame,
+            text="Pre-warm Outlook when the server starts",
+            variable=self.prewarm_var
+        )
+        self.prewarm_check.grid(row=4, column=0, columnspan=2, sticky=tk.W, pady=(5, 0))
+        
+        self.watch_check = ttk.Checkbutton(
+            status_frame,
+            text="Attach matching files from Downloads (without Chrome)",
+            variable=self.watch_var
+        )
+        self.watch_check.grid(row=5, column=0, columnspan=2, sticky=tk.W, pady=(5, 0))
+        
         # Button frame
         button_frame = ttk.Frame(main_frame)
         button_frame.grid(row=2, column=0, columnspan=2, pady=(0, 10))
@@ -152,6 +280,7 @@ class ServerLauncher:
             button_frame,
             text="Start Server",
             command=self.start_server,
+            state=tk.DISABLED,
             width=15
         )
         self.start_button.grid(row=0, column=0, padx=5)
@@ -187,6 +316,18 @@ class ServerLauncher:
         )
         self.log_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         
+        search_frame = ttk.Frame(log_frame)
+        search_frame.grid(row=1, column=0, sticky=(tk.W, tk.E), pady=(5, 0))
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
+        search_entry.grid(row=0, column=0, sticky=(tk.W, tk.E))
+        search_entry.bind('<Return>', lambda event: self.search_history())
+        ttk.Button(
+            search_frame,
+            text="Search History",
+            command=self.search_history
+        ).grid(row=0, column=1, padx=(5, 0))
+        search_frame.columnconfigure(0, weight=1)
+        
         # Info label
         info_label = ttk.Label(
             main_frame,
@@ -205,39 +346,152 @@ class ServerLauncher:
         self.root.rowconfigure(0, weight=1)
     
     def log(self, message):
-        """Add a message to the log."""
+        """Add a message to the log (safe from any thread; shown on the next tick)."""
         timestamp = datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] {message}\n"
+        self.log_buffer.append((next(self.log_sequence), f"[{timestamp}] {message}\n"))
+    
+    def flush_log(self):
+        """Move buffered messages into the log widget and history (runs on the Tk thread)."""
+        entries = []
+        while True:
+            try:
+                entries.append(self.log_buffer.popleft())
+            except IndexError:
+                break
+        
+        if entries:
+            # The ring buffer drops the oldest messages when the GUI falls behind
+            dropped = entries[0][0] - self.log_last_drained - 1
+            self.log_last_drained = entries[-1][0]
+            lines = [entry for _, entry in entries]
+            if dropped > 0:
+                lines.insert(0, f"... {dropped} log messages dropped\n")
+            text = "".join(lines)
+            self.log_history.append(text)
+            self.update_log_ui(text, text.count("\n"))
+        
+        if self.events_pending.is_set():
+            self.events_pending.clear()
+            self.drain_events()
         
-        # Update UI (thread-safe)
-        self.root.after(0, self.update_log_ui, log_entry)
+        self.root.after(LOG_TICK_MS, self.flush_log)
     
-    def update_log_ui(self, message):
-        """Update the log UI (must be called from main thread)."""
+    def update_log_ui(self, text, line_count):
+        """Append a batch of lines to the log widget (must be called from main thread)."""
         self.log_text.config(state=tk.NORMAL)
-        self.log_text.insert(tk.END, message)
+        self.log_text.insert(tk.END, text)
+        self.log_widget_lines += line_count
+        
+        # Trim in blocks so the widget is not edited on every message
+        if self.log_widget_lines > LOG_WIDGET_LINES:
+            excess = self.log_widget_lines - LOG_WIDGET_LINES + LOG_TRIM_LINES
+            self.log_text.delete('1.0', f'{excess + 1}.0')
+            self.log_widget_lines -= excess
+        
         self.log_text.see(tk.END)
         self.log_text.config(state=tk.DISABLED)
+    
+    def search_history(self):
+        """Search the activity history file and show the matches in a separate window."""
+        term = self.search_var.get().strip()
+        if not term:
+            return
+        
+        def search():
+            matches = self.log_history.search(term)
+            self.root.after(0, self.show_search_results, term, matches)
         
-        # Keep only last 100 lines
-        line_count = int(self.log_text.index('end-1c').split('.')[0])
-        if line_count > 100:
-            self.log_text.config(state=tk.NORMAL)
-            self.log_text.delete('1.0', '2.0')
-            self.log_text.config(state=tk.DISABLED)
-    
-    def check_server_status(self):
-        """Check if server is already running on the port."""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        result = sock.connect_ex(('localhost', PORT))
-        sock.close()
-        
-        if result == 0:
-            self.log("Server appears to be running already (port in use)")
-            self.server_running = True
-            self.update_ui()
+        threading.Thread(target=search, daemon=True).start()
+    
+    def show_search_results(self, term, matches):
+        """Show search matches (must be called from main thread)."""
+        window = tk.Toplevel(self.root)
+        window.title(f"Activity history: {term}")
+        window.geometry("600x400")
+        results = scrolledtext.ScrolledText(window, font=("Courier", 9), wrap=tk.WORD)
+        results.pack(fill=tk.BOTH, expand=True)
+        if matches:
+            results.insert(tk.END, "".join(matches))
+            results.see(tk.END)
         else:
-            self.log("Server is stopped")
+            results.insert(tk.END, f"No log lines contain \"{term}\"\n")
+        results.config(state=tk.DISABLED)
+    
+    def configure_diagnostics(self):
+        """Turn request tracing and profiling on or off from the checkbox."""
+        if self.diagnostics_var.get():
+            diagnostics_dir = server_module.get_diagnostics_dir()
+            server_module.configure_diagnostics(
+                trace_file=os.path.join(diagnostics_dir, "trace.jsonl"),
+                profile_dir=os.path.join(diagnostics_dir, "profiles"),
+                log=self.log
+            )
+            self.log(f"Tracing and profiling requests to {diagnostics_dir}")
+        else:
+            server_module.configure_diagnostics()
+    
+    def subscribe_events(self):
+        """Follow job events from the in-process server to show the last attach."""
+        self.unsubscribe_events()
+        self.event_subscription = server_module.get_event_bus().subscribe(
+            max_events=32,
+            wakeup=self.events_pending.set
+        )
+    
+    def unsubscribe_events(self):
+        """Stop following job events."""
+        if self.event_subscription is not None:
+            self.event_subscription.close()
+            self.event_subscription = None
+    
+    def drain_events(self):
+        """Show finished jobs from the event subscription (must be called from main thread)."""
+        subscription = self.event_subscription
+        if subscription is None:
+            return
+        for event in subscription.drain():
+            if event['event'] not in ('done', 'failed'):
+                continue
+            total_ms = event['timings'].get('total', 0) * 1000
+            automation_ms = event['timings'].get('automation', 0) * 1000
+            outcome = "OK" if event['event'] == 'done' else "failed"
+            self.last_attach_label.config(
+                text=f"Last attach: {outcome}, {total_ms:.0f} ms (Outlook {automation_ms:.0f} ms)"
+            )
+    
+    def load_server_in_background(self):
+        """Load the server module off the Tk thread, then auto-start the server."""
+        self.log(f"Window shown {(time.perf_counter() - LAUNCH_TIME) * 1000:.0f} ms after launch")
+        
+        def load():
+            start = time.perf_counter()
+            try:
+                module = load_server_module()
+            except Exception as e:
+                import traceback
+                print(f"Failed to load server module: {e}\n{traceback.format_exc()}", file=sys.stderr)
+                self.root.after(0, self.server_module_failed, e)
+                return
+            self.root.after(0, self.server_module_loaded, module, time.perf_counter() - start)
+        
+        threading.Thread(target=load, daemon=True).start()
+    
+    def server_module_loaded(self, module, seconds):
+        """Fill in the server settings and auto-start (must be called from main thread)."""
+        self.log(f"Server module loaded in {seconds * 1000:.0f} ms")
+        self.log_history.open(os.path.join(module.get_diagnostics_dir(), "activity.log"))
+        self.port_label.config(text=f"Port: {module.PORT}")
+        self.engine_combo.config(values=module.ENGINES)
+        self.engine_var.set(module.ENGINE)
+        self.prewarm_var.set(module.PREWARM)
+        self.watch_var.set(bool(module.WATCH_DIRS))
+        self.update_ui()
+        self.auto_start_server()
+    
+    def server_module_failed(self, error):
+        """Report a server module that could not be loaded (must be called from main thread)."""
+        self.log(f"Failed to load server module: {error}")
+        messagebox.showerror("Error", f"Failed to start application:\n{error}")
     
     def auto_start_server(self):
         """Automatically start the server when app launches."""
@@ -250,37 +504,39 @@ class ServerLauncher:
         if self.server_running:
             self.log("Server is already running!")
             return
+        if server_module is None:
+            self.log("Server module is still loading...")
+            return
+        
+        engine = self.engine_var.get()
+        port = server_module.PORT
+        self.configure_diagnostics()
+        prewarm = self.prewarm_var.get()
+        watch = (server_module.WATCH_DIRS or [server_module.default_downloads_dir()]) if self.watch_var.get() else []
+        self.server_ready.clear()
         
         def run_server():
             try:
-                # Bind to localhost only (127.0.0.1) for security and to avoid firewall issues
-                server_address = ('127.0.0.1', PORT)
-                httpd = http.server.HTTPServer(server_address, GUIAttachHandler)
+                # Bind to localhost only (127.0.0.1) for security and to avoid firewall issues.
+                # create_server binds and listens, so connections queue from here on.
+                server_address = ('127.0.0.1', port)
+                httpd = server_module.create_server(server_address, GUIAttachHandler, engine=engine)
                 httpd.log_callback = self.log
                 self.server_instance = httpd
+                self.server_ready.set()
+                startup_ms = (time.perf_counter() - LAUNCH_TIME) * 1000
+                self.log(f"✅ Server is listening on 127.0.0.1:{port} ({engine} engine, "
+                         f"{httpd.max_workers} workers), {startup_ms:.0f} ms after launch")
+                self.root.after(0, self.server_started_ui)
                 
-                self.root.after(0, self.log, f"Starting server on 127.0.0.1:{PORT}...")
-                # Give server a moment to actually start
-                import time
-                time.sleep(0.2)
-                
-                # Test that server is actually listening
-                test_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                test_result = test_sock.connect_ex(('127.0.0.1', PORT))
-                test_sock.close()
-                
-                if test_result == 0:
-                    self.root.after(0, self.log, f"✅ Server is running and listening on 127.0.0.1:{PORT}")
-                    self.root.after(0, self.server_started_ui)
-                else:
-                    self.root.after(0, self.log, f"⚠️ Warning: Server may not be listening properly")
-                    self.root.after(0, self.server_started_ui)
-                
+                server_module.start_background_tasks(self.log, prewarm=prewarm, watch=watch)
+                self.subscribe_events()
                 httpd.serve_forever()
             except OSError as e:
-                if "Address already in use" in str(e):
-                    self.root.after(0, self.log, f"Error: Port {PORT} is already in use!")
-                    self.root.after(0, self.server_stopped_ui)
+                if e.errno in (errno.EADDRINUSE, 10048) or "Address already in use" in str(e):
+                    # Another copy of the server already owns the port
+                    self.root.after(0, self.log, f"Port {port} is already in use - the server appears to be running already")
+                    self.root.after(0, self.server_external_ui)
                 else:
                     self.root.after(0, self.log, f"Error starting server: {e}")
                     self.root.after(0, self.server_stopped_ui)
@@ -299,20 +555,35 @@ class ServerLauncher:
         self.log("Ready to receive file attachments from Chrome extension")
     
     def stop_server(self):
-        """Stop the server."""
+        """Stop the server (shutdown waits for serve_forever, so it runs off the Tk thread)."""
         if not self.server_running or not self.server_instance:
             self.log("Server is not running!")
             return
         
-        try:
-            self.log("Stopping server...")
-            self.server_instance.shutdown()
-            self.server_instance = None
-            self.server_running = False
-            self.update_ui()
-            self.log("Server stopped")
-        except Exception as e:
-            self.log(f"Error stopping server: {e}")
+        self.log("Stopping server...")
+        httpd = self.server_instance
+        self.server_instance = None
+        self.stop_button.config(state=tk.DISABLED)
+        self.unsubscribe_events()
+        
+        def stop():
+            self.server_ready.clear()
+            try:
+                httpd.shutdown()
+                httpd.server_close()
+                server_module.stop_background_tasks()
+                self.log("Server stopped")
+            except Exception as e:
+                self.log(f"Error stopping server: {e}")
+            self.root.after(0, self.server_stopped_ui)
+        
+        self.stop_thread = threading.Thread(target=stop, daemon=True)
+        self.stop_thread.start()
+    
+    def server_external_ui(self):
+        """Show a server started elsewhere as running (must be called from main thread)."""
+        self.server_running = True
+        self.update_ui()
     
     def server_stopped_ui(self):
         """Update UI when server stops."""
@@ -325,16 +596,22 @@ class ServerLauncher:
         
         def test():
             try:
-                # Try to connect to the server
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(2)
-                result = sock.connect_ex(('127.0.0.1', PORT))
-                sock.close()
+                port = load_server_module().PORT
+
+                if self.server_ready.is_set():
+                    # Our own server has bound the port; go straight to the HTTP check
+                    result = 0
+                else:
+                    # Another process may own the port; try to connect to it
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.settimeout(2)
+                    result = sock.connect_ex(('127.0.0.1', port))
+                    sock.close()
                 
                 if result == 0:
                     # Try HTTP request
                     try:
-                        response = urllib.request.urlopen(f'http://127.0.0.1:{PORT}/status', timeout=2)
+                        response = urllib.request.urlopen(f'http://127.0.0.1:{port}/status', timeout=2)
                         status = response.read().decode('utf-8')
                         self.root.after(0, self.log, f"Connection test successful! Server responded: {status}")
                         self.root.after(0, lambda: messagebox.showinfo("Test Result", "✅ Connection successful!\n\nThe server is running and accessible."))
@@ -342,7 +619,7 @@ class ServerLauncher:
                         self.root.after(0, self.log, f"Server is listening but not responding: {e}")
                         self.root.after(0, lambda: messagebox.showwarning("Test Result", f"⚠️ Server is listening but not responding correctly:\n{e}"))
                 else:
-                    self.root.after(0, self.log, f"Connection test failed: Cannot connect to 127.0.0.1:{PORT}")
+                    self.root.after(0, self.log, f"Connection test failed: Cannot connect to 127.0.0.1:{port}")
                     error_msg = (
                         "Cannot connect to server!\n\n"
                         "Possible causes:\n"
@@ -367,17 +644,31 @@ class ServerLauncher:
             self.status_label.config(text="Status: Running", foreground="green")
             self.start_button.config(state=tk.DISABLED)
             self.stop_button.config(state=tk.NORMAL)
+            self.engine_combo.config(state=tk.DISABLED)
+            self.diagnostics_check.config(state=tk.DISABLED)
+            self.prewarm_check.config(state=tk.DISABLED)
+            self.watch_check.config(state=tk.DISABLED)
         else:
             self.status_label.config(text="Status: Stopped", foreground="red")
             self.start_button.config(state=tk.NORMAL)
             self.stop_button.config(state=tk.DISABLED)
+            self.engine_combo.config(state="readonly")
+            self.diagnostics_check.config(state=tk.NORMAL)
+            self.prewarm_check.config(state=tk.NORMAL)
+            self.watch_check.config(state=tk.NORMAL)
     
     def on_closing(self):
         """Handle window closing."""
         if self.server_running:
             self.stop_server()
-            # Wait a bit for server to stop
-            self.root.after(100, self.root.destroy)
+            self.root.after(100, self.destroy_when_stopped)
+        else:
+            self.root.destroy()
+    
+    def destroy_when_stopped(self):
+        """Close the window once the stop thread has finished."""
+        if self.stop_thread is not None and self.stop_thread.is_alive():
+            self.root.after(100, self.destroy_when_stopped)
         else:
             self.root.destroy()
 
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Outlook Auto Attach Native Messaging Host
+Lets the Chrome extension attach files without going through localhost HTTP:
+Chrome starts this host and exchanges messages with it over stdin/stdout
+(each a 32-bit native-endian length followed by UTF-8 JSON). Requests run
+through the same routes and attach pipeline as AttachHandler.
+
+Request:  {"id": 1, "method": "POST", "path": "/attach", "body": {"filePath": "..."}}
+Reply:    {"id": 1, "status": 200, "body": {"success": true, ...}}
+
+GET paths (/status, /rules, /jobs/<id>) are answered the same way; a body
+that is not JSON comes back as {"text": "..."}. Requests are handled
+concurrently, so replies can arrive out of order and are matched by id.
+
+The host runs the pipeline itself; Outlook automation and the document
+store manifest are guarded by file locks shared with a running server.
+With OUTLOOK_ATTACH_NATIVE_FORWARD=1 it instead forwards requests to the
+server on localhost, once /status shows the listener is that server.
+
+Install (registers the host for one extension ID with Chrome for this user):
+    python3 outlook-attach-native-host.py --install --extension-id <id>
+"""
+
+import argparse
+import http.client
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HOST_NAME = 'com.outlookattach.host'
+
+# Chrome refuses messages from a host larger than this
+MAX_REPLY_BYTES = 1024 * 1024
+
+# Requests handled at once; attaches still serialize on the Outlook lock
+HOST_WORKERS = int(os.environ.get('OUTLOOK_ATTACH_NATIVE_WORKERS', '4'))
+
+# Forward requests to our server when it is listening on localhost ('1'),
+# waiting this many seconds for a reply (an attach waits for Outlook)
+FORWARD_TO_SERVER = os.environ.get('OUTLOOK_ATTACH_NATIVE_FORWARD', '0') == '1'
+FORWARD_TIMEOUT = float(os.environ.get('OUTLOOK_ATTACH_NATIVE_FORWARD_TIMEOUT', '300'))
+
+
+def load_server_module():
+    """Load outlook-attach-server.py from next to this file."""
+    import importlib.util
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    spec = importlib.util.spec_from_file_location(
+        "outlook_attach_server",
+        os.path.join(base_path, "outlook-attach-server.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_message(stream):
+    """Read one message from stream; returns None at end of input."""
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    length, = struct.unpack('=I', header)
+    return json.loads(stream.read(length).decode('utf-8'))
+
+
+def write_message(stream, message):
+    """Write one message to stream."""
+    payload = json.dumps(message, ensure_ascii=False).encode('utf-8')
+    stream.write(struct.pack('=I', len(payload)) + payload)
+    stream.flush()
+
+
+def decode_payload(headers, payload):
+    """Turn a route payload back into JSON for the reply."""
+    content_type = dict(headers).get('Content-Type', '')
+    if content_type.startswith('application/json'):
+        return json.loads(payload.decode('utf-8'))
+    return {'text': payload.decode('utf-8', 'replace')}
+
+
+class NativeHost:
+    """Reads requests from Chrome, runs them on a thread pool and writes replies."""
+
+    def __init__(self, server_module, stdin, stdout, workers=HOST_WORKERS):
+        self.server_module = server_module
+        self.stdin = stdin
+        self.stdout = stdout
+        self._write_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='attach-native')
+
+    def run(self):
+        """Serve until Chrome closes the port (end of stdin)."""
+        try:
+            while True:
+                message = read_message(self.stdin)
+                if message is None:
+                    break
+                self._pool.submit(self.handle, message)
+        finally:
+            self._pool.shutdown(wait=True)
+            self.server_module.flush_document_stores()
+
+    def handle(self, message):
+        """Answer one request; errors become a 500 reply instead of ending the host."""
+        server = self.server_module
+        trace = None
+        try:
+            status_code, body, trace = self.dispatch(message.get('method', 'POST'), message.get('path', ''),
+                                                     message.get('body'))
+        except Exception as e:
+            status_code, body = 500, server.error_response_data(f"Error: {e}")
+        reply = {'id': message.get('id'), 'status': status_code, 'body': body}
+        if len(json.dumps(reply, ensure_ascii=False).encode('utf-8')) > MAX_REPLY_BYTES:
+            reply.update(status=500, body=server.error_response_data("Reply too large for native messaging"))
+        write_start = time.perf_counter()
+        with self._write_lock:
+            write_message(self.stdout, reply)
+        if trace is not None:
+            server.finish_attach_response(trace, status_code, write_start)
+
+    def dispatch(self, method, path, body):
+        """
+        Forward a request to the running server, or route it here like the
+        HTTP engines do when none is listening.
+        Returns (status_code, body, trace); trace is only set for attach routes run here.
+        """
+        server = self.server_module
+        forwarded = self.forward(method, path, body) if FORWARD_TO_SERVER else None
+        if forwarded is not None:
+            return forwarded + (None,)
+        if method == 'GET':
+            status_code, headers, payload = server.process_get_request(path, 'application/json')
+            return status_code, decode_payload(headers, payload) if payload else None, None
+        if method == 'DELETE':
+            status_code, headers, payload = server.process_delete_request(path)
+            return status_code, decode_payload(headers, payload) if payload else None, None
+        process_request = server.ATTACH_ROUTES.get(path)
+        if method != 'POST' or process_request is None:
+            return 404, server.error_response_data(f"No route for {method} {path}"), None
+
+        status_code, response_data, log_entry, trace = server.run_attach_route(
+            path, process_request, json.dumps(body or {}).encode('utf-8')
+        )
+        if log_entry:
+            server.log_to_stderr(log_entry)
+        return status_code, response_data, trace
+
+
+    def forward(self, method, path, body):
+        """
+        Send a request to the server on localhost. Returns (status_code, body),
+        or None when the request was not sent: nothing is listening, or the
+        listener does not answer /status like our server. Errors after that
+        are raised rather than retried here, since the server may already
+        have attached the file.
+        """
+        connection = http.client.HTTPConnection('127.0.0.1', self.server_module.PORT, timeout=FORWARD_TIMEOUT)
+        try:
+            try:
+                connection.connect()
+                connection.request('GET', '/status', headers={'Accept': 'application/json'})
+                response = connection.getresponse()
+                status = json.loads(response.read().decode('utf-8'))
+            except (OSError, http.client.HTTPException, ValueError):
+                return None
+            # File paths only go to a process that is our server
+            ours = isinstance(status, dict) and status.get('status') == 'running' and 'outlook' in status
+            if response.status != 200 or not ours:
+                return None
+            payload = json.dumps(body or {}).encode('utf-8') if method == 'POST' else None
+            connection.request(method, path, body=payload, headers={
+                'Content-Type': 'application/json',
+                'Accept': 'application/json',
+            })
+            response = connection.getresponse()
+            data = response.read()
+            return response.status, decode_payload(response.getheaders(), data) if data else None
+        finally:
+            connection.close()
+
+
+def native_hosts_dir():
+    """Return Chrome's per-user NativeMessagingHosts folder (macOS and Linux)."""
+    if sys.platform == 'darwin':
+        return os.path.expanduser('~/Library/Application Support/Google/Chrome/NativeMessagingHosts')
+    return os.path.expanduser('~/.config/google-chrome/NativeMessagingHosts')
+
+
+def install(extension_id):
+    """
+    Write a launcher script and host manifest under ~/.outlook-attach and
+    register the manifest with Chrome (a manifest copy on macOS/Linux, a
+    registry key on Windows).
+    """
+    host_dir = os.path.join(os.path.expanduser("~"), ".outlook-attach", "native-host")
+    os.makedirs(host_dir, exist_ok=True)
+    script = os.path.abspath(__file__)
+
+    # Chrome runs the manifest's path directly, so pin this interpreter
+    if sys.platform == 'win32':
+        launcher = os.path.join(host_dir, 'outlook-attach-native-host.bat')
+        with open(launcher, 'w') as f:
+            f.write(f'@echo off\r\n"{sys.executable}" "{script}" %*\r\n')
+    else:
+        launcher = os.path.join(host_dir, 'outlook-attach-native-host.sh')
+        with open(launcher, 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "{script}" "$@"\n')
+        os.chmod(launcher, 0o755)
+
+    manifest = {
+        'name': HOST_NAME,
+        'description': 'Outlook Auto Attach',
+        'path': launcher,
+        'type': 'stdio',
+        'allowed_origins': [f'chrome-extension://{extension_id}/'],
+    }
+    manifest_path = os.path.join(host_dir, f'{HOST_NAME}.json')
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if sys.platform == 'win32':
+        import winreg
+        key_path = rf'Software\Google\Chrome\NativeMessagingHosts\{HOST_NAME}'
+        with winreg.CreateKey(winreg.HKEY_CURRENT_USER, key_path) as key:
+            winreg.SetValueEx(key, '', 0, winreg.REG_SZ, manifest_path)
+        print(f"Registered {manifest_path} under HKEY_CURRENT_USER\\{key_path}")
+    else:
+        hosts_dir = native_hosts_dir()
+        os.makedirs(hosts_dir, exist_ok=True)
+        with open(os.path.join(hosts_dir, f'{HOST_NAME}.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        print(f"Installed {HOST_NAME} in {hosts_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Outlook Auto Attach native messaging host")
+    parser.add_argument('--install', action='store_true', help="register the host with Chrome for this user")
+    parser.add_argument('--extension-id', help="extension allowed to connect (with --install)")
+    # Chrome passes the caller's origin (and on Windows a window handle)
+    args, _ = parser.parse_known_args()
+
+    if args.install:
+        if not args.extension_id:
+            parser.error("--install needs --extension-id")
+        install(args.extension_id)
+        return 0
+
+    # stdout carries the protocol: keep it for messages and point fd 1 at
+    # stderr, so prints and child processes (osascript) cannot corrupt it
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    server_module = load_server_module()
+    NativeHost(server_module, sys.stdin.buffer, protocol_out).run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
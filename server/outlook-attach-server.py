@@ -5,64 +5,425 @@ Receives file paths from Chrome extension and opens Outlook with file attached.
 Supports both macOS (AppleScript) and Windows (COM automation).
 """
 
+import argparse
+import bisect
+import heapq
+import errno
+import hashlib
+import http
 import http.server
+import itertools
 import json
 import sys
 import os
 import subprocess
 import platform
+import queue
+import random
 import shutil
 import tempfile
 import re
+import socket
+import stat
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
+from email.utils import formatdate
 
 PORT = 8765
 
+# Number of worker threads serving HTTP requests concurrently
+MAX_WORKERS = int(os.environ.get('OUTLOOK_ATTACH_WORKERS', '8'))
 
-def create_unique_file_copy(original_path):
+# Connections allowed to wait for a free worker before new ones get 503
+MAX_QUEUED_REQUESTS = int(os.environ.get('OUTLOOK_ATTACH_QUEUE', '32'))
+
+# Server engines: 'threaded' (HTTP/1.0, one connection per request) or
+# 'asyncio' (persistent HTTP/1.1 connections)
+ENGINES = ('threaded', 'asyncio')
+ENGINE = os.environ.get('OUTLOOK_ATTACH_ENGINE', 'threaded')
+
+STATUS_TEXT = b'Outlook Auto Attach Server is running'
+
+# Outlook automation is not safe to drive from several threads at once, nor
+# from the server and the native messaging host at once: OUTLOOK_LOCK (an
+# InterProcessLock) also holds an advisory lock on this file
+OUTLOOK_LOCK_FILE = os.environ.get(
+    'OUTLOOK_ATTACH_LOCK_FILE',
+    os.path.join(os.path.expanduser("~"), ".outlook-attach", "outlook.lock")
+)
+
+# Automation backend: 'outlook' drives Outlook on macOS and Windows;
+# 'simulated' stands in for it anywhere (e.g. Linux build agents), taking
+# SIMULATED_LATENCY ± SIMULATED_JITTER seconds per attach and failing at
+# SIMULATED_FAILURE_RATE
+BACKENDS = ('outlook', 'simulated')
+BACKEND = os.environ.get('OUTLOOK_ATTACH_BACKEND', 'outlook')
+SIMULATED_LATENCY = float(os.environ.get('OUTLOOK_ATTACH_SIMULATED_LATENCY', '0.5'))
+SIMULATED_JITTER = float(os.environ.get('OUTLOOK_ATTACH_SIMULATED_JITTER', '0.2'))
+SIMULATED_FAILURE_RATE = float(os.environ.get('OUTLOOK_ATTACH_SIMULATED_FAILURE_RATE', '0'))
+
+_simulated_outlook = None
+
+# Files copied in parallel for a /attach/batch request, and the batch size limit
+COPY_WORKERS = int(os.environ.get('OUTLOOK_ATTACH_COPY_WORKERS', '4'))
+MAX_BATCH_FILES = int(os.environ.get('OUTLOOK_ATTACH_MAX_BATCH', '50'))
+
+_copy_pool = None
+_copy_pool_lock = threading.Lock()
+
+# /attach/batch zips the files into one attachment once they total at least
+# BUNDLE_MIN_BYTES or number at least BUNDLE_MIN_FILES (0 turns a trigger
+# off); a request can also ask for it with "bundle": true or false. Files are
+# deflated in parallel on BUNDLE_WORKERS threads (zlib releases the GIL)
+BUNDLE_MIN_BYTES = int(float(os.environ.get('OUTLOOK_ATTACH_BUNDLE_MIN_MB', '10')) * 1024 * 1024)
+BUNDLE_MIN_FILES = int(os.environ.get('OUTLOOK_ATTACH_BUNDLE_MIN_FILES', '10'))
+BUNDLE_WORKERS = int(os.environ.get('OUTLOOK_ATTACH_BUNDLE_WORKERS', str(os.cpu_count() or 2)))
+BUNDLE_LEVEL = int(os.environ.get('OUTLOOK_ATTACH_BUNDLE_LEVEL', '6'))
+
+_bundle_pool = None
+_bundle_pool_lock = threading.Lock()
+
+# /attach/upload: bodies are streamed to disk UPLOAD_CHUNK_SIZE bytes at a
+# time, and uploads larger than UPLOAD_MAX_BYTES are refused with 413
+UPLOAD_MAX_BYTES = int(float(os.environ.get('OUTLOOK_ATTACH_UPLOAD_MAX_MB', '100')) * 1024 * 1024)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Seconds an attach waits for the Windows COM worker before giving up
+COM_JOB_TIMEOUT = float(os.environ.get('OUTLOOK_ATTACH_COM_TIMEOUT', '30'))
+
+_com_worker = None
+_com_worker_lock = threading.Lock()
+
+# Set OUTLOOK_ATTACH_APPLESCRIPT_RUNNER=0 to spawn osascript for every attach
+APPLESCRIPT_RUNNER_ENABLED = os.environ.get('OUTLOOK_ATTACH_APPLESCRIPT_RUNNER', '1') != '0'
+
+_applescript_runner = None
+_applescript_runner_lock = threading.Lock()
+
+# Pre-warming (OUTLOOK_ATTACH_PREWARM=1 or --prewarm): at startup, launch
+# Outlook without bringing it forward and make a no-op call, so the first
+# attach does not pay Outlook's cold start. Every PREWARM_INTERVAL seconds the
+# server checks that Outlook is still running and warms it again after a
+# restart (it does not relaunch an Outlook the user quit). A warm-up may take
+# PREWARM_TIMEOUT seconds, longer than an attach is allowed to
+PREWARM = os.environ.get('OUTLOOK_ATTACH_PREWARM', '0') == '1'
+PREWARM_INTERVAL = float(os.environ.get('OUTLOOK_ATTACH_PREWARM_INTERVAL', '60'))
+PREWARM_TIMEOUT = float(os.environ.get('OUTLOOK_ATTACH_PREWARM_TIMEOUT', '60'))
+
+_prewarmer = None
+_prewarmer_lock = threading.Lock()
+
+# Download folders the server watches itself (separated by os.pathsep): new
+# files a document rule matches are attached without the extension's round
+# trip. WATCH_BACKEND picks 'inotify', 'kqueue', 'windows' or 'poll' instead
+# of the best one available
+WATCH_DIRS = [d for d in os.environ.get('OUTLOOK_ATTACH_WATCH_DIRS', '').split(os.pathsep) if d]
+WATCH_BACKEND = os.environ.get('OUTLOOK_ATTACH_WATCH_BACKEND', 'auto')
+# A watched download is remembered this long, so the extension's confirm of
+# the same file (often minutes later) is answered as a duplicate
+WATCH_DUPLICATE_WINDOW = float(os.environ.get('OUTLOOK_ATTACH_WATCH_DUPLICATE_WINDOW', '600'))
+
+# Names browsers give downloads in progress; the finished file is renamed
+WATCH_IGNORED_SUFFIXES = ('.crdownload', '.part', '.partial', '.download', '.tmp')
+
+_downloads_watcher = None
+
+# Document classification rules; edits to the file are picked up while running
+DOCUMENT_RULES_FILE = os.environ.get(
+    'OUTLOOK_ATTACH_RULES',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'document-rules.json')
+)
+
+DEFAULT_NAME_TEMPLATE = '{type}-{timestamp}-{microseconds}{ext}'
+
+# Used when no rules file is present; mirrors document-rules.json
+DEFAULT_DOCUMENT_RULES = {
+    'default': {'type': 'Orderbekräftelse'},
+    'rules': [
+        {'type': 'Faktura', 'pattern': r'\d{7}'},
+        {'type': 'Order', 'pattern': 'inköp|inkop', 'flags': 'i'},
+        {'type': 'Orderbekräftelse', 'pattern': 'orderbekräftelse|orderbekr', 'flags': 'i'},
+    ],
+}
+
+_document_rules = None
+_document_rules_lock = threading.Lock()
+
+# Keep one content-addressed blob per unique document in businessnxtdocs and
+# hardlink the named copies to it (OUTLOOK_ATTACH_DEDUP=0 makes full copies)
+DEDUP_ENABLED = os.environ.get('OUTLOOK_ATTACH_DEDUP', '1') != '0'
+
+_document_stores = {}
+_document_stores_lock = threading.Lock()
+
+# businessnxtdocs retention: days a copy is kept, total size cap and how
+# often the sweeper runs (0 disables the respective limit)
+RETENTION_MAX_AGE_DAYS = float(os.environ.get('OUTLOOK_ATTACH_RETENTION_DAYS', '90'))
+RETENTION_MAX_BYTES = int(float(os.environ.get('OUTLOOK_ATTACH_RETENTION_MAX_MB', '2048')) * 1024 * 1024)
+RETENTION_SWEEP_INTERVAL = float(os.environ.get('OUTLOOK_ATTACH_SWEEP_INTERVAL', '3600'))
+
+_retention_sweeper = None
+
+# Copy strategies tried in order, cheapest first (see clone_file)
+COPY_STRATEGY_ORDER = os.environ.get(
+    'OUTLOOK_ATTACH_COPY_STRATEGIES', 'hardlink,reflink,kernel,bytes'
+).split(',')
+# Copies of the user's own files must not share their inode: a hardlink would
+# let later edits to the download change the attachment, so those skip it
+INDEPENDENT_COPY_STRATEGIES = [name for name in COPY_STRATEGY_ORDER if name != 'hardlink'] or ['bytes']
+
+# ioctl request number for FICLONE (_IOW(0x94, 9, int)) on Linux
+FICLONE = 0x40049409
+
+_libc = None
+
+
+def get_businessnxtdocs_dir():
+    """Return the folder the renamed attachment copies are written to."""
+    home_dir = os.path.expanduser("~")
+    desktop_dir = os.path.join(home_dir, "Desktop")
+    return os.path.join(desktop_dir, "businessnxtdocs")
+
+
+def unique_document_name(base_name, file_extension, template=DEFAULT_NAME_TEMPLATE, match=''):
+    """
+    Build a file name from a rule template and the current time.
+    Templates can use {type}, {timestamp}, {microseconds}, {ext} and {match}
+    (the text the rule matched, e.g. the invoice number).
+    """
+    now = datetime.now()
+    return template.format(
+        type=base_name,
+        timestamp=now.strftime("%Y%m%d-%H%M%S"),
+        microseconds=now.strftime("%f"),
+        ext=file_extension,
+        match=match
+    )
+
+
+Classification = namedtuple('Classification', 'document_type template match rule')
+
+# Non-ASCII characters that case-insensitive re patterns match to ASCII letters
+ASCII_CASE_EQUIVALENTS = frozenset('\u0130\u0131\u017f\u212a')
+
+
+def literal_needles(pattern, ignore_case):
+    """
+    For a pattern that is a plain alternation of literals (e.g. 'inköp|inkop'),
+    return the substrings one of which an ASCII name (lowercased when
+    ignore_case) must contain for the pattern to match it. Returns None for
+    any other pattern.
+    """
+    needles = []
+    for alternative in pattern.split('|'):
+        if not alternative or re.escape(alternative) != alternative:
+            return None
+        if alternative.isascii():
+            needles.append(alternative.lower())
+        elif ignore_case and not ASCII_CASE_EQUIVALENTS.isdisjoint(alternative):
+            return None
+        # Any other non-ASCII alternative cannot match an ASCII name
+    return tuple(needles)
+
+
+class DocumentRules:
+    """
+    Document classification rules (pattern → document type → file name
+    template) loaded from a JSON file. All patterns are compiled once and
+    tested in file order; the first hit wins, so every name is scanned once
+    per rule at most. Rules that are plain words skip the regex for ASCII
+    names that contain none of them, like the substring checks they replaced.
+    Names no rule matches get the default type.
+    The file is re-read when its modification time changes (checked at most
+    every reload_interval seconds); an invalid file keeps the previous rules.
+    """
+
+    reload_interval = 1.0
+
+    def __init__(self, path=None, log=None):
+        self.path = path
+        self.log = log
+        self.rules = []
+        self.default = None
+        self._matchers = ((), None)
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._apply(DEFAULT_DOCUMENT_RULES)
+        self.reload_if_changed(force=True)
+
+    def classify(self, file_name):
+        """Return the Classification for a file name."""
+        if self.path and time.monotonic() - self._checked >= self.reload_interval:
+            self.reload_if_changed()
+        matchers, unmatched = self._matchers
+        folded = file_name.lower() if file_name.isascii() else None
+        for search, needles, document_type, template, rule in matchers:
+            if needles is not None and folded is not None:
+                for needle in needles:
+                    if needle in folded:
+                        break
+                else:
+                    continue
+            found = search(file_name)
+            if found is not None:
+                # _make skips the keyword handling of Classification(...), half the cost
+                return Classification._make((document_type, template, found.group(), rule))
+        return unmatched
+
+    def matches(self, file_name):
+        """Return True if any rule (not just the default) matches the name."""
+        return self.classify(file_name).rule is not None
+
+    def describe(self):
+        """Return the rule table as JSON-friendly data for clients such as the extension."""
+        return {
+            'rules': [
+                {'type': r['type'], 'pattern': r['pattern'], 'flags': r['flags'], 'template': r['template']}
+                for r in self.rules
+            ],
+            'default': dict(self.default),
+        }
+
+    def reload_if_changed(self, force=False):
+        """Re-read the rules file if it changed since it was last loaded."""
+        if not self.path:
+            return
+        now = time.monotonic()
+        if not force and now - self._checked < self.reload_interval:
+            return
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                return
+            if mtime == self._mtime:
+                return
+            self._mtime = mtime
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._apply(json.load(f))
+                if self.log is not None and not force:
+                    self.log(f"Reloaded {len(self.rules)} document rules from {self.path}")
+            except (OSError, ValueError, KeyError, IndexError, TypeError, re.error) as e:
+                if self.log is not None:
+                    self.log(f"Ignoring invalid document rules in {self.path}: {e}")
+
+    def _apply(self, config):
+        default = {
+            'type': config['default']['type'],
+            'template': config['default'].get('template', DEFAULT_NAME_TEMPLATE),
+        }
+        rules = []
+        for rule in config['rules']:
+            flags = rule.get('flags', '')
+            if set(flags) - set('i'):
+                raise ValueError(f"Unsupported flags {flags!r} in rule {rule['type']}")
+            regex = re.compile(rule['pattern'], re.IGNORECASE if flags else 0)
+            template = rule.get('template', default['template'])
+            # Fail on unknown placeholders now rather than on the next attach
+            unique_document_name(rule['type'], '.pdf', template)
+            rules.append({
+                'type': rule['type'],
+                'pattern': rule['pattern'],
+                'flags': flags,
+                'template': template,
+                'regex': regex,
+            })
+        unique_document_name(default['type'], '.pdf', default['template'])
+        # classify() only unpacks this, so it always sees one rule set
+        matchers = tuple(
+            (r['regex'].search, literal_needles(r['pattern'], bool(r['flags'])), r['type'], r['template'], r)
+            for r in rules
+        )
+        unmatched = Classification(default['type'], default['template'], '', None)
+        self.rules, self.default, self._matchers = rules, default, (matchers, unmatched)
+
+
+def get_document_rules():
+    """Return the shared DocumentRules loaded from DOCUMENT_RULES_FILE."""
+    global _document_rules
+    with _document_rules_lock:
+        if _document_rules is None:
+            path = DOCUMENT_RULES_FILE if os.path.exists(DOCUMENT_RULES_FILE) else None
+            _document_rules = DocumentRules(path, log=log_to_stderr)
+        return _document_rules
+
+
+def create_unique_file_copy(original_path, copy_info=None, upload=None):
     """
-    Create a unique copy of the file with a clean name format based on file type:
+    Create a unique copy of the file with a clean name format based on file type,
+    as classified by the document rules (document-rules.json), by default:
     - Files with 7-digit numbers → "Faktura-datum-tid.pdf"
     - Files with "Inköp" → "Order-datum-tid.pdf"
-    - Files with "Orderbekräftelse" → "Orderbekräftelse-datum-tid.pdf"
+    - Everything else, e.g. "Orderbekräftelse" → "Orderbekräftelse-datum-tid.pdf"
     Includes microseconds to ensure uniqueness and avoid system-appended numbers.
+    With deduplication enabled the copy is a hardlink to a content-addressed
+    blob, so attaching the same document again costs no copy I/O.
+    If copy_info is a dict it receives the document type, the classification
+    time and the copy strategy, seconds and bytes.
+    For an Upload, original_path is the received file: it is classified by the
+    uploaded name and moved into place instead of copied.
     Returns the path to the unique copy.
     """
     if not os.path.exists(original_path):
         return None, f"File not found: {original_path}"
     
     try:
-        original_name = os.path.basename(original_path)
+        original_name = upload.name if upload is not None else os.path.basename(original_path)
         name_parts = os.path.splitext(original_name)
         file_extension = name_parts[1]
         
-        home_dir = os.path.expanduser("~")
-        desktop_dir = os.path.join(home_dir, "Desktop")
-        businessnxtdocs_dir = os.path.join(desktop_dir, "businessnxtdocs")
+        businessnxtdocs_dir = get_businessnxtdocs_dir()
                 
         os.makedirs(businessnxtdocs_dir, exist_ok=True)
         
-        now = datetime.now()
-        timestamp = now.strftime("%Y%m%d-%H%M%S")
-        microseconds = now.strftime("%f")
+        classify_start = time.perf_counter()
+        classification = get_document_rules().classify(original_name)
+        classify_seconds = time.perf_counter() - classify_start
         
-        original_lower = original_name.lower()
+        def make_name():
+            return unique_document_name(
+                classification.document_type,
+                file_extension,
+                classification.template,
+                classification.match
+            )
         
-        has_7digits = bool(re.search(r'\d{7}', original_name))
-        has_inkop = 'inköp' in original_lower or 'inkop' in original_lower
-        has_orderbekraeftelse = 'orderbekräftelse' in original_lower or 'orderbekr' in original_lower
-                
-        if has_7digits:
-            base_name = "Faktura"
-        elif has_inkop:
-            base_name = "Order"
+        if DEDUP_ENABLED:
+            store = get_document_store(businessnxtdocs_dir)
+            if upload is not None:
+                unique_path, copy_result = store.add(original_path, make_name, digest=upload.sha256, move=True)
+            else:
+                unique_path, copy_result = store.add(original_path, make_name)
         else:
-            base_name = "Orderbekräftelse"
-        
-        unique_name = f"{base_name}-{timestamp}-{microseconds}{file_extension}"
-        unique_path = os.path.join(businessnxtdocs_dir, unique_name)
+            # clone_file creates the name exclusively, so parallel copies in
+            # the same microsecond cannot overwrite each other. An upload is
+            # our own file and is removed afterwards, so it may be hardlinked
+            strategies = COPY_STRATEGY_ORDER if upload is not None else INDEPENDENT_COPY_STRATEGIES
+            while True:
+                unique_name = make_name()
+                unique_path = os.path.join(businessnxtdocs_dir, unique_name)
+                try:
+                    copy_result = clone_file(original_path, unique_path, strategies)
+                    break
+                except FileExistsError:
+                    continue
+            if upload is not None:
+                os.remove(original_path)
         
-        shutil.copy2(original_path, unique_path)
+        if copy_info is not None:
+            copy_info['documentType'] = classification.document_type
+            copy_info['classifySeconds'] = classify_seconds
+            copy_info.update(copy_result._asdict())
         
         return unique_path, None
         
@@ -70,20 +431,728 @@ def create_unique_file_copy(original_path):
         return None, f"Error creating unique copy: {str(e)}"
 
 
+CopyResult = namedtuple('CopyResult', 'strategy seconds bytes')
+
+
+def clone_file(src, dst, strategies=None):
+    """
+    Copy src to a new file dst using the cheapest strategy that works:
+    hardlink, then reflink/clone (FICLONE on Linux, clonefile on APFS), then
+    kernel-side copy (copy_file_range/sendfile), then a plain byte copy.
+    dst is created exclusively; FileExistsError is raised if it exists.
+    strategies limits the order tried (names from COPY_STRATEGIES).
+    Returns a CopyResult with the strategy used, seconds taken and bytes.
+    """
+    start = time.perf_counter()
+    size = os.stat(src).st_size
+    last_error = None
+    for name in strategies or COPY_STRATEGY_ORDER:
+        try:
+            if COPY_STRATEGIES[name](src, dst):
+                return CopyResult(name, time.perf_counter() - start, size)
+        except FileExistsError:
+            raise
+        except OSError as e:
+            last_error = e
+            try:
+                os.remove(dst)
+            except OSError:
+                pass
+    raise last_error or OSError(f"No copy strategy could copy {src}")
+
+
+def copy_by_hardlink(src, dst):
+    """Link dst to src's inode; only possible on the same volume."""
+    if os.stat(src).st_dev != os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+        return False
+    os.link(src, dst)
+    return True
+
+
+def copy_by_reflink(src, dst):
+    """Clone src's blocks copy-on-write: clonefile on macOS, FICLONE on Linux."""
+    system = platform.system()
+    if system == 'Darwin':
+        libc = get_libc()
+        clonefile = getattr(libc, 'clonefile', None) if libc is not None else None
+        if clonefile is None:
+            return False
+        if clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            import ctypes
+            err = ctypes.get_errno()
+            raise FileExistsError(err, os.strerror(err), dst) if err == errno.EEXIST else OSError(err, os.strerror(err), dst)
+        return True
+    if system == 'Linux':
+        import fcntl
+        with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return True
+    return False
+
+
+def copy_in_kernel(src, dst):
+    """Copy without moving bytes through user space: copy_file_range, else sendfile."""
+    copy_range = getattr(os, 'copy_file_range', None)
+    if copy_range is None and platform.system() != 'Linux':
+        # sendfile only accepts a regular file as destination on Linux
+        return False
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            chunk = min(remaining, 1 << 30)
+            if copy_range is not None:
+                sent = copy_range(fsrc.fileno(), fdst.fileno(), chunk)
+            else:
+                sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, chunk)
+            if sent == 0:
+                # The source shrank or the filesystem gave up: fail, so that
+                # clone_file removes the partial dst and tries the next strategy
+                raise OSError(errno.EIO, f"Kernel copy stopped with {remaining} bytes left", dst)
+            offset += sent
+            remaining -= sent
+    shutil.copystat(src, dst)
+    return True
+
+
+def copy_bytes(src, dst):
+    """Stream the bytes through user space, then copy metadata like shutil.copy2."""
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    shutil.copystat(src, dst)
+    return True
+
+
+def get_libc():
+    """Return the C library via ctypes, or None where it cannot be loaded."""
+    global _libc
+    if _libc is None:
+        # Imported here: ctypes is only needed for reflink copies
+        import ctypes
+        import ctypes.util
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except (OSError, TypeError):
+            _libc = False
+    return _libc or None
+
+
+COPY_STRATEGIES = {
+    'hardlink': copy_by_hardlink,
+    'reflink': copy_by_reflink,
+    'kernel': copy_in_kernel,
+    'bytes': copy_bytes,
+}
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class InterProcessLock:
+    """
+    A lock held across threads and processes: the server and the native
+    messaging host each load this module, so a threading.Lock alone does not
+    keep them apart. The process-wide part is an advisory lock on path
+    (flock on macOS/Linux, msvcrt.locking on Windows); when path cannot be
+    opened or locked, it falls back to the thread lock alone.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = None
+        self._held = False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self):
+        """Wait for the lock in this process, then across processes."""
+        self._lock.acquire()
+        try:
+            if self._fd is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._lock_file(True)
+            self._held = True
+        except OSError:
+            pass
+
+    def release(self):
+        """Release the lock taken by acquire."""
+        try:
+            if self._held:
+                self._held = False
+                self._lock_file(False)
+        except OSError:
+            pass
+        finally:
+            self._lock.release()
+
+    def _lock_file(self, lock):
+        if os.name == 'nt':
+            import msvcrt
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            if not lock:
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+                return
+            # LK_LOCK gives up after 10 seconds; keep waiting like flock does
+            while True:
+                try:
+                    msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                    return
+                except OSError as e:
+                    if e.errno != errno.EDEADLOCK:
+                        raise
+        else:
+            import fcntl
+            fcntl.flock(self._fd, fcntl.LOCK_EX if lock else fcntl.LOCK_UN)
+
+
+OUTLOOK_LOCK = InterProcessLock(OUTLOOK_LOCK_FILE)
+
+
+class DocumentStore:
+    """
+    Content-addressed store for the businessnxtdocs copies.
+    Each unique file content is kept once as .store/<sha256>, and the
+    user-facing Faktura-/Order-/Orderbekräftelse- names are hardlinks to that
+    blob (a plain copy where hardlinks are not supported). .manifest.json maps
+    every name to its hash and creation time, records when each content was
+    last attached (for the sweeper's least-recently-used order), and
+    remembers the hash of recently seen source files by path, size and
+    mtime, so re-attaching an unchanged download is neither re-hashed nor
+    re-copied. Updates are written out together save_delay seconds after
+    the first one rather than on every attach, and names whose file is gone
+    are dropped whenever the manifest is read from disk.
+    """
+
+    blob_dir_name = '.store'
+    manifest_name = '.manifest.json'
+    lock_name = '.manifest.lock'
+    max_source_entries = 1000
+    save_delay = 2.0
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, self.blob_dir_name)
+        self.manifest_path = os.path.join(directory, self.manifest_name)
+        # The native messaging host may update the same manifest from its own process
+        self._lock = InterProcessLock(os.path.join(directory, self.lock_name))
+        self._manifest = None
+        self._manifest_stamp = None
+        # Changes not yet on disk, replayed if another process replaces the file first
+        self._pending = []
+        self._save_timer = None
+
+    def blob_path(self, digest):
+        """Return the path of the blob for a content hash."""
+        return os.path.join(self.blob_dir, digest)
+
+    def add(self, original_path, make_name, digest=None, move=False):
+        """
+        Store original_path's content and create a new link to it named by
+        make_name(), which is called again if the name is already taken.
+        digest skips hashing when the content hash is already known; move
+        renames original_path into the store (or deletes it when the content
+        is already there) instead of copying it, for files the server owns.
+        Returns (unique_path, CopyResult); the strategy is 'dedup' when the
+        content was already stored.
+        """
+        start = time.perf_counter()
+        st = os.stat(original_path)
+        source_key = f"{os.path.realpath(original_path)}|{st.st_size}|{st.st_mtime_ns}"
+        
+        if digest is None:
+            with self._lock:
+                digest = self._load()['sources'].get(source_key)
+        if digest is None:
+            digest = hash_file(original_path)
+        
+        blob_path = self.blob_path(digest)
+        strategy = 'dedup'
+        # Pinned so the retention sweeper cannot remove the blob mid-link
+        with IN_FLIGHT.pinned([blob_path]):
+            if not os.path.exists(blob_path):
+                os.makedirs(self.blob_dir, exist_ok=True)
+                if move:
+                    os.replace(original_path, blob_path)
+                    strategy = 'move'
+                else:
+                    temp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    if os.path.lexists(temp_path):
+                        os.remove(temp_path)
+                    strategy = clone_file(original_path, temp_path, INDEPENDENT_COPY_STRATEGIES).strategy
+                    os.replace(temp_path, blob_path)
+            elif move:
+                os.remove(original_path)
+            
+            unique_path = self._link_unique(blob_path, make_name)
+        
+        name = os.path.basename(unique_path)
+        now = time.time()
+        
+        def record(manifest):
+            manifest['names'][name] = {'hash': digest, 'created': now}
+            # New or reused, the content was used now
+            manifest['used'][digest] = now
+            # A moved file is gone, so there is no source to remember
+            if not move:
+                sources = manifest['sources']
+                sources.pop(source_key, None)
+                sources[source_key] = digest
+                while len(sources) > self.max_source_entries:
+                    sources.pop(next(iter(sources)))
+        
+        self._update(record)
+        
+        return unique_path, CopyResult(strategy, time.perf_counter() - start, st.st_size)
+
+    def entries(self):
+        """Return {name: (hash, created)} for every name in the manifest."""
+        with self._lock:
+            names = self._load()['names']
+            return {
+                name: (entry['hash'], entry.get('created', 0)) if isinstance(entry, dict) else (entry, 0)
+                for name, entry in names.items()
+            }
+
+    def hash_of(self, name):
+        """Return the content hash stored for a name, or None."""
+        with self._lock:
+            entry = self._load()['names'].get(name)
+        return entry['hash'] if isinstance(entry, dict) else entry
+
+    def last_used(self):
+        """Return {hash: time the content was last attached}."""
+        with self._lock:
+            return dict(self._load()['used'])
+
+    def forget(self, names):
+        """Drop removed names from the manifest, and the use times of contents no name refers to."""
+        names = list(names)
+        
+        def remove(manifest):
+            for name in names:
+                manifest['names'].pop(name, None)
+            self._prune_used(manifest)
+        
+        self._update(remove)
+
+    def flush(self):
+        """Write pending manifest changes now."""
+        try:
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                if self._pending:
+                    self._load()
+                    self._save()
+                    self._pending = []
+        except OSError as e:
+            log_to_stderr(f"Could not save {self.manifest_path}: {e}")
+
+    def _link_unique(self, blob_path, make_name):
+        # Names hardlink to the store's own blob where the volume supports it
+        while True:
+            unique_path = os.path.join(self.directory, make_name())
+            try:
+                clone_file(blob_path, unique_path)
+                return unique_path
+            except FileExistsError:
+                continue
+
+    def _update(self, change):
+        # Apply now, write out with whatever else arrives within save_delay
+        with self._lock:
+            change(self._load())
+            self._pending.append(change)
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_delay, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def _load(self):
+        # Re-read only when another process has replaced the file since
+        stamp = self._stamp()
+        if self._manifest is None or stamp != self._manifest_stamp:
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    self._manifest = json.load(f)
+            except (OSError, ValueError):
+                self._manifest = {}
+            self._manifest.setdefault('names', {})
+            self._manifest.setdefault('used', {})
+            self._manifest.setdefault('sources', {})
+            self._manifest_stamp = stamp
+            # Names deleted by hand would otherwise stay until the sweeper met them
+            try:
+                present = set(os.listdir(self.directory))
+            except OSError:
+                present = None
+            if present is not None:
+                names = self._manifest['names']
+                for name in [name for name in names if name not in present]:
+                    del names[name]
+                self._prune_used(self._manifest)
+            for change in self._pending:
+                change(self._manifest)
+        return self._manifest
+
+    @staticmethod
+    def _prune_used(manifest):
+        live = {entry['hash'] if isinstance(entry, dict) else entry for entry in manifest['names'].values()}
+        used = manifest['used']
+        for digest in [digest for digest in used if digest not in live]:
+            del used[digest]
+
+    def _save(self):
+        temp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._manifest, f, ensure_ascii=False)
+        os.replace(temp_path, self.manifest_path)
+        self._manifest_stamp = self._stamp()
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.manifest_path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class InFlightFiles:
+    """
+    Reference counts for files an attach is still using, so the retention
+    sweeper never deletes a copy before Outlook has picked it up.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def pin(self, paths):
+        """Pin paths until a matching unpin."""
+        with self._lock:
+            for key in self._keys(paths):
+                self._counts[key] = self._counts.get(key, 0) + 1
+
+    def unpin(self, paths):
+        """Release one pin on each of paths."""
+        with self._lock:
+            for key in self._keys(paths):
+                remaining = self._counts[key] - 1
+                if remaining:
+                    self._counts[key] = remaining
+                else:
+                    del self._counts[key]
+
+    @contextmanager
+    def pinned(self, paths):
+        """Pin paths for the duration of the with block."""
+        paths = list(paths)
+        self.pin(paths)
+        try:
+            yield
+        finally:
+            self.unpin(paths)
+
+    def remove_if_unpinned(self, path):
+        """Delete path unless it is pinned; returns True if it was deleted."""
+        key, = self._keys([path])
+        with self._lock:
+            if key in self._counts:
+                return False
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return True
+
+    @staticmethod
+    def _keys(paths):
+        return [os.path.normcase(os.path.abspath(p)) for p in paths]
+
+
+IN_FLIGHT = InFlightFiles()
+
+
+SweepReport = namedtuple('SweepReport', 'removed_files freed_bytes kept_files kept_bytes seconds')
+
+
+class RetentionSweeper:
+    """
+    Background thread that keeps businessnxtdocs bounded. Each sweep removes
+    named copies whose content has not been attached for max_age_days, then
+    the least recently used ones until the folder is under max_bytes, and
+    deletes store blobs no name refers to any more. Pinned (in-flight) files and files younger than the
+    grace period are never removed. Sizes are counted once per inode, so
+    hardlinked names are not double counted.
+    """
+
+    grace_seconds = 600
+
+    def __init__(self, directory=None, max_age_days=RETENTION_MAX_AGE_DAYS,
+                 max_bytes=RETENTION_MAX_BYTES, interval=RETENTION_SWEEP_INTERVAL, log=None):
+        self.directory = directory
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.log = log
+        self.last_report = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sweeping every interval seconds."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='retention-sweeper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the sweeper thread."""
+        self._stop.set()
+
+    def _run(self):
+        # Let startup traffic go first
+        if self._stop.wait(min(60, self.interval)):
+            return
+        while True:
+            try:
+                report = self.sweep()
+                if report.removed_files and self.log is not None:
+                    self.log(
+                        f"Retention sweep: removed {report.removed_files} files, "
+                        f"freed {report.freed_bytes / (1024 * 1024):.1f} MB in {report.seconds * 1000:.0f} ms "
+                        f"({report.kept_files} files, {report.kept_bytes / (1024 * 1024):.1f} MB kept)"
+                    )
+            except Exception as e:
+                if self.log is not None:
+                    self.log(f"Retention sweep failed: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def sweep(self, now=None):
+        """Run one sweep and return a SweepReport."""
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        directory = self.directory or get_businessnxtdocs_dir()
+        if not os.path.isdir(directory):
+            self.last_report = SweepReport(0, 0, 0, 0, time.perf_counter() - start)
+            return self.last_report
+        
+        store = get_document_store(directory)
+        manifest_entries = store.entries()
+        last_used = store.last_used()
+        
+        names = []
+        name_refs = {}
+        sizes = {}
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                inode = (st.st_dev, st.st_ino)
+                known = manifest_entries.get(entry.name)
+                created = known[1] if known and known[1] else max(st.st_mtime, st.st_ctime)
+                # Every name of a reused content shares its last use
+                used = max(created, last_used.get(known[0], 0)) if known else created
+                names.append((used, created, entry.name, entry.path, inode))
+                name_refs[inode] = name_refs.get(inode, 0) + 1
+                sizes[inode] = st.st_size
+        
+        blobs = {}
+        blob_dir = os.path.join(directory, DocumentStore.blob_dir_name)
+        if os.path.isdir(blob_dir):
+            with os.scandir(blob_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.tmp') or not entry.is_file(follow_symlinks=False):
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    inode = (st.st_dev, st.st_ino)
+                    blobs[inode] = (entry.path, st.st_ctime)
+                    sizes[inode] = st.st_size
+        
+        total_bytes = sum(sizes.values())
+        removed_names = []
+        freed_bytes = 0
+        max_age = self.max_age_days * 86400 if self.max_age_days else None
+        
+        def release(inode):
+            nonlocal total_bytes, freed_bytes
+            blob = blobs.pop(inode, None)
+            if blob is not None and not IN_FLIGHT.remove_if_unpinned(blob[0]):
+                return
+            total_bytes -= sizes[inode]
+            freed_bytes += sizes[inode]
+        
+        names.sort()
+        for used, created, name, path, inode in names:
+            age = now - used
+            expired = max_age is not None and age > max_age
+            oversize = bool(self.max_bytes) and total_bytes > self.max_bytes
+            if not expired and not oversize:
+                break
+            if age < self.grace_seconds or not IN_FLIGHT.remove_if_unpinned(path):
+                continue
+            removed_names.append(name)
+            name_refs[inode] -= 1
+            if name_refs[inode] == 0:
+                release(inode)
+        
+        # Blobs left behind by earlier sweeps or interrupted attaches
+        for inode, (path, changed) in list(blobs.items()):
+            if name_refs.get(inode) or now - changed < self.grace_seconds:
+                continue
+            release(inode)
+        
+        # Uploads abandoned mid-transfer or whose job never ran
+        upload_dir = os.path.join(directory, UploadReceiver.dir_name)
+        if os.path.isdir(upload_dir):
+            with os.scandir(upload_dir) as it:
+                for entry in it:
+                    try:
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                        if now - st.st_mtime >= self.grace_seconds and IN_FLIGHT.remove_if_unpinned(entry.path):
+                            freed_bytes += st.st_size
+                    except FileNotFoundError:
+                        # Finished or aborted by its UploadReceiver meanwhile
+                        continue
+        
+        if removed_names:
+            store.forget(removed_names)
+        
+        self.last_report = SweepReport(
+            removed_files=len(removed_names),
+            freed_bytes=freed_bytes,
+            kept_files=len(names) - len(removed_names),
+            kept_bytes=total_bytes,
+            seconds=time.perf_counter() - start
+        )
+        return self.last_report
+
+
+def start_background_tasks(log=None, prewarm=None, watch=None):
+    """
+    Start the server's background threads; log receives their messages.
+    prewarm turns Outlook pre-warming on or off (default: PREWARM) and watch
+    lists the download folders to watch (default: WATCH_DIRS).
+    """
+    global _retention_sweeper, _downloads_watcher
+    if log is None:
+        log = log_to_stderr
+    get_job_manager().log = log
+    if RETENTION_MAX_AGE_DAYS or RETENTION_MAX_BYTES:
+        _retention_sweeper = RetentionSweeper(log=log)
+        _retention_sweeper.start()
+    if PREWARM if prewarm is None else prewarm:
+        prewarmer = get_outlook_prewarmer()
+        prewarmer.log = log
+        prewarmer.start()
+    directories = WATCH_DIRS if watch is None else watch
+    if directories:
+        _downloads_watcher = DownloadsWatcher(directories, log=log)
+        _downloads_watcher.start()
+
+
+def stop_background_tasks():
+    """Stop the threads started by start_background_tasks."""
+    global _retention_sweeper, _downloads_watcher
+    if _retention_sweeper is not None:
+        _retention_sweeper.stop()
+        _retention_sweeper = None
+    get_outlook_prewarmer().stop()
+    if _downloads_watcher is not None:
+        _downloads_watcher.stop()
+        _downloads_watcher = None
+    if _attach_journal is not None:
+        _attach_journal.close()
+    flush_document_stores()
+
+
+def log_to_stderr(message):
+    """Write a timestamped message to stderr in the request log format."""
+    timestamp = datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")
+    sys.stderr.write(f"{timestamp} {message}\n")
+
+
+def get_document_store(directory):
+    """Return the shared DocumentStore for directory."""
+    with _document_stores_lock:
+        store = _document_stores.get(directory)
+        if store is None:
+            store = _document_stores[directory] = DocumentStore(directory)
+        return store
+
+
+def flush_document_stores():
+    """Write every DocumentStore's pending manifest changes."""
+    with _document_stores_lock:
+        stores = list(_document_stores.values())
+    for store in stores:
+        store.flush()
+
+
 def open_outlook_mac(file_path):
     """Open Outlook on macOS using AppleScript and attach the file."""
-    if not os.path.exists(file_path):
-        return False, f"File not found: {file_path}"
+    return open_outlook_mac_files([file_path])
+
+
+def open_outlook_mac_files(file_paths):
+    """
+    Open one Outlook message on macOS with all files attached.
+    Uses the warm AppleScript runner when available and falls back to
+    spawning osascript if the runner cannot be used.
+    """
+    for file_path in file_paths:
+        if not os.path.exists(file_path):
+            return False, f"File not found: {file_path}"
+    
+    runner = get_applescript_runner()
+    if runner is not None:
+        try:
+            ok, result = runner.call('attach_files', [os.path.abspath(p) for p in file_paths])
+            if ok:
+                return True, "Outlook opened successfully"
+            return False, f"AppleScript error: {result}"
+        except subprocess.TimeoutExpired:
+            return False, "Timeout opening Outlook"
+        except AppleScriptRunnerError as e:
+            sys.stderr.write(f"AppleScript runner unavailable, spawning osascript: {e}\n")
     
+    return open_outlook_mac_files_spawn(file_paths)
+
+
+def open_outlook_mac_files_spawn(file_paths):
+    """Attach file_paths to one Outlook message by spawning osascript with a generated script."""
     try:
-        file_path = os.path.abspath(file_path)
+        attachment_lines = "\n".join(
+            f'                make new attachment with properties {{file:POSIX file "{applescript_escape(os.path.abspath(p))}"}}'
+            for p in file_paths
+        )
         
         script = f'''
         tell application "Microsoft Outlook"
             activate
             set newMessage to make new outgoing message
             tell newMessage
-                make new attachment with properties {{file:POSIX file "{file_path}"}}
+{attachment_lines}
             end tell
             open newMessage
         end tell
@@ -108,144 +1177,3487 @@ def open_outlook_mac(file_path):
         return False, f"Error: {str(e)}"
 
 
-def open_outlook_windows(file_path):
-    """Open Outlook on Windows using COM automation and attach the file."""
-    if not os.path.exists(file_path):
-        return False, f"File not found: {file_path}"
+def applescript_escape(value):
+    """Escape a value for use inside an AppleScript string literal."""
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def warm_up_outlook_mac(timeout=PREWARM_TIMEOUT):
+    """Launch Outlook on macOS without activating it and wait for it to answer."""
+    runner = get_applescript_runner()
+    if runner is not None:
+        try:
+            ok, result = runner.call('warm_up', timeout=timeout)
+            if ok:
+                return True, f"Outlook {result} is ready"
+            return False, f"AppleScript error: {result}"
+        except subprocess.TimeoutExpired:
+            return False, "Timeout warming up Outlook"
+        except AppleScriptRunnerError as e:
+            sys.stderr.write(f"AppleScript runner unavailable, spawning osascript: {e}\n")
     
     try:
-        import win32com.client
-        
-        file_path = os.path.abspath(file_path)
-        file_path = file_path.replace('/', '\\')
-        
-        outlook = win32com.client.Dispatch("Outlook.Application")
-        
-        mail_item = outlook.CreateItem(0)
-        
-        mail_item.Attachments.Add(file_path)
-        
-        mail_item.Display()
-        
-        return True, "Outlook opened successfully"
-        
-    except ImportError:
-        return False, "pywin32 not installed"
+        result = subprocess.run(
+            ['osascript', '-e', 'tell application "Microsoft Outlook" to launch',
+             '-e', 'tell application "Microsoft Outlook" to return version as text'],
+            capture_output=True,
+            text=True,
+            timeout=timeout
+        )
+        if result.returncode == 0:
+            return True, f"Outlook {result.stdout.strip()} is ready"
+        error_msg = result.stderr.strip() if result.stderr else "Unknown error"
+        return False, f"AppleScript error: {error_msg}"
+    except subprocess.TimeoutExpired:
+        return False, "Timeout warming up Outlook"
     except Exception as e:
         return False, f"Error: {str(e)}"
 
 
-class AttachHandler(http.server.BaseHTTPRequestHandler):
-    """HTTP request handler for /attach endpoint."""
-    
-    def log_message(self, format, *args):
-        """Override to use custom log format with timestamp."""
-        timestamp = datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")
-        sys.stderr.write(f"{timestamp} {format % args}\n")
-    
-    def do_OPTIONS(self):
-        """Handle CORS preflight requests."""
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
-    
-    def do_POST(self):
-        """Handle POST requests to /attach endpoint."""
-        if self.path != '/attach':
-            self.send_response(404)
-            self.end_headers()
-            return
-        
-        content_length = int(self.headers.get('Content-Length', 0))
-        body = self.rfile.read(content_length)
-        
-        try:
-            data = json.loads(body.decode('utf-8'))
-            file_path = data.get('filePath')
-            
-            if not file_path:
-                self.send_error_response(400, "Missing filePath in request")
-                return
-            
-            unique_file_path, copy_error = create_unique_file_copy(file_path)
-            if not unique_file_path:
-                self.send_error_response(500, copy_error or "Failed to create unique file copy")
-                return
-            
-            file_to_attach = unique_file_path
-            
-            system = platform.system()
-            if system == 'Darwin':
-                success, message = open_outlook_mac(file_to_attach)
-            elif system == 'Windows':
-                success, message = open_outlook_windows(file_to_attach)
-            else:
-                self.send_error_response(400, f"Unsupported platform: {system}")
-                return
-            
-            response_data = {
-                'success': success,
-                'message': message
-            }
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(response_data).encode('utf-8'))
-            
-            status = "Success" if success else "Failed"
-            original_filename = os.path.basename(file_path)
-            unique_filename = os.path.basename(file_to_attach)
-            self.log_message(f"Attached file: {original_filename} (unique: {unique_filename}) - {status}: {success}")
-            
-        except json.JSONDecodeError:
-            self.send_error_response(400, "Invalid JSON in request body")
-        except Exception as e:
-            self.send_error_response(500, f"Internal server error: {str(e)}")
-    
-    def send_error_response(self, status_code, message):
-        """Send an error response with JSON body."""
+def outlook_running_mac():
+    """Return whether Outlook is running on macOS (without launching it), or None if unknown."""
+    runner = get_applescript_runner()
+    try:
+        if runner is not None:
+            ok, result = runner.call('outlook_running')
+        else:
+            completed = subprocess.run(
+                ['osascript', '-e', 'application "Microsoft Outlook" is running'],
+                capture_output=True, text=True, timeout=10
+            )
+            ok, result = completed.returncode == 0, completed.stdout
+    except (subprocess.TimeoutExpired, AppleScriptRunnerError, OSError):
+        return None
+    return result.strip() == 'true' if ok else None
+
+
+# Handlers compiled once by the AppleScript runner; paths arrive as parameters
+OUTLOOK_APPLESCRIPT = '''
+on attach_files(posixPaths)
+    set theFiles to {}
+    repeat with posixPath in posixPaths
+        set end of theFiles to (POSIX file (posixPath as text))
+    end repeat
+    tell application "Microsoft Outlook"
+        activate
+        set newMessage to make new outgoing message
+        tell newMessage
+            repeat with theFile in theFiles
+                make new attachment with properties {file:(contents of theFile)}
+            end repeat
+        end tell
+        open newMessage
+    end tell
+    return "ok"
+end attach_files
+
+on warm_up()
+    tell application "Microsoft Outlook"
+        launch
+        return version as text
+    end tell
+end warm_up
+
+on outlook_running()
+    return (application "Microsoft Outlook" is running) as text
+end outlook_running
+'''
+
+# JavaScript for Automation host run by a single long-lived osascript process.
+# It compiles the AppleScript in argv[0] once, then reads one JSON request per
+# line from stdin ({"handler": name, "args": [...]}), calls the handler with an
+# Apple event and writes one JSON reply per line to stdout.
+APPLESCRIPT_RUNNER_HOST = '''
+ObjC.import('Foundation');
+
+function descriptorFor(value) {
+    if (Array.isArray(value)) {
+        var list = $.NSAppleEventDescriptor.listDescriptor;
+        value.forEach(function (item, i) { list.insertDescriptorAtIndex(descriptorFor(item), i + 1); });
+        return list;
+    }
+    return $.NSAppleEventDescriptor.descriptorWithString(String(value));
+}
+
+function run(argv) {
+    var stdin = $.NSFileHandle.fileHandleWithStandardInput;
+    var stdout = $.NSFileHandle.fileHandleWithStandardOutput;
+    var reply = function (obj) {
+        stdout.writeData($(JSON.stringify(obj) + "\\n").dataUsingEncoding($.NSUTF8StringEncoding));
+    };
+    var errorMessage = function (ref) {
+        var info = ObjC.deepUnwrap(ref[0]);
+        return info ? String(info.NSAppleScriptErrorMessage || JSON.stringify(info)) : null;
+    };
+
+    var script = $.NSAppleScript.alloc.initWithSource($(argv[0]));
+    var compileError = Ref();
+    if (!script.compileAndReturnError(compileError)) {
+        reply({ready: false, error: errorMessage(compileError)});
+        return;
+    }
+    reply({ready: true});
+
+    var buffer = "";
+    while (true) {
+        var data = stdin.availableData;
+        if (data.length == 0) {
+            return;
+        }
+        buffer += $.NSString.alloc.initWithDataEncoding(data, $.NSUTF8StringEncoding).js;
+        var newline;
+        while ((newline = buffer.indexOf("\\n")) >= 0) {
+            var line = buffer.slice(0, newline);
+            buffer = buffer.slice(newline + 1);
+            try {
+                var request = JSON.parse(line);
+                // kASAppleScriptSuite / kASSubroutineEvent with keyASSubroutineName
+                var event = $.NSAppleEventDescriptor.appleEventWithEventClassEventIDTargetDescriptorReturnIDTransactionID(
+                    0x61736372, 0x70736272, $.NSAppleEventDescriptor.currentProcessDescriptor, -1, 0);
+                event.setParamDescriptorForKeyword(descriptorFor(request.handler.toLowerCase()), 0x736e616d);
+                event.setParamDescriptorForKeyword(descriptorFor(request.args), 0x2d2d2d2d);
+                var callError = Ref();
+                var result = script.executeAppleEventError(event, callError);
+                var message = errorMessage(callError);
+                if (message !== null) {
+                    reply({ok: false, error: message});
+                } else {
+                    reply({ok: true, result: ObjC.unwrap(result.stringValue) || ""});
+                }
+            } catch (e) {
+                reply({ok: false, error: String(e)});
+            }
+        }
+    }
+}
+'''
+
+
+class AppleScriptRunnerError(Exception):
+    """The AppleScript runner process could not be started or stopped answering."""
+
+
+class AppleScriptRunner:
+    """
+    One long-lived osascript process that compiles an AppleScript once and
+    then runs its handlers with parameters sent over stdin. Attaches skip the
+    per-call process spawn and script compile of `osascript -e`.
+    Script errors are returned as (False, message); problems with the runner
+    process itself raise AppleScriptRunnerError so callers can fall back.
+    """
+
+    def __init__(self, source, timeout=10, startup_timeout=10):
+        self.source = source
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self.calls = 0
+        self.last_duration = None
+        self._process = None
+        self._replies = None
+        self._lock = threading.Lock()
+
+    def call(self, handler, *args, timeout=None):
+        """
+        Call handler(*args) in the compiled script and return (success, result).
+        timeout overrides the runner's default for this call.
+        """
+        with self._lock:
+            self._ensure_started()
+            request = json.dumps({'handler': handler, 'args': list(args)}) + "\n"
+            start = time.perf_counter()
+            try:
+                self._process.stdin.write(request)
+                self._process.stdin.flush()
+            except OSError as e:
+                self._stop_process()
+                raise AppleScriptRunnerError(f"runner stdin closed: {e}")
+            reply = self._read_reply(timeout or self.timeout)
+            self.last_duration = time.perf_counter() - start
+            self.calls += 1
+            if reply.get('ok'):
+                return True, reply.get('result', '')
+            return False, reply.get('error') or "Unknown error"
+
+    def close(self):
+        """Stop the runner process."""
+        with self._lock:
+            self._stop_process()
+
+    def _ensure_started(self):
+        if self._process is not None and self._process.poll() is None:
+            return
+        self._stop_process()
+        try:
+            self._process = subprocess.Popen(
+                ['osascript', '-l', 'JavaScript', '-e', APPLESCRIPT_RUNNER_HOST, self.source],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                encoding='utf-8',
+                bufsize=1
+            )
+        except OSError as e:
+            raise AppleScriptRunnerError(f"cannot start osascript: {e}")
+        self._replies = queue.Queue()
+        threading.Thread(
+            target=self._read_stdout,
+            args=(self._process, self._replies),
+            name='applescript-runner',
+            daemon=True
+        ).start()
+        ready = self._read_reply(self.startup_timeout)
+        if not ready.get('ready'):
+            self._stop_process()
+            raise AppleScriptRunnerError(f"script did not compile: {ready.get('error')}")
+
+    def _read_reply(self, timeout):
+        try:
+            line = self._replies.get(timeout=timeout)
+        except queue.Empty:
+            # The runner may be stuck inside Outlook; start a fresh one next time
+            self._stop_process()
+            raise subprocess.TimeoutExpired('osascript', timeout)
+        if line is None:
+            self._stop_process()
+            raise AppleScriptRunnerError("runner exited")
+        try:
+            return json.loads(line)
+        except ValueError:
+            self._stop_process()
+            raise AppleScriptRunnerError(f"unexpected runner output: {line.strip()}")
+
+    @staticmethod
+    def _read_stdout(process, replies):
+        for line in process.stdout:
+            replies.put(line)
+        replies.put(None)
+
+    def _stop_process(self):
+        process, self._process = self._process, None
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def get_applescript_runner():
+    """Return the shared AppleScript runner, or None when it is disabled or failed to start."""
+    global _applescript_runner
+    if not APPLESCRIPT_RUNNER_ENABLED:
+        return None
+    with _applescript_runner_lock:
+        if _applescript_runner is None:
+            _applescript_runner = AppleScriptRunner(OUTLOOK_APPLESCRIPT)
+        return _applescript_runner
+
+
+def open_outlook_windows(file_path):
+    """Open Outlook on Windows using COM automation and attach the file."""
+    return open_outlook_windows_files([file_path])
+
+
+def open_outlook_windows_files(file_paths):
+    """Open one Outlook mail item on Windows with all files attached."""
+    for file_path in file_paths:
+        if not os.path.exists(file_path):
+            return False, f"File not found: {file_path}"
+    
+    windows_paths = [os.path.abspath(p).replace('/', '\\') for p in file_paths]
+    return get_com_worker().attach_files(windows_paths)
+
+
+class OutlookComWorker:
+    """
+    Long-lived Windows automation thread that owns one COM apartment (STA) and
+    one cached Outlook.Application object. Attach jobs are queued to it, so
+    Dispatch() runs once instead of on every HTTP thread, and the cached
+    object is dropped and re-created when Outlook has been restarted.
+    
+    dispatch is a callable taking a ProgID; it defaults to
+    win32com.client.Dispatch, and a fake can be passed in to drive the
+    worker without Outlook (COM initialization is skipped in that case).
+    """
+
+    def __init__(self, dispatch=None, job_timeout=COM_JOB_TIMEOUT, get_active=None):
+        self.dispatch = dispatch
+        self.get_active = get_active
+        self.uses_com = dispatch is None
+        self.job_timeout = job_timeout
+        self.state = 'cold'
+        self.connects = 0
+        self.jobs_done = 0
+        self.last_error = None
+        self._outlook = None
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker thread if it is not running."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='outlook-com', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Ask the worker thread to release Outlook and exit."""
+        self._jobs.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def status(self):
+        """Return a snapshot of the worker's warm/cold state and counters."""
+        return {
+            'state': self.state,
+            'connects': self.connects,
+            'jobsDone': self.jobs_done,
+            'lastError': self.last_error,
+        }
+
+    def attach_files(self, file_paths):
+        """Queue an attach job and wait for its (success, message) result."""
+        return self.submit(self._attach_files, file_paths)
+
+    def warm_up(self, timeout=PREWARM_TIMEOUT):
+        """Connect to Outlook (starting it without a window if needed) and make a no-op call."""
+        return self.submit(self._version, timeout=timeout)
+
+    def probe(self):
+        """
+        Return whether Outlook is running, without starting it: checks the
+        cached object, or attaches to a running Outlook (e.g. after a restart).
+        None when that cannot be told (no pywin32, or a fake dispatch).
+        """
+        self.start()
+        future = Future()
+        self._jobs.put((future, self._probe, None))
+        try:
+            return future.result(timeout=self.job_timeout)
+        except FutureTimeoutError:
+            # Drop the probe if the worker has not picked it up yet
+            future.cancel()
+            return None
+
+    def submit(self, func, *args, timeout=None):
+        """Run func(outlook, *args) on the COM thread and wait for its (success, message) result."""
+        self.start()
+        future = Future()
+        self._jobs.put((future, func, args))
+        try:
+            return future.result(timeout=timeout or self.job_timeout)
+        except FutureTimeoutError:
+            # A queued job is cancelled so _run skips it; one already running
+            # cannot be stopped and may still open its mail window
+            if future.cancel():
+                return False, "Timeout waiting for Outlook"
+            return False, "Timeout waiting for Outlook (the job is still running and may complete)"
+
+    def _run(self):
+        pythoncom = None
+        if self.uses_com:
+            try:
+                import pythoncom
+                import win32com.client
+                self.dispatch = win32com.client.Dispatch
+                self.get_active = win32com.client.GetActiveObject
+                pythoncom.CoInitializeEx(pythoncom.COINIT_APARTMENTTHREADED)
+            except ImportError:
+                pythoncom = None
+        try:
+            while True:
+                job = self._jobs.get()
+                if job is None:
+                    break
+                future, func, args = job
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    # Jobs without args (probe) handle the Outlook object themselves
+                    future.set_result(func() if args is None else self._call(func, args))
+                except Exception as e:
+                    future.set_exception(e)
+        finally:
+            self._outlook = None
+            self.state = 'stopped'
+            if pythoncom is not None:
+                pythoncom.CoUninitialize()
+
+    def _call(self, func, args):
+        if self.dispatch is None:
+            return False, "pywin32 not installed"
+        # A cached object from before an Outlook restart fails on first use, so
+        # check it with a no-op call and reconnect. func itself runs only once:
+        # retrying a half-done attach could open a second mail window
+        if self._outlook is not None:
+            try:
+                self._outlook.Version
+            except Exception:
+                self._outlook = None
+                self.state = 'cold'
+        try:
+            if self._outlook is None:
+                self._outlook = self.dispatch("Outlook.Application")
+                self.connects += 1
+                self.state = 'warm'
+        except Exception as e:
+            self.state = 'cold'
+            self.last_error = str(e)
+            return False, f"Error: {str(e)}"
+        try:
+            result = func(self._outlook, *args)
+        except Exception as e:
+            self.last_error = str(e)
+            return False, f"Error: {str(e)}"
+        self.jobs_done += 1
+        self.last_error = None
+        return result
+
+    def _probe(self):
+        if self._outlook is not None:
+            try:
+                self._outlook.Version
+                return True
+            except Exception:
+                # Outlook quit or restarted since the object was taken
+                self._outlook = None
+                self.state = 'cold'
+        if self.get_active is None:
+            return None
+        try:
+            self._outlook = self.get_active("Outlook.Application")
+        except Exception:
+            return False
+        self.connects += 1
+        self.state = 'warm'
+        return True
+
+    @staticmethod
+    def _version(outlook):
+        return True, f"Outlook {outlook.Version} is ready"
+
+    @staticmethod
+    def _attach_files(outlook, file_paths):
+        mail_item = outlook.CreateItem(0)
+        for file_path in file_paths:
+            mail_item.Attachments.Add(file_path)
+        mail_item.Display()
+        return True, "Outlook opened successfully"
+
+
+def get_com_worker():
+    """Return the shared Outlook COM worker, creating it on first use."""
+    global _com_worker
+    with _com_worker_lock:
+        if _com_worker is None:
+            _com_worker = OutlookComWorker()
+        return _com_worker
+
+
+def attach_to_outlook(system, file_path):
+    """Run the platform automation for file_path, one caller at a time."""
+    return attach_files_to_outlook(system, [file_path])
+
+
+def attach_files_to_outlook(system, file_paths):
+    """Attach all file_paths to a single new message, one caller at a time."""
+    with OUTLOOK_LOCK:
+        if system == 'Simulated':
+            success, message = get_simulated_outlook().attach_files(file_paths)
+        elif system == 'Darwin':
+            success, message = open_outlook_mac_files(file_paths)
+        else:
+            success, message = open_outlook_windows_files(file_paths)
+    if success:
+        get_outlook_prewarmer().record_attach()
+    return success, message
+
+
+def warm_up_outlook(system, timeout=PREWARM_TIMEOUT):
+    """
+    Start Outlook if needed and make a no-op call. Returns (success, message).
+    Runs without OUTLOOK_LOCK, so a cold start of up to `timeout` seconds
+    does not hold up attaches: on Windows the COM worker and on macOS the
+    AppleScript runner already run one call at a time.
+    """
+    if system == 'Simulated':
+        with OUTLOOK_LOCK:
+            simulated = get_simulated_outlook()
+        return simulated.warm_up()
+    if system == 'Darwin':
+        return warm_up_outlook_mac(timeout)
+    if system == 'Windows':
+        return get_com_worker().warm_up(timeout)
+    return False, f"Unsupported platform: {system}"
+
+
+def outlook_is_running(system):
+    """Return whether Outlook is running (never starting it), or None when unknown."""
+    if system == 'Simulated':
+        return True
+    if system == 'Darwin':
+        return outlook_running_mac()
+    if system == 'Windows':
+        return get_com_worker().probe()
+    return None
+
+
+class OutlookPrewarmer:
+    """
+    Background thread that warms Outlook up at startup and again whenever it
+    has been restarted, and reports the warm/cold state for /status.
+    States: 'cold' (not warmed yet, or Outlook quit), 'warming', 'warm' and
+    'failed' (the last warm-up did not succeed; retried once Outlook runs).
+    """
+
+    def __init__(self, interval=PREWARM_INTERVAL, timeout=PREWARM_TIMEOUT, log=None):
+        self.interval = interval
+        self.timeout = timeout
+        self.log = log
+        self.state = 'cold'
+        self.time_to_warm = None
+        self.warmed_at = None
+        self.warmups = 0
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Warm up now and then check every interval seconds."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='outlook-prewarm', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the prewarm thread."""
+        self._stop.set()
+
+    @property
+    def enabled(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def warm(self):
+        """Warm Outlook up now. Returns True on success."""
+        self.state = 'warming'
+        start = time.perf_counter()
+        success, message = warm_up_outlook(get_attach_system(), self.timeout)
+        seconds = time.perf_counter() - start
+        get_metrics().observe('outlook_attach_prewarm_seconds', seconds,
+                              result='success' if success else 'error')
+        if success:
+            self.state = 'warm'
+            self.time_to_warm = seconds
+            self.warmed_at = time.time()
+            self.warmups += 1
+            self.last_error = None
+            self._log(f"{message} (warmed in {seconds:.1f}s)")
+        else:
+            self.state = 'failed'
+            self.last_error = message
+            self._log(f"Outlook warm-up failed after {seconds:.1f}s: {message}")
+        return success
+
+    def check(self):
+        """Mark Outlook cold if it quit, and warm it again once it runs after a restart."""
+        running = outlook_is_running(get_attach_system())
+        if running is False:
+            if self.state != 'cold':
+                self._log("Outlook is not running; it will be warmed when it starts again")
+            self.state = 'cold'
+        elif running and self.state != 'warm':
+            self.warm()
+
+    def record_attach(self):
+        """A successful attach leaves Outlook warm."""
+        self.state = 'warm'
+
+    def status(self):
+        """Return the warm/cold state for /status."""
+        return {
+            'prewarm': self.enabled,
+            'state': self.state,
+            'timeToWarm': round(self.time_to_warm, 3) if self.time_to_warm is not None else None,
+            'warmedAt': (datetime.fromtimestamp(self.warmed_at).isoformat(timespec='seconds')
+                         if self.warmed_at is not None else None),
+            'warmups': self.warmups,
+            'lastError': self.last_error,
+        }
+
+    def describe(self):
+        """One-line summary of status() for the plain-text /status."""
+        if self.state == 'warm' and self.time_to_warm is not None:
+            return f"warm (warmed in {self.time_to_warm:.1f}s)"
+        if self.state == 'failed':
+            return f"warm-up failed: {self.last_error}"
+        return self.state
+
+    def _log(self, message):
+        (self.log or log_to_stderr)(message)
+
+    def _run(self):
+        try:
+            self.warm()
+        except Exception as e:
+            self.state = 'failed'
+            self.last_error = str(e)
+            self._log(f"Outlook warm-up failed: {e}")
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                self._log(f"Outlook check failed: {e}")
+
+
+def get_outlook_prewarmer():
+    """Return the shared OutlookPrewarmer (started by start_background_tasks when enabled)."""
+    global _prewarmer
+    with _prewarmer_lock:
+        if _prewarmer is None:
+            _prewarmer = OutlookPrewarmer()
+        return _prewarmer
+
+
+def default_downloads_dir():
+    """Return the user's Downloads folder."""
+    return os.path.join(os.path.expanduser("~"), "Downloads")
+
+
+def scan_directory(directory):
+    """Return {name: (size, mtime_ns)} for the regular files in directory."""
+    files = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files[entry.name] = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        pass
+    return files
+
+
+def file_signature(path):
+    """Return (size, mtime_ns) for a regular file, or None if there is none at path."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns) if stat.S_ISREG(st.st_mode) else None
+
+
+class PollingWatch:
+    """
+    Finds new and changed files by rescanning the folders every interval
+    seconds. Used where the platform has no change notifications.
+    """
+
+    name = 'poll'
+
+    def __init__(self, directories, interval=1.0):
+        self.directories = directories
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._next_scan = time.monotonic() + (interval or 0)
+        self._snapshot = {d: scan_directory(d) for d in directories}
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds (None: until something changes) and return
+        the changes as [(path, complete)]; complete means the file was just
+        closed or renamed into place, so it is probably fully written.
+        """
+        delay = self._next_scan - time.monotonic()
+        if timeout is not None:
+            delay = min(delay, timeout)
+        if delay > 0 and self._wakeup.wait(delay):
+            return []
+        if time.monotonic() < self._next_scan:
+            return []
+        self._next_scan = time.monotonic() + self.interval
+        return self.rescan(self.directories)
+
+    def rescan(self, directories):
+        """Compare directories with the last scan and return their changes."""
+        changes = []
+        for directory in directories:
+            previous = self._snapshot.get(directory, {})
+            current = scan_directory(directory)
+            for name, signature in current.items():
+                if previous.get(name) == signature:
+                    continue
+                # A partial download (name.crdownload, name.part) renamed over it
+                renamed = any(name + suffix in previous and name + suffix not in current
+                              for suffix in WATCH_IGNORED_SUFFIXES)
+                changes.append((os.path.join(directory, name), renamed))
+            self._snapshot[directory] = current
+        return changes
+
+    def wake(self):
+        """Make a pending wait() return early."""
+        self._wakeup.set()
+
+    def close(self):
+        pass
+
+
+class KqueueWatch(PollingWatch):
+    """Rescans a folder when kqueue reports a change to its entries (macOS, BSD)."""
+
+    name = 'kqueue'
+
+    def __init__(self, directories):
+        import select
+        self._kq = select.kqueue()
+        super().__init__(directories, None)
+        self._fds = {}
+        self._wake_r, self._wake_w = os.pipe()
+        events = [select.kevent(self._wake_r, select.KQ_FILTER_READ, select.KQ_EV_ADD)]
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            self._fds[fd] = directory
+            events.append(select.kevent(fd, select.KQ_FILTER_VNODE, select.KQ_EV_ADD | select.KQ_EV_CLEAR,
+                                        select.KQ_NOTE_WRITE))
+        self._kq.control(events, 0)
+
+    def wait(self, timeout):
+        changed = []
+        for event in self._kq.control(None, 16, timeout):
+            if event.ident == self._wake_r:
+                os.read(self._wake_r, 512)
+            elif event.ident in self._fds:
+                changed.append(self._fds[event.ident])
+        return self.rescan(changed) if changed else []
+
+    def wake(self):
+        os.write(self._wake_w, b'x')
+
+    def close(self):
+        self._kq.close()
+        for fd in list(self._fds) + [self._wake_r, self._wake_w]:
+            os.close(fd)
+
+
+class InotifyWatch:
+    """Reads close-after-write and rename events from inotify (Linux)."""
+
+    name = 'inotify'
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    def __init__(self, directories):
+        import ctypes
+        libc = get_libc()
+        if libc is None:
+            raise OSError("C library not available")
+        fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._fd = fd
+        self._dirs = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+            if wd < 0:
+                err = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(err, os.strerror(err), directory)
+            self._dirs[wd] = directory
+        self._wake_r, self._wake_w = os.pipe()
+
+    def wait(self, timeout):
+        import select
+        readable, _, _ = select.select([self._fd, self._wake_r], [], [], timeout)
+        if self._wake_r in readable:
+            os.read(self._wake_r, 512)
+        if self._fd not in readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        changes = []
+        offset = 0
+        # struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+        while offset + 16 <= len(data):
+            wd, _, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            directory = self._dirs.get(wd)
+            if directory is not None and name:
+                changes.append((os.path.join(directory, os.fsdecode(name)), True))
+        return changes
+
+    def wake(self):
+        os.write(self._wake_w, b'x')
+
+    def close(self):
+        for fd in (self._fd, self._wake_r, self._wake_w):
+            os.close(fd)
+
+
+class DirectoryChangesWatch:
+    """Reads file name changes with ReadDirectoryChangesW (Windows, needs pywin32)."""
+
+    name = 'windows'
+
+    FILE_LIST_DIRECTORY = 0x0001
+    FILE_ACTION_ADDED = 1
+    FILE_ACTION_MODIFIED = 3
+    FILE_ACTION_RENAMED_NEW_NAME = 5
+
+    def __init__(self, directories):
+        import pywintypes
+        import win32con
+        import win32event
+        import win32file
+        self._win32event = win32event
+        self._win32file = win32file
+        self._filter = (win32con.FILE_NOTIFY_CHANGE_FILE_NAME | win32con.FILE_NOTIFY_CHANGE_SIZE
+                        | win32con.FILE_NOTIFY_CHANGE_LAST_WRITE)
+        self._stop_event = win32event.CreateEvent(None, True, False, None)
+        self._watches = []
+        for directory in directories:
+            handle = win32file.CreateFile(
+                directory, self.FILE_LIST_DIRECTORY,
+                win32con.FILE_SHARE_READ | win32con.FILE_SHARE_WRITE | win32con.FILE_SHARE_DELETE,
+                None, win32con.OPEN_EXISTING,
+                win32con.FILE_FLAG_BACKUP_SEMANTICS | win32con.FILE_FLAG_OVERLAPPED, None
+            )
+            overlapped = pywintypes.OVERLAPPED()
+            overlapped.hEvent = win32event.CreateEvent(None, True, False, None)
+            watch = (directory, handle, overlapped, win32file.AllocateReadBuffer(64 * 1024))
+            self._read(watch)
+            self._watches.append(watch)
+
+    def _read(self, watch):
+        _, handle, overlapped, buffer = watch
+        self._win32file.ReadDirectoryChangesW(handle, buffer, False, self._filter, overlapped)
+
+    def wait(self, timeout):
+        win32event = self._win32event
+        handles = [watch[2].hEvent for watch in self._watches] + [self._stop_event]
+        result = win32event.WaitForMultipleObjects(
+            handles, False, win32event.INFINITE if timeout is None else int(timeout * 1000)
+        )
+        index = result - win32event.WAIT_OBJECT_0
+        if not 0 <= index < len(self._watches):
+            win32event.ResetEvent(self._stop_event)
+            return []
+        watch = self._watches[index]
+        directory, handle, overlapped, buffer = watch
+        size = self._win32file.GetOverlappedResult(handle, overlapped, True)
+        win32event.ResetEvent(overlapped.hEvent)
+        changes = []
+        for action, name in self._win32file.FILE_NOTIFY_INFORMATION(buffer, size):
+            if action in (self.FILE_ACTION_ADDED, self.FILE_ACTION_MODIFIED, self.FILE_ACTION_RENAMED_NEW_NAME):
+                changes.append((os.path.join(directory, name), action == self.FILE_ACTION_RENAMED_NEW_NAME))
+        self._read(watch)
+        return changes
+
+    def wake(self):
+        self._win32event.SetEvent(self._stop_event)
+
+    def close(self):
+        for _, handle, _, _ in self._watches:
+            self._win32file.CancelIo(handle)
+            handle.Close()
+
+
+def open_watch(directories, backend='auto', poll_interval=1.0, log=None):
+    """
+    Return a watch on directories from the first backend that works here
+    (inotify, kqueue, ReadDirectoryChangesW), or a PollingWatch. A named
+    backend is used or its error raised.
+    """
+    for name, watch_class in (('inotify', InotifyWatch), ('kqueue', KqueueWatch),
+                              ('windows', DirectoryChangesWatch)):
+        if backend not in ('auto', name):
+            continue
+        try:
+            return watch_class(directories)
+        except Exception as e:
+            if backend == name:
+                raise
+            if log is not None and not isinstance(e, (ImportError, AttributeError)):
+                log(f"Cannot watch downloads with {name}: {e}")
+    if backend not in ('auto', 'poll'):
+        raise ValueError(f"Unknown watch backend: {backend}")
+    return PollingWatch(directories, poll_interval)
+
+
+class DownloadsWatcher:
+    """
+    Background thread that watches download folders and queues an attach
+    job for each new file a document rule matches, without the extension's
+    download event → confirm → fetch round trip. A file is queued once its
+    size and mtime have held still for settle_seconds after it was closed
+    or renamed into place (quiet_seconds after any other change). Partial
+    downloads (.crdownload, .part, ...) and hidden files are ignored, and
+    files already in the folders at start are left alone.
+    Its jobs are remembered for WATCH_DUPLICATE_WINDOW seconds, and /status
+    reports watching=true so the extension sends its attaches to this server,
+    where a confirm of the same download is answered as a duplicate.
+    """
+
+    settle_seconds = 0.05
+    quiet_seconds = 1.0
+    poll_interval = 1.0
+    max_remembered = 1000
+
+    def __init__(self, directories, backend=WATCH_BACKEND, log=None):
+        self.directories = [os.path.abspath(os.path.expanduser(d)) for d in directories]
+        self.backend = backend
+        self.log = log
+        self.queued = 0
+        self._pending = {}
+        self._queued_files = OrderedDict()
+        self._watch = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start watching in a background thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='downloads-watcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the watcher thread."""
+        self._stop.set()
+        watch = self._watch
+        if watch is not None:
+            watch.wake()
+
+    def wanted(self, name):
+        """Return True if a file name should be attached when it appears."""
+        if name.startswith(('.', '~$')) or name.lower().endswith(WATCH_IGNORED_SUFFIXES):
+            return False
+        return get_document_rules().matches(name)
+
+    def _run(self):
+        directories = [d for d in self.directories if os.path.isdir(d)]
+        for directory in set(self.directories) - set(directories):
+            if self.log is not None:
+                self.log(f"Not watching {directory}: no such folder")
+        if not directories:
+            return
+        try:
+            self._watch = open_watch(directories, self.backend, self.poll_interval, self.log)
+        except Exception as e:
+            if self.log is not None:
+                self.log(f"Cannot watch downloads: {e}")
+            return
+        if self.log is not None:
+            self.log(f"Watching {', '.join(directories)} for downloads ({self._watch.name})")
+        try:
+            while not self._stop.is_set():
+                for path, complete in self._watch.wait(self._next_timeout()):
+                    self._note(path, complete)
+                self._check_pending()
+        except Exception as e:
+            if self.log is not None:
+                self.log(f"Downloads watcher failed: {e}")
+        finally:
+            self._watch.close()
+            self._watch = None
+
+    def _next_timeout(self):
+        if not self._pending:
+            return None
+        return max(0.0, min(entry[0] for entry in self._pending.values()) - time.perf_counter())
+
+    def _note(self, path, complete):
+        """Start (or restart) the debounce for a changed file."""
+        if not self.wanted(os.path.basename(path)):
+            return
+        now = time.perf_counter()
+        entry = self._pending.get(path)
+        detected = entry[2] if entry is not None else now
+        delay = self.settle_seconds if complete else self.quiet_seconds
+        self._pending[path] = [now + delay, file_signature(path), detected]
+
+    def _check_pending(self):
+        """Queue the files that held still since they were noted."""
+        now = time.perf_counter()
+        for path, (deadline, signature, detected) in list(self._pending.items()):
+            if deadline > now:
+                continue
+            current = file_signature(path)
+            if current is None:
+                del self._pending[path]
+                continue
+            if current != signature:
+                self._pending[path] = [now + self.quiet_seconds, current, detected]
+                continue
+            del self._pending[path]
+            if self._queued_files.get(path) == current:
+                continue
+            self._queued_files[path] = current
+            self._queued_files.move_to_end(path)
+            while len(self._queued_files) > self.max_remembered:
+                self._queued_files.popitem(last=False)
+            self.queue(path, detected)
+
+    def queue(self, path, detected):
+        """Queue an attach job for path; detected is when it first changed (perf_counter)."""
+        job = AttachJob('attach', [path])
+        _, _, log_entry = run_or_queue_job(job, {'async': True}, duplicate_window=WATCH_DUPLICATE_WINDOW)
+        latency = time.perf_counter() - detected
+        get_metrics().observe('outlook_attach_watch_latency_seconds', latency)
+        self.queued += 1
+        if self.log is not None:
+            self.log(f"Download {os.path.basename(path)}: {log_entry} "
+                     f"({latency * 1000:.0f} ms after it appeared)")
+
+
+def get_attach_system():
+    """
+    Return the automation target for attaches: 'Simulated' with the simulated
+    backend, otherwise the platform ('Darwin', 'Windows', or unsupported).
+    """
+    if BACKEND == 'simulated':
+        return 'Simulated'
+    return platform.system()
+
+
+class SimulatedOutlook:
+    """
+    Stand-in for Outlook automation with a configurable delay and failure
+    rate, so the full attach path can run and be load-tested on any platform.
+    """
+
+    def __init__(self, latency=SIMULATED_LATENCY, jitter=SIMULATED_JITTER,
+                 failure_rate=SIMULATED_FAILURE_RATE, seed=None):
+        self.latency = max(0.0, latency)
+        self.jitter = max(0.0, jitter)
+        self.failure_rate = min(1.0, max(0.0, failure_rate))
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+
+    def attach_files(self, file_paths):
+        """Pretend to open a message with file_paths attached. Returns (success, message)."""
+        self.calls += 1
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, delay))
+        
+        for file_path in file_paths:
+            if not os.path.exists(file_path):
+                self.failures += 1
+                return False, f"File not found: {file_path}"
+        if self._random.random() < self.failure_rate:
+            self.failures += 1
+            return False, "Simulated Outlook failure"
+        return True, f"Simulated Outlook opened with {len(file_paths)} attachment(s)"
+
+    def warm_up(self):
+        """Pretend to start Outlook. Returns (success, message)."""
+        time.sleep(self.latency)
+        return True, "Simulated Outlook is ready"
+
+
+def get_simulated_outlook():
+    """Return the shared SimulatedOutlook (callers hold OUTLOOK_LOCK)."""
+    global _simulated_outlook
+    if _simulated_outlook is None:
+        _simulated_outlook = SimulatedOutlook()
+    return _simulated_outlook
+
+
+def configure_backend(backend, latency=SIMULATED_LATENCY, jitter=SIMULATED_JITTER,
+                      failure_rate=SIMULATED_FAILURE_RATE, seed=None):
+    """Select the automation backend ('outlook' or 'simulated') and its simulation settings."""
+    global BACKEND, _simulated_outlook
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend}")
+    with OUTLOOK_LOCK:
+        BACKEND = backend
+        _simulated_outlook = SimulatedOutlook(latency, jitter, failure_rate, seed)
+
+
+# Worker threads running queued (async) attach jobs, and how many finished
+# jobs are kept for GET /jobs/<id>
+JOB_WORKERS = int(os.environ.get('OUTLOOK_ATTACH_JOB_WORKERS', '2'))
+MAX_FINISHED_JOBS = int(os.environ.get('OUTLOOK_ATTACH_JOB_HISTORY', '500'))
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+# Repeats of an attach (same files, unchanged, same optional requestId)
+# within this many seconds get the original result instead of another copy
+# and Outlook window; 0 turns this off. At most IDEMPOTENCY_MAX_ENTRIES are
+# remembered. A duplicate of a job still under way is answered with 202 and
+# its jobId at once rather than holding a worker until it finishes
+IDEMPOTENCY_WINDOW = float(os.environ.get('OUTLOOK_ATTACH_IDEMPOTENCY_WINDOW', '10'))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get('OUTLOOK_ATTACH_IDEMPOTENCY_ENTRIES', '256'))
+
+_idempotency_cache = None
+_idempotency_cache_lock = threading.Lock()
+
+# /events (Server-Sent Events): events buffered per subscriber before the
+# oldest are dropped, subscriber limit, extra threads the threaded engine
+# sets aside for event streams, and seconds between keep-alive comments
+EVENT_BUFFER_SIZE = int(os.environ.get('OUTLOOK_ATTACH_EVENT_BUFFER', '256'))
+EVENT_MAX_SUBSCRIBERS = int(os.environ.get('OUTLOOK_ATTACH_EVENT_SUBSCRIBERS', '64'))
+EVENT_STREAM_THREADS = int(os.environ.get('OUTLOOK_ATTACH_EVENT_STREAM_THREADS', '8'))
+EVENT_HEARTBEAT = 15
+
+# Request tracing and profiling (off unless configured): JSONL file the
+# per-request trace spans are appended to, and folder keeping cProfile
+# .prof files of the PROFILE_KEEP slowest requests
+TRACE_FILE = os.environ.get('OUTLOOK_ATTACH_TRACE_FILE') or None
+PROFILE_DIR = os.environ.get('OUTLOOK_ATTACH_PROFILE_DIR') or None
+PROFILE_KEEP = int(os.environ.get('OUTLOOK_ATTACH_PROFILE_KEEP', '10'))
+
+# SQLite journal (WAL mode) of every finished attach, queried by GET /history;
+# OUTLOOK_ATTACH_JOURNAL set to an empty value turns it off
+JOURNAL_FILE = os.environ.get(
+    'OUTLOOK_ATTACH_JOURNAL',
+    os.path.join(os.path.expanduser("~"), ".outlook-attach", "journal.db")
+)
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+# Seconds without requests or running jobs after which the server exits, for
+# on-demand use where a supervisor (systemd, launchd or the service stub)
+# holds the listening socket and starts the server again; 0 stays resident
+IDLE_EXIT = float(os.environ.get('OUTLOOK_ATTACH_IDLE_EXIT', '0'))
+
+# Listening socket handed over by a supervisor: systemd passes fds from 3
+# (LISTEN_FDS/LISTEN_PID), launchd by name from the job's Sockets entry, and
+# the service stub as OUTLOOK_ATTACH_LISTEN_FD (an fd, or 'share' for a
+# Windows socket.share() payload on stdin)
+SD_LISTEN_FDS_START = 3
+LAUNCHD_SOCKET_NAME = os.environ.get('OUTLOOK_ATTACH_LAUNCHD_SOCKET', 'Listeners')
+
+_idle_monitor = None
+_idle_monitor_lock = threading.Lock()
+
+# Upper bounds (seconds) of the /metrics latency histogram buckets
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_event_bus = None
+_event_bus_lock = threading.Lock()
+
+
+def get_copy_pool():
+    """Return the shared thread pool used to copy batch files in parallel."""
+    global _copy_pool
+    with _copy_pool_lock:
+        if _copy_pool is None:
+            _copy_pool = ThreadPoolExecutor(max_workers=COPY_WORKERS, thread_name_prefix='attach-copy')
+        return _copy_pool
+
+
+def get_bundle_pool():
+    """Return the shared thread pool used to compress bundle entries in parallel."""
+    global _bundle_pool
+    with _bundle_pool_lock:
+        if _bundle_pool is None:
+            _bundle_pool = ThreadPoolExecutor(max_workers=max(1, BUNDLE_WORKERS), thread_name_prefix='attach-bundle')
+        return _bundle_pool
+
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """
+    HTTP server that hands each connection to a bounded pool of worker threads.
+    One worker is kept free of /attach work so /status stays responsive while
+    Outlook automation is running, and connections beyond the queue limit are
+    answered with 503 instead of piling up. /events streams hold a thread each,
+    so the pool has event_streams extra threads and at most that many streams.
+    """
+
+    def __init__(self, server_address, handler_class, max_workers=MAX_WORKERS,
+                 max_queued=MAX_QUEUED_REQUESTS, event_streams=EVENT_STREAM_THREADS,
+                 bind_and_activate=True, sock=None):
+        self.max_workers = max(2, int(max_workers))
+        event_streams = max(0, int(event_streams))
+        self.attach_slots = threading.BoundedSemaphore(self.max_workers - 1)
+        self.event_slots = threading.BoundedSemaphore(event_streams) if event_streams else None
+        self.event_subscriptions = set()
+        self.request_slots = threading.BoundedSemaphore(
+            self.max_workers + event_streams + max(0, int(max_queued))
+        )
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.max_workers + event_streams,
+            thread_name_prefix='attach-worker'
+        )
+        if sock is None:
+            super().__init__(server_address, handler_class, bind_and_activate)
+        else:
+            # Serve a listening socket handed over by a supervisor
+            super().__init__(server_address, handler_class, bind_and_activate=False)
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+            self.server_name, self.server_port = self.server_address[:2]
+
+    def process_request(self, request, client_address):
+        """Queue the connection for a worker, or reject it when the queue is full."""
+        get_idle_monitor().touch()
+        if not self.request_slots.acquire(blocking=False):
+            try:
+                request.sendall(
+                    b'HTTP/1.0 503 Service Unavailable\r\n'
+                    b'Content-Type: application/json\r\n'
+                    b'Access-Control-Allow-Origin: *\r\n'
+                    b'Retry-After: 1\r\n\r\n'
+                    b'{"success": false, "message": "Server busy"}'
+                )
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        """Serve one connection on a pool thread."""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.request_slots.release()
+
+    def server_close(self):
+        """Close the listening socket, end event streams and let in-flight requests finish."""
+        super().server_close()
+        for subscription in list(self.event_subscriptions):
+            subscription.close()
+        self.pool.shutdown(wait=False)
+
+
+def process_attach_request(body, trace=None):
+    """
+    Handle an /attach request body: {"filePath": ..., "async": false, "requestId": ...}.
+    Runs the pipeline right away, or with "async": true queues it as a job
+    and answers 202 with the job ID. Repeats (same file and requestId) within
+    IDEMPOTENCY_WINDOW get the first request's result. Shared by every server engine.
+    Stage spans are added to trace (a RequestTrace) when one is given.
+    Returns (status_code, response_data, log_entry); log_entry is None on errors.
+    """
+    try:
+        parse_start = time.perf_counter()
+        data = json.loads(body.decode('utf-8'))
+        file_path = data.get('filePath')
+        
+        if not file_path:
+            return 400, error_response_data("Missing filePath in request"), None
+        
+        job = AttachJob('attach', [file_path], trace)
+        job.add_timing('parse', parse_start, time.perf_counter())
+        return run_or_queue_job(job, data)
+        
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return 400, error_response_data("Invalid JSON in request body"), None
+    except Exception as e:
+        return 500, error_response_data(f"Internal server error: {str(e)}"), None
+
+
+def process_attach_batch_request(body, trace=None):
+    """
+    Handle an /attach/batch request body: {"filePaths": [...], "async": false, "requestId": ...}.
+    Returns (status_code, response_data, log_entry) like process_attach_request.
+    """
+    try:
+        parse_start = time.perf_counter()
+        data = json.loads(body.decode('utf-8'))
+        file_paths = data.get('filePaths')
+        
+        if not isinstance(file_paths, list) or not file_paths:
+            return 400, error_response_data("Missing filePaths list in request"), None
+        if not all(isinstance(p, str) and p for p in file_paths):
+            return 400, error_response_data("filePaths must be a list of file paths"), None
+        if len(file_paths) > MAX_BATCH_FILES:
+            return 400, error_response_data(f"Too many files in batch (max {MAX_BATCH_FILES})"), None
+        
+        bundle = data.get('bundle')
+        if bundle is not None and not isinstance(bundle, bool):
+            return 400, error_response_data("bundle must be true, false or left out"), None
+        
+        job = AttachJob('batch', file_paths, trace)
+        job.bundle = bundle
+        job.add_timing('parse', parse_start, time.perf_counter())
+        return run_or_queue_job(job, data)
+        
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return 400, error_response_data("Invalid JSON in request body"), None
+    except Exception as e:
+        return 500, error_response_data(f"Internal server error: {str(e)}"), None
+
+
+Upload = namedtuple('Upload', 'path name sha256 size started finished')
+
+
+class UploadError(Exception):
+    """An /attach/upload request that cannot be accepted; carries the HTTP status."""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UploadReceiver:
+    """
+    Streams an /attach/upload body into businessnxtdocs/.uploads in chunks,
+    hashing it on the way, so memory use does not grow with the file size.
+    The received file is on the same volume as the store, so keeping it is a
+    rename, not another copy. Engines feed it with write() (or receive() for
+    a blocking stream) and then call finish().
+    """
+
+    dir_name = '.uploads'
+
+    def __init__(self, name, length, expected_sha256=None, max_bytes=None):
+        self.name = os.path.basename((name or '').replace('\\', '/')).strip()
+        if not self.name:
+            raise UploadError(400, "Missing name for upload")
+        if length is None:
+            raise UploadError(411, "Content-Length required for upload")
+        if length < 0:
+            raise UploadError(400, "Invalid Content-Length")
+        max_bytes = UPLOAD_MAX_BYTES if max_bytes is None else max_bytes
+        if length > max_bytes:
+            raise UploadError(413, f"Upload too large: {length} bytes (limit {max_bytes})")
+        self.length = length
+        self.expected_sha256 = expected_sha256.lower() if expected_sha256 else None
+        self.received = 0
+        self.started = time.perf_counter()
+        upload_dir = os.path.join(get_businessnxtdocs_dir(), self.dir_name)
+        os.makedirs(upload_dir, exist_ok=True)
+        self.path = os.path.join(upload_dir, f"{uuid.uuid4().hex}.part")
+        self._file = open(self.path, 'xb')
+        self._digest = hashlib.sha256()
+
+    @property
+    def remaining(self):
+        return self.length - self.received
+
+    def write(self, chunk):
+        """Append one chunk of the body."""
+        try:
+            self._file.write(chunk)
+        except OSError as e:
+            self.abort()
+            raise UploadError(500, f"Error writing upload: {e}")
+        self._digest.update(chunk)
+        self.received += len(chunk)
+
+    def receive(self, read):
+        """Read the rest of the body with read(size) from a blocking stream, then finish()."""
+        try:
+            while self.remaining:
+                chunk = read(min(UPLOAD_CHUNK_SIZE, self.remaining))
+                if not chunk:
+                    break
+                self.write(chunk)
+        except (OSError, ValueError) as e:
+            self.abort()
+            raise UploadError(400, f"Upload interrupted: {e}")
+        return self.finish()
+
+    def finish(self):
+        """Close the file and check its length and checksum. Returns an Upload."""
+        self._file.close()
+        if self.received != self.length:
+            self.abort()
+            raise UploadError(400, f"Upload incomplete: {self.received} of {self.length} bytes")
+        digest = self._digest.hexdigest()
+        if self.expected_sha256 and self.expected_sha256 != digest:
+            self.abort()
+            raise UploadError(400, "Upload checksum mismatch")
+        return Upload(self.path, self.name, digest, self.received, self.started, time.perf_counter())
+
+    def abort(self):
+        """Drop the partial file."""
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def start_upload(path, content_length):
+    """
+    Parse an /attach/upload request target (?name=...&requestId=...&async=1&sha256=...)
+    and open a receiver for its body. Returns (UploadReceiver, params);
+    raises UploadError when the upload is refused.
+    """
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+    params = {key: values[-1] for key, values in query.items()}
+    receiver = UploadReceiver(params.get('name'), content_length, params.get('sha256'))
+    return receiver, params
+
+
+def process_upload_request(body, trace=None):
+    """
+    Handle a received /attach/upload: body is (Upload, params), params being
+    the query string. Runs the /attach pipeline on the received file, now or
+    as a queued job with async=1. Shared by every server engine.
+    Returns (status_code, response_data, log_entry); log_entry is None on errors.
+    """
+    upload, params = body
+    try:
+        job = AttachJob('upload', [upload.path], trace)
+        job.set_upload(upload)
+        job.add_timing('receive', upload.started, upload.finished)
+        data = {
+            'requestId': params.get('requestId'),
+            'async': params.get('async', '').lower() in ('1', 'true'),
+        }
+        return run_or_queue_job(job, data)
+    except Exception as e:
+        return 500, error_response_data(f"Internal server error: {str(e)}"), None
+
+
+def run_or_queue_job(job, data, duplicate_window=None):
+    """
+    Run job now, or queue it and answer 202 when the request asked for "async".
+    A repeat of a recent request is answered from the original job instead;
+    duplicate_window overrides how long this job is remembered for that.
+    """
+    original = get_idempotency_cache().claim(job, data.get('requestId'), window=duplicate_window)
+    if original is not None:
+        return duplicate_job_response(original, job, data)
+    
+    if data.get('async'):
+        # The request's trace ends with the 202; the job gets a trace of its own
+        if job.trace is not None:
+            job.trace.attributes['jobId'] = job.id
+        job.trace = RequestTrace(f"job:{job.kind}", trace_id=job.id, start=job._created)
+        get_job_manager().submit(job)
         response_data = {
-            'success': False,
-            'message': message
+            'success': True,
+            'message': "Attach queued",
+            'jobId': job.id,
+            'state': job.state,
+            'location': f"/jobs/{job.id}"
+        }
+        return 202, response_data, f"Queued {job.kind} job {job.id} ({len(job.file_paths)} files)"
+    job.run()
+    return job.status_code, job.result, job.log_entry
+
+
+def duplicate_job_response(original, job, data):
+    """Answer a repeated request with the original job's result, or 202 and its jobId while it runs."""
+    get_metrics().inc('outlook_attach_duplicates_total', kind=job.kind)
+    job.discard_upload()
+    if job.trace is not None:
+        job.trace.attributes['duplicateOf'] = original.id
+    log_entry = f"Duplicate {job.kind} request answered from job {original.id}"
+    if data.get('async') or not original.wait(0):
+        get_job_manager().track(original)
+        response_data = {
+            'success': True,
+            'message': "Same attach already requested",
+            'jobId': original.id,
+            'state': original.state,
+            'location': f"/jobs/{original.id}",
+            'duplicate': True
+        }
+        return 202, response_data, log_entry
+    return original.status_code, dict(original.result, duplicate=True), log_entry
+
+
+class IdempotencyCache:
+    """
+    Short-lived memory of attach jobs keyed by the files' identity (real
+    path, size, mtime), so double clicks, repeated download events and the
+    downloads watcher do not open Outlook twice for one file. Uploads are
+    keyed by name, content hash and the client's optional requestId.
+    Entries expire after `window` seconds (or the window given to claim),
+    the oldest are evicted beyond max_entries, and failed or cancelled jobs
+    do not suppress a retry.
+    """
+
+    def __init__(self, window=IDEMPOTENCY_WINDOW, max_entries=IDEMPOTENCY_MAX_ENTRIES):
+        self.window = window
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, job, request_id=None):
+        """Return the cache key for job, or None if a file cannot be stat'ed."""
+        if job.upload is not None:
+            # Every upload is a new file; its name and content identify it
+            return (job.kind, str(request_id) if request_id is not None else '',
+                    f"{job.upload.name}|{job.upload.sha256}")
+        # A file on disk is identified by itself, whoever asks for it: the
+        # watcher sends no requestId, the extension sends its downloadId
+        parts = [job.kind]
+        for file_path in job.file_paths:
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                return None
+            parts.append(f"{os.path.realpath(file_path)}|{st.st_size}|{st.st_mtime_ns}")
+        return tuple(parts)
+
+    def claim(self, job, request_id=None, now=None, window=None):
+        """
+        Return the still-valid original job for a repeat of this request, or
+        remember job as the original (for window seconds, default self.window)
+        and return None.
+        """
+        if self.window <= 0:
+            return None
+        key = self.key(job, request_id)
+        if key is None:
+            return None
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            # Entries are kept in insertion order, which is expiry order for
+            # entries with the default window; longer ones are checked below
+            while self._entries:
+                oldest_key, (expires, _) = next(iter(self._entries.items()))
+                if expires > now:
+                    break
+                del self._entries[oldest_key]
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now and entry[1].state not in ('failed', 'cancelled'):
+                return entry[1]
+            self._entries.pop(key, None)
+            self._entries[key] = (now + (self.window if window is None else window), job)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def get_idempotency_cache():
+    """Return the shared IdempotencyCache."""
+    global _idempotency_cache
+    with _idempotency_cache_lock:
+        if _idempotency_cache is None:
+            _idempotency_cache = IdempotencyCache()
+        return _idempotency_cache
+
+
+def deflate_to_file(source_path, target_path, level=None, chunk_size=1024 * 1024):
+    """
+    Raw-deflate source_path into target_path, chunk by chunk, as the data of
+    a zip entry. Returns (crc32, size, compressed_size).
+    """
+    import zlib
+    compressor = zlib.compressobj(BUNDLE_LEVEL if level is None else level, zlib.DEFLATED, -15)
+    crc = size = compressed_size = 0
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            target.write(data)
+            compressed_size += len(data)
+        data = compressor.flush()
+        target.write(data)
+        compressed_size += len(data)
+    return crc, size, compressed_size
+
+
+class ZipWriter:
+    """
+    Writes a zip archive from entries compressed elsewhere, copying each
+    entry's data from a file in chunks, so memory use does not depend on the
+    archive size. Names are stored as UTF-8. There is no ZIP64 support, so
+    an archive must stay under 4 GiB and 65535 entries.
+    """
+
+    STORED = 0
+    DEFLATED = 8
+    max_offset = 0xFFFFFFFF
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'xb')
+        self._entries = []
+
+    def add(self, name, data_path, method, crc, size, compressed_size, mtime):
+        """Append an entry whose (already compressed) data is in data_path."""
+        offset = self._file.tell()
+        if offset + compressed_size + 1024 > self.max_offset or len(self._entries) >= 0xFFFF:
+            raise ValueError("Bundle too large for a zip without ZIP64")
+        encoded_name = name.encode('utf-8')
+        local = time.localtime(mtime)
+        dos_time = (local.tm_hour << 11) | (local.tm_min << 5) | (local.tm_sec // 2)
+        dos_date = ((max(local.tm_year, 1980) - 1980) << 9) | (local.tm_mon << 5) | local.tm_mday
+        # Version 2.0 needed, flag bit 11: the name is UTF-8
+        fields = (method, dos_time, dos_date, crc, compressed_size, size, len(encoded_name))
+        self._file.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x0800, *fields, 0) + encoded_name)
+        with open(data_path, 'rb') as data:
+            shutil.copyfileobj(data, self._file, 1024 * 1024)
+        self._entries.append((encoded_name, fields, offset))
+
+    def close(self):
+        """Write the central directory and close the archive."""
+        start = self._file.tell()
+        for encoded_name, fields, offset in self._entries:
+            self._file.write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x0800,
+                                         *fields, 0, 0, 0, 0, 0, offset) + encoded_name)
+        end = self._file.tell()
+        count = len(self._entries)
+        self._file.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, end - start, start, 0))
+        self._file.close()
+
+    def abort(self):
+        """Close and delete an unfinished archive."""
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+BundleResult = namedtuple('BundleResult', 'path files bytes compressed_bytes seconds')
+
+
+def bundle_files(file_paths, base_name):
+    """
+    Zip file_paths (under their base names) into a new <base_name>-... .zip
+    next to them. Entries are deflated in parallel on the bundle pool into
+    temporary files and streamed into the archive in order as each one
+    finishes; entries that would not shrink are stored as they are.
+    Returns a BundleResult.
+    """
+    start = time.perf_counter()
+    directory = os.path.dirname(file_paths[0])
+    work_dir = os.path.join(directory, '.bundles', uuid.uuid4().hex)
+    os.makedirs(work_dir)
+    try:
+        while True:
+            try:
+                writer = ZipWriter(os.path.join(directory, unique_document_name(base_name, '.zip')))
+                break
+            except FileExistsError:
+                continue
+        pool = get_bundle_pool()
+        parts = [os.path.join(work_dir, f"{index}.deflate") for index in range(len(file_paths))]
+        futures = [pool.submit(deflate_to_file, path, part) for path, part in zip(file_paths, parts)]
+        try:
+            total = 0
+            for path, part, future in zip(file_paths, parts, futures):
+                crc, size, compressed_size = future.result()
+                mtime = os.stat(path).st_mtime
+                if compressed_size < size:
+                    writer.add(os.path.basename(path), part, ZipWriter.DEFLATED, crc, size, compressed_size, mtime)
+                else:
+                    writer.add(os.path.basename(path), path, ZipWriter.STORED, crc, size, size, mtime)
+                os.remove(part)
+                total += size
+            writer.close()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            writer.abort()
+            raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return BundleResult(writer.path, len(file_paths), total, os.path.getsize(writer.path),
+                        time.perf_counter() - start)
+
+
+def should_bundle(file_paths, requested=None):
+    """Return True if these files should go out as one zip (requested: the request's "bundle")."""
+    if requested is not None:
+        return requested and len(file_paths) > 1
+    if len(file_paths) < 2:
+        return False
+    if BUNDLE_MIN_FILES and len(file_paths) >= BUNDLE_MIN_FILES:
+        return True
+    return bool(BUNDLE_MIN_BYTES) and sum(os.path.getsize(p) for p in file_paths) >= BUNDLE_MIN_BYTES
+
+
+def attach_single_file(job):
+    """
+    The /attach pipeline: copy the file into businessnxtdocs, then open it in Outlook.
+    Returns (status_code, response_data, log_entry).
+    """
+    file_path = job.file_paths[0]
+    
+    copy_info = {}
+    with job.stage('copy'):
+        unique_file_path, copy_error = create_unique_file_copy(file_path, copy_info, job.upload)
+    job.discard_upload()
+    if not unique_file_path:
+        return 500, error_response_data(copy_error or "Failed to create unique file copy"), None
+    job.document_type = copy_info['documentType']
+    job.timings['classify'] = copy_info.pop('classifySeconds')
+    job.publish('copied', timings=dict(job.timings), documentTypes=[job.document_type])
+    
+    file_to_attach = unique_file_path
+    
+    system = get_attach_system()
+    if system not in ('Darwin', 'Windows', 'Simulated'):
+        return 400, error_response_data(f"Unsupported platform: {system}"), None
+    
+    job.publish('automation', files=[file_to_attach])
+    with IN_FLIGHT.pinned([file_to_attach]), job.stage('automation'):
+        success, message = attach_to_outlook(system, file_to_attach)
+    
+    response_data = {
+        'success': success,
+        'message': message,
+        'uniquePath': unique_file_path,
+        'documentType': copy_info.pop('documentType'),
+        'copy': copy_info
+    }
+    
+    status = "Success" if success else "Failed"
+    original_filename = job.upload.name if job.upload is not None else os.path.basename(file_path)
+    unique_filename = os.path.basename(file_to_attach)
+    log_entry = (f"Attached file: {original_filename} (unique: {unique_filename}, "
+                 f"copy: {copy_info['strategy']} {copy_info['seconds'] * 1000:.1f} ms) - {status}: {success}")
+    return 200, response_data, log_entry
+
+
+def attach_file_batch(job):
+    """
+    The /attach/batch pipeline: copy every file in parallel, then attach all
+    copies to one Outlook message with a single automation call.
+    Returns (status_code, response_data, log_entry).
+    """
+    file_paths = job.file_paths
+    
+    system = get_attach_system()
+    if system not in ('Darwin', 'Windows', 'Simulated'):
+        return 400, error_response_data(f"Unsupported platform: {system}"), None
+    
+    copy_infos = [{} for _ in file_paths]
+    with job.stage('copy'):
+        copies = list(get_copy_pool().map(create_unique_file_copy, file_paths, copy_infos))
+    
+    results = []
+    files_to_attach = []
+    for file_path, copy_info, (unique_file_path, copy_error) in zip(file_paths, copy_infos, copies):
+        if unique_file_path:
+            files_to_attach.append(unique_file_path)
+            job.timings['classify'] = job.timings.get('classify', 0) + copy_info.pop('classifySeconds')
+            results.append({
+                'filePath': file_path,
+                'uniquePath': unique_file_path,
+                'documentType': copy_info.pop('documentType'),
+                'copy': copy_info
+            })
+        else:
+            results.append({
+                'filePath': file_path,
+                'success': False,
+                'message': copy_error or "Failed to create unique file copy"
+            })
+    
+    if not files_to_attach:
+        response_data = error_response_data("No files could be copied")
+        response_data['results'] = results
+        return 500, response_data, None
+    document_types = [r['documentType'] for r in results if 'documentType' in r]
+    job.document_type = document_types[0] if len(set(document_types)) == 1 else 'mixed'
+    job.publish('copied', timings=dict(job.timings), documentTypes=document_types)
+    
+    bundle = None
+    if should_bundle(files_to_attach, job.bundle):
+        base_name = job.document_type if job.document_type != 'mixed' else 'Dokument'
+        with job.stage('bundle'):
+            try:
+                bundle = bundle_files(files_to_attach, base_name)
+            except (OSError, ValueError) as e:
+                log_to_stderr(f"Could not bundle job {job.id}, attaching the files separately: {e}")
+        if bundle is not None:
+            files_to_attach = [bundle.path]
+    
+    job.publish('automation', files=files_to_attach)
+    with IN_FLIGHT.pinned(files_to_attach), job.stage('automation'):
+        success, message = attach_files_to_outlook(system, files_to_attach)
+    for result in results:
+        if 'uniquePath' in result:
+            result['success'] = success
+            result['message'] = message
+    
+    attached = sum(1 for r in results if r['success'])
+    if success and attached < len(file_paths):
+        message = f"Outlook opened with {attached} of {len(file_paths)} files attached"
+    response_data = {
+        'success': attached == len(file_paths),
+        'message': message,
+        'results': results
+    }
+    
+    status = "Success" if success else "Failed"
+    if bundle is not None:
+        ratio = bundle.compressed_bytes / bundle.bytes if bundle.bytes else 1.0
+        response_data['bundle'] = {
+            'path': bundle.path,
+            'files': bundle.files,
+            'bytes': bundle.bytes,
+            'compressedBytes': bundle.compressed_bytes,
+            'ratio': round(ratio, 4),
+            'seconds': bundle.seconds
+        }
+        log_entry = (f"Attached {bundle.files} of {len(file_paths)} files as {os.path.basename(bundle.path)} "
+                     f"({bundle.bytes / (1024 * 1024):.1f} MB → {bundle.compressed_bytes / (1024 * 1024):.1f} MB, "
+                     f"{ratio:.0%}, {bundle.seconds * 1000:.0f} ms) - {status}: {success}")
+    else:
+        log_entry = f"Attached {len(files_to_attach)} of {len(file_paths)} files in one message - {status}: {success}"
+    return 200, response_data, log_entry
+
+
+class AttachJob:
+    """
+    One attach (single file or batch) with its state, per-stage timings and
+    result. Synchronous requests run a job inline; asynchronous ones are
+    queued on the JobManager and can be polled or cancelled via /jobs/<id>.
+    States: queued → running → succeeded | failed, or queued → cancelled.
+    """
+
+    pipelines = {
+        'attach': attach_single_file,
+        'batch': attach_file_batch,
+        'upload': attach_single_file,
+    }
+
+    def __init__(self, kind, file_paths, trace=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.file_paths = list(file_paths)
+        self.document_type = 'unknown'
+        self.upload = None
+        self._upload_pinned = False
+        self.bundle = None
+        self.trace = trace
+        self.state = 'queued'
+        self.created_at = time.time()
+        self._created = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+        self.timings = {}
+        self.status_code = None
+        self.result = None
+        self.log_entry = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a pipeline stage into timings[name] (seconds) and the trace."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_timing(name, start, time.perf_counter())
+
+    def add_timing(self, name, start, end):
+        """Record a stage that ran from start to end (perf_counter values)."""
+        self.timings[name] = end - start
+        if self.trace is not None:
+            self.trace.add_span(name, start, end)
+
+    def start(self):
+        """Move queued → running; returns False if the job was cancelled first."""
+        with self._lock:
+            if self.state != 'queued':
+                return False
+            self.state = 'running'
+            self.started_at = time.time()
+            self.add_timing('queue', self._created, time.perf_counter())
+        self.publish('started', files=self.file_paths)
+        return True
+
+    def cancel(self):
+        """Move queued → cancelled; returns False once the job has started."""
+        with self._lock:
+            if self.state != 'queued':
+                return False
+            self.state = 'cancelled'
+            self.finished_at = time.time()
+            self.status_code = 409
+            self.result = error_response_data("Cancelled before it started")
+        self._done.set()
+        self.publish('cancelled')
+        self.discard_upload()
+        return True
+
+    def set_upload(self, upload):
+        """Take over a received upload, pinned against the retention sweeper until discarded."""
+        IN_FLIGHT.pin([upload.path])
+        self.upload = upload
+        self._upload_pinned = True
+
+    def discard_upload(self):
+        """Remove an uploaded file that was not (or not yet) moved into the store, and unpin it."""
+        with self._lock:
+            pinned, self._upload_pinned = self._upload_pinned, False
+        if self.upload is not None and os.path.exists(self.upload.path):
+            try:
+                os.remove(self.upload.path)
+            except OSError:
+                pass
+        if pinned:
+            IN_FLIGHT.unpin([self.upload.path])
+
+    def wait(self, timeout=None):
+        """Wait until the job has finished or was cancelled; returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def publish(self, event_type, **fields):
+        """Publish a lifecycle event for this job on the shared EventBus."""
+        get_event_bus().publish(event_type, jobId=self.id, kind=self.kind, **fields)
+
+    def run(self):
+        """Run the pipeline for this job and record its outcome."""
+        with self._lock:
+            state = self.state
+        # start() re-checks under the lock, so a cancel in between wins; a job
+        # that was cancelled or has already finished is not run again
+        if state == 'queued':
+            if not self.start():
+                return
+        elif state != 'running':
+            return
+        start = time.perf_counter()
+        try:
+            status_code, result, log_entry = self.pipelines[self.kind](self)
+        except Exception as e:
+            status_code, result, log_entry = 500, error_response_data(f"Internal server error: {str(e)}"), None
+        # The pipeline normally discards the upload after its copy stage
+        self.discard_upload()
+        self.timings['total'] = time.perf_counter() - start
+        with self._lock:
+            self.status_code, self.result, self.log_entry = status_code, result, log_entry
+            self.finished_at = time.time()
+            self.state = 'succeeded' if status_code == 200 and result.get('success') else 'failed'
+        self._done.set()
+        get_metrics().record_job(self)
+        journal = get_attach_journal()
+        if journal is not None:
+            journal.record(self)
+        if self.trace is not None:
+            self.trace.attributes.update(jobId=self.id, documentType=self.document_type,
+                                         files=len(self.file_paths), state=self.state)
+        self.publish('done' if self.state == 'succeeded' else 'failed',
+                     statusCode=status_code, timings=dict(self.timings), result=result)
+
+    def to_dict(self):
+        """Return the job as JSON-friendly data for GET /jobs/<id>."""
+        # Under the lock so state, result and finishedAt come from the same transition
+        with self._lock:
+            return {
+                'jobId': self.id,
+                'kind': self.kind,
+                'state': self.state,
+                'files': self.file_paths,
+                'documentType': self.document_type,
+                'createdAt': self.created_at,
+                'startedAt': self.started_at,
+                'finishedAt': self.finished_at,
+                'timings': dict(self.timings),
+                'statusCode': self.status_code,
+                'result': self.result,
+            }
+
+
+class JobManager:
+    """
+    Queue and worker threads for asynchronous attach jobs. Finished jobs are
+    kept (up to max_finished) so clients can still fetch their result.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_finished=MAX_FINISHED_JOBS, log=None):
+        self.workers = max(1, int(workers))
+        self.max_finished = max_finished
+        self.log = log
+        self._jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        """Queue a job and start the workers on first use."""
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+        job.publish('queued', files=job.file_paths)
+        with self._lock:
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._work, name=f'attach-job-{i}', daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+        self._queue.put(job)
+
+    def track(self, job):
+        """Make a job (e.g. one run synchronously) available to GET /jobs/<id>."""
+        with self._lock:
+            if job.id not in self._jobs:
+                self._jobs[job.id] = job
+                self._prune()
+
+    def get(self, job_id):
+        """Return the job with job_id, or None."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a queued job. Returns (job, cancelled); job is None if unknown."""
+        job = self.get(job_id)
+        if job is None:
+            return None, False
+        return job, job.cancel()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if not job.start():
+                continue
+            with get_idle_monitor().busy():
+                profiler = get_profiler()
+                if profiler is not None:
+                    profiler.run(job.id, job.run)
+                else:
+                    job.run()
+            if job.trace is not None:
+                job.trace.finish(job.status_code)
+            log = self.log or log_to_stderr
+            if job.log_entry:
+                log(f"Job {job.id}: {job.log_entry}")
+            else:
+                log(f"Job {job.id} failed: {job.result.get('message')}")
+
+
+def get_job_manager():
+    """Return the shared JobManager."""
+    global _job_manager
+    with _job_manager_lock:
+        if _job_manager is None:
+            _job_manager = JobManager()
+        return _job_manager
+
+
+class EventSubscription:
+    """
+    One /events subscriber's bounded event buffer. When the buffer is full the
+    oldest event is dropped and counted, so publishing never waits on a slow
+    reader. wakeup, if set, is called from the publishing thread after each event.
+    """
+
+    def __init__(self, bus, max_events=EVENT_BUFFER_SIZE, wakeup=None):
+        self.bus = bus
+        self.events = deque(maxlen=max(1, max_events))
+        self.dropped = 0
+        self.closed = False
+        self.wakeup = wakeup
+        self._ready = threading.Condition()
+
+    def push(self, event):
+        """Buffer an event, dropping the oldest one if the buffer is full."""
+        with self._ready:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+            self._ready.notify()
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def drain(self):
+        """Return and clear the buffered events, led by a 'dropped' event if any were lost."""
+        with self._ready:
+            events = list(self.events)
+            self.events.clear()
+            if self.dropped:
+                events.insert(0, {'event': 'dropped', 'count': self.dropped})
+                self.dropped = 0
+        return events
+
+    def wait(self, timeout=None):
+        """Block until events arrive, the timeout passes or the subscription closes; then drain."""
+        with self._ready:
+            if not self.events and not self.closed:
+                self._ready.wait(timeout)
+        return self.drain()
+
+    def close(self):
+        """Unsubscribe and wake any reader blocked in wait()."""
+        self.bus.unsubscribe(self)
+        with self._ready:
+            self.closed = True
+            self._ready.notify_all()
+        if self.wakeup is not None:
+            self.wakeup()
+
+
+class EventBus:
+    """
+    Fan-out of job lifecycle events to /events subscribers and in-process
+    listeners such as the launcher. The subscriber tuple is replaced on
+    (un)subscribe, so publish() only touches the subscribers' own buffers.
+    """
+
+    def __init__(self, max_subscribers=EVENT_MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self._subscribers = ()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+
+    def subscribe(self, max_events=EVENT_BUFFER_SIZE, wakeup=None):
+        """Return a new EventSubscription, or None when the subscriber limit is reached."""
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscription = EventSubscription(self, max_events, wakeup)
+            self._subscribers += (subscription,)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        """Remove a subscription; unknown subscriptions are ignored."""
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscription)
+
+    def publish(self, event_type, **fields):
+        """Send an event to every subscriber. Never blocks on a subscriber."""
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        event = dict(fields, event=event_type, id=next(self._ids), time=time.time())
+        for subscription in subscribers:
+            subscription.push(event)
+
+
+def get_event_bus():
+    """Return the shared EventBus."""
+    global _event_bus
+    with _event_bus_lock:
+        if _event_bus is None:
+            _event_bus = EventBus()
+        return _event_bus
+
+
+def format_event(event):
+    """Encode an event as a Server-Sent Events message."""
+    lines = []
+    if 'id' in event:
+        lines.append(f"id: {event['id']}")
+    lines.append(f"event: {event['event']}")
+    lines.append(f"data: {json.dumps(event, ensure_ascii=False)}")
+    return ("\n".join(lines) + "\n\n").encode('utf-8')
+
+
+# No Access-Control-Allow-Origin: the stream carries every job's files and
+# results, so only the extension (through its host permission) may read it
+EVENT_STREAM_HEADERS = [
+    ('Content-Type', 'text/event-stream; charset=utf-8'),
+    ('Cache-Control', 'no-cache'),
+]
+
+
+class RequestTrace:
+    """
+    Timed spans of one attach request (or queued job). Finished traces are
+    appended to the trace file as JSON lines; server_timing() renders the
+    spans for the Server-Timing response header.
+    """
+
+    def __init__(self, route, trace_id=None, start=None):
+        now = time.perf_counter()
+        self.id = trace_id or uuid.uuid4().hex
+        self.route = route
+        self.started_at = time.time() - (now - start if start is not None else 0)
+        self.status_code = None
+        self.attributes = {}
+        self.spans = []
+        self._start = start if start is not None else now
+
+    def add_span(self, name, start, end):
+        """Add a span that ran from start to end (perf_counter values)."""
+        self.spans.append((name, start - self._start, end - start))
+
+    def server_timing(self):
+        """Return the spans so far as a Server-Timing header value."""
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, _, seconds in self.spans]
+        parts.append(f"total;dur={(time.perf_counter() - self._start) * 1000:.1f}")
+        return ", ".join(parts)
+
+    def finish(self, status_code):
+        """End the trace and hand it to the trace writer, if tracing is on."""
+        self.status_code = status_code
+        writer = get_trace_writer()
+        if writer is not None:
+            writer.write(self.to_dict())
+
+    def to_dict(self):
+        """Return the trace as one JSON-friendly record."""
+        return {
+            'traceId': self.id,
+            'route': self.route,
+            'start': datetime.fromtimestamp(self.started_at).isoformat(),
+            'durationMs': round((time.perf_counter() - self._start) * 1000, 3),
+            'statusCode': self.status_code,
+            'attributes': self.attributes,
+            'spans': [
+                {'name': name, 'startMs': round(offset * 1000, 3), 'durationMs': round(seconds * 1000, 3)}
+                for name, offset, seconds in self.spans
+            ],
+        }
+
+
+class TraceWriter:
+    """
+    Appends finished traces to a JSONL file. Writing happens on a background
+    thread, so a slow disk never delays a response.
+    """
+
+    def __init__(self, path, log=None):
+        self.path = path
+        self.log = log
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        """Queue a trace record for writing."""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+                    self._thread.start()
+        self._queue.put(record)
+
+    def close(self):
+        """Write out queued records and stop the writer thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while len(records) < 100:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in records
+            lines = ''.join(json.dumps(r, ensure_ascii=False) + "\n" for r in records if r is not None)
+            try:
+                if lines:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                    with open(self.path, 'a', encoding='utf-8') as trace_file:
+                        trace_file.write(lines)
+            except OSError as e:
+                (self.log or log_to_stderr)(f"Could not write trace file {self.path}: {e}")
+            if stop:
+                return
+
+
+class AttachJournal:
+    """
+    Durable record of finished attaches, one row per file, in an SQLite
+    database in WAL mode. record() only queues the job; a background thread
+    writes queued jobs in batches, one transaction each, so attaches never
+    wait on the disk. Queries use a connection per thread and, thanks to WAL,
+    run alongside the writer. Rows are listed newest first and paged by
+    keyset (the last row's finish time and id), so every filter walks one
+    index in order and pages stay fast however large the journal grows.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS attaches (
+            id INTEGER PRIMARY KEY,
+            finished_at REAL NOT NULL,
+            job_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            original_path TEXT,
+            original_name TEXT,
+            stored_name TEXT,
+            document_type TEXT,
+            sha256 TEXT,
+            bytes INTEGER,
+            copy_strategy TEXT,
+            outcome TEXT NOT NULL,
+            message TEXT,
+            timings TEXT
+        );
+        CREATE INDEX IF NOT EXISTS attaches_finished ON attaches (finished_at, original_name, stored_name);
+        CREATE INDEX IF NOT EXISTS attaches_type ON attaches (document_type, finished_at);
+        CREATE INDEX IF NOT EXISTS attaches_outcome ON attaches (outcome, finished_at);
+        CREATE INDEX IF NOT EXISTS attaches_sha256 ON attaches (sha256);
+        CREATE INDEX IF NOT EXISTS attaches_job ON attaches (job_id);
+    """
+
+    columns = ('id', 'finished_at', 'job_id', 'kind', 'original_path', 'original_name', 'stored_name',
+               'document_type', 'sha256', 'bytes', 'copy_strategy', 'outcome', 'message', 'timings')
+
+    max_batch = 500
+
+    def __init__(self, path, log=None):
+        self.path = path
+        self.log = log
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def record(self, job):
+        """Queue a finished job for writing."""
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='attach-journal', daemon=True)
+                    self._thread.start()
+        self._queue.put(job)
+
+    def close(self):
+        """Write out queued jobs and stop the writer thread."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def query(self, document_type=None, outcome=None, text=None, sha256=None, job_id=None,
+              since=None, until=None, limit=HISTORY_PAGE_SIZE, before=None):
+        """
+        Return (entries, next_cursor) for the rows matching every given
+        filter, newest first. text matches the original or stored file name;
+        since and until are Unix times. Pass next_cursor as before to get the
+        next page; it is None on the last page.
+        """
+        clauses = []
+        args = []
+        for column, value in (('document_type', document_type), ('outcome', outcome),
+                              ('sha256', sha256), ('job_id', job_id)):
+            if value:
+                clauses.append(f"{column} = ?")
+                args.append(value)
+        if text:
+            pattern = '%' + re.sub(r'([\\%_])', r'\\\1', text) + '%'
+            clauses.append("(original_name LIKE ? ESCAPE '\\' OR stored_name LIKE ? ESCAPE '\\')")
+            args += [pattern, pattern]
+        if since is not None:
+            clauses.append("finished_at >= ?")
+            args.append(since)
+        if until is not None:
+            clauses.append("finished_at < ?")
+            args.append(until)
+        if before is not None:
+            clauses.append("(finished_at, id) < (SELECT finished_at, id FROM attaches WHERE id = ?)")
+            args.append(before)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = self._connection().execute(
+            f"SELECT {', '.join(self.columns)} FROM attaches{where} ORDER BY finished_at DESC, id DESC LIMIT ?",
+            args + [limit + 1]
+        ).fetchall()
+        entries = [self._entry(row) for row in rows[:limit]]
+        return entries, (entries[-1]['id'] if len(rows) > limit else None)
+
+    def _entry(self, row):
+        values = dict(zip(self.columns, row))
+        return {
+            'id': values['id'],
+            'finishedAt': datetime.fromtimestamp(values['finished_at']).isoformat(timespec='seconds'),
+            'jobId': values['job_id'],
+            'kind': values['kind'],
+            'originalPath': values['original_path'],
+            'originalName': values['original_name'],
+            'storedName': values['stored_name'],
+            'documentType': values['document_type'],
+            'sha256': values['sha256'],
+            'bytes': values['bytes'],
+            'copyStrategy': values['copy_strategy'],
+            'outcome': values['outcome'],
+            'message': values['message'],
+            'timings': json.loads(values['timings']) if values['timings'] else {},
         }
+
+    def _connect(self):
+        import sqlite3
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(self.schema)
+        return connection
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def _rows(self, job):
+        """Build the rows for a finished job: one per file, copied or not."""
+        result = job.result or {}
+        timings = json.dumps({stage: round(seconds, 6) for stage, seconds in job.timings.items()})
+        if job.kind == 'batch':
+            files = result.get('results') or [{'filePath': path} for path in job.file_paths]
+        else:
+            files = [dict(result, filePath=job.file_paths[0])]
+        rows = []
+        for file in files:
+            original_path = file.get('filePath')
+            if job.upload is not None:
+                original_path, original_name = None, job.upload.name
+            else:
+                original_name = os.path.basename(original_path) if original_path else None
+            stored_path = file.get('uniquePath')
+            copy_info = file.get('copy') or {}
+            success = file.get('success', result.get('success'))
+            rows.append((
+                job.finished_at, job.id, job.kind, original_path, original_name,
+                os.path.basename(stored_path) if stored_path else None,
+                file.get('documentType'), self._hash(job, stored_path) if stored_path else None,
+                copy_info.get('bytes'), copy_info.get('strategy'),
+                'succeeded' if success else 'failed', file.get('message', result.get('message')), timings
+            ))
+        return rows
+
+    def _hash(self, job, stored_path):
+        """Content hash of a stored copy, from the upload or store when known."""
+        if job.upload is not None:
+            return job.upload.sha256
+        if DEDUP_ENABLED:
+            digest = get_document_store(os.path.dirname(stored_path)).hash_of(os.path.basename(stored_path))
+            if digest:
+                return digest
+        try:
+            return hash_file(stored_path)
+        except OSError:
+            return None
+
+    def _run(self):
+        connection = None
+        while True:
+            jobs = [self._queue.get()]
+            while len(jobs) < self.max_batch:
+                try:
+                    jobs.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in jobs
+            try:
+                rows = [row for job in jobs if job is not None for row in self._rows(job)]
+                if rows:
+                    if connection is None:
+                        connection = self._connect()
+                    with connection:
+                        connection.executemany(
+                            f"INSERT INTO attaches ({', '.join(self.columns[1:])}) "
+                            f"VALUES ({', '.join('?' * (len(self.columns) - 1))})",
+                            rows
+                        )
+            except Exception as e:
+                (self.log or log_to_stderr)(f"Could not write attach journal {self.path}: {e}")
+            if stop:
+                if connection is not None:
+                    connection.close()
+                return
+
+
+class SlowRequestProfiler:
+    """
+    Runs requests under cProfile and keeps .prof files for the `keep` slowest
+    ones in directory. cProfile profiles one thread at a time, so a request
+    arriving while another is being profiled runs unprofiled, and work the
+    request hands to other threads (such as parallel batch copies) is not
+    included in its profile.
+    """
+
+    def __init__(self, directory, keep=PROFILE_KEEP):
+        self.directory = directory
+        self.keep = max(1, int(keep))
+        self._busy = threading.Lock()
+        self._kept = []
+        self._lock = threading.Lock()
+
+    def run(self, name, func, *args):
+        """Call func(*args), profiling it if no other request is being profiled."""
+        if not self._busy.acquire(blocking=False):
+            return func(*args)
+        try:
+            import cProfile
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler (e.g. a debugger) owns the profiling hook
+                return func(*args)
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                profile.disable()
+                self._keep_if_slow(name, time.perf_counter() - start, profile)
+        finally:
+            self._busy.release()
+
+    def _keep_if_slow(self, name, seconds, profile):
+        with self._lock:
+            if len(self._kept) >= self.keep and seconds <= self._kept[0][0]:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{seconds * 1000:09.1f}ms-{name}.prof")
+            profile.dump_stats(path)
+            heapq.heappush(self._kept, (seconds, path))
+            if len(self._kept) > self.keep:
+                _, fastest = heapq.heappop(self._kept)
+                try:
+                    os.remove(fastest)
+                except OSError:
+                    pass
+
+
+def get_diagnostics_dir():
+    """Return the folder the launcher writes traces and profiles to."""
+    return os.path.join(os.path.expanduser("~"), ".outlook-attach")
+
+
+def configure_diagnostics(trace_file=None, profile_dir=None, profile_keep=PROFILE_KEEP, log=None):
+    """Turn request tracing and profiling on (paths given) or off (None)."""
+    global _trace_writer, _profiler
+    old_writer = _trace_writer
+    _trace_writer = TraceWriter(trace_file, log) if trace_file else None
+    _profiler = SlowRequestProfiler(profile_dir, profile_keep) if profile_dir else None
+    if old_writer is not None:
+        old_writer.close()
+
+
+def get_trace_writer():
+    """Return the active TraceWriter, or None when tracing is off."""
+    return _trace_writer
+
+
+def get_profiler():
+    """Return the active SlowRequestProfiler, or None when profiling is off."""
+    return _profiler
+
+
+def get_attach_journal():
+    """Return the active AttachJournal, or None when the journal is off."""
+    return _attach_journal
+
+
+def configure_journal(path, log=None):
+    """Record attaches in the journal at path, or stop recording (None or empty)."""
+    global _attach_journal
+    old_journal = _attach_journal
+    _attach_journal = AttachJournal(path, log) if path else None
+    if old_journal is not None:
+        old_journal.close()
+
+
+def parse_history_time(value):
+    """Parse a /history since/until value: Unix seconds or an ISO date or date-time (local time)."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def process_history_request(path):
+    """
+    Answer GET /history?type=&outcome=&q=&sha256=&jobId=&since=&until=&limit=&before=;
+    shared by every server engine. Entries come newest first; "next" is the
+    before value for the following page.
+    Returns (status_code, response_data).
+    """
+    journal = get_attach_journal()
+    if journal is None:
+        return 404, error_response_data("Attach journal is turned off")
+    params = {key: values[-1] for key, values in urllib.parse.parse_qs(urllib.parse.urlsplit(path).query).items()}
+    try:
+        limit = max(1, min(int(params.get('limit', HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE))
+        since = parse_history_time(params['since']) if params.get('since') else None
+        until = parse_history_time(params['until']) if params.get('until') else None
+        before = int(params['before']) if params.get('before') else None
+    except ValueError as e:
+        return 400, error_response_data(f"Invalid history query: {e}")
+    try:
+        entries, next_cursor = journal.query(
+            document_type=params.get('type'), outcome=params.get('outcome'), text=params.get('q'),
+            sha256=params.get('sha256'), job_id=params.get('jobId'),
+            since=since, until=until, limit=limit, before=before
+        )
+    except Exception as e:
+        return 500, error_response_data(f"Could not read attach journal: {e}")
+    return 200, {'success': True, 'entries': entries, 'next': next_cursor}
+
+
+def run_attach_route(route, process_request, body, start=None):
+    """
+    Run an attach route under a new RequestTrace, profiled when profiling is
+    on; shared by every server engine. start (a perf_counter value) backdates
+    the trace, e.g. to when an upload began arriving.
+    Returns (status_code, response_data, log_entry, trace).
+    """
+    trace = RequestTrace(route, start=start)
+    with get_idle_monitor().busy():
+        profiler = get_profiler()
+        if profiler is not None:
+            result = profiler.run(trace.id, process_request, body, trace)
+        else:
+            result = process_request(body, trace)
+    return result + (trace,)
+
+
+def finish_attach_response(trace, status_code, write_start):
+    """Record the response write that began at write_start, then finish the trace."""
+    write_end = time.perf_counter()
+    trace.add_span('write', write_start, write_end)
+    get_metrics().record_response(trace.route, status_code, write_end - write_start)
+    trace.finish(status_code)
+
+
+_trace_writer = TraceWriter(TRACE_FILE) if TRACE_FILE else None
+_profiler = SlowRequestProfiler(PROFILE_DIR) if PROFILE_DIR else None
+_attach_journal = AttachJournal(JOURNAL_FILE) if JOURNAL_FILE else None
+
+
+class Metrics:
+    """
+    Counters and latency histograms for the attach path, rendered in the
+    Prometheus text format at /metrics. Every thread records into its own
+    shard, so recording takes no lock; render() merges the shards.
+    """
+
+    help_text = {
+        'outlook_attach_requests_total': "Attach requests answered, by route and HTTP status.",
+        'outlook_attach_jobs_total': "Attach jobs finished, by kind, document type and result.",
+        'outlook_attach_files_total': "Files in finished attach jobs, by document type and result.",
+        'outlook_attach_duplicates_total': "Repeated attach requests answered from an earlier job.",
+        'outlook_attach_stage_seconds': "Time spent per attach stage, by document type and result.",
+        'outlook_attach_response_write_seconds': "Time spent encoding and writing attach responses.",
+        'outlook_attach_prewarm_seconds': "Time taken to warm Outlook up, by result.",
+        'outlook_attach_watch_latency_seconds': "Time from a watched download appearing to its job being queued.",
+    }
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = ({}, {})
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to a counter."""
+        counters = self._shard()[0]
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """Record one latency sample in a histogram."""
+        histograms = self._shard()[1]
+        key = (name, tuple(sorted(labels.items())))
+        histogram = histograms.get(key)
+        if histogram is None:
+            # Per-bucket counts (last one is +Inf), then the sum
+            histogram = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def record_job(self, job):
+        """Record a finished job's stage timings and outcome."""
+        labels = {'document_type': job.document_type, 'result': job.state}
+        for stage, seconds in job.timings.items():
+            self.observe('outlook_attach_stage_seconds', seconds, stage=stage, **labels)
+        self.inc('outlook_attach_jobs_total', kind=job.kind, **labels)
+        self.inc('outlook_attach_files_total', len(job.file_paths), **labels)
+
+    def record_response(self, route, status_code, seconds):
+        """Record an answered attach request and the time taken to write it."""
+        self.inc('outlook_attach_requests_total', route=route, status=str(status_code))
+        self.observe('outlook_attach_response_write_seconds', seconds, route=route)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        counters = {}
+        histograms = {}
+        with self._lock:
+            shards = list(self._shards)
+        for shard_counters, shard_histograms in shards:
+            for key, value in list(shard_counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, values in list(shard_histograms.items()):
+                merged = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(list(values)):
+                    merged[i] += value
+        
+        lines = []
+        for name in sorted({key[0] for key in counters}):
+            lines.append(f"# HELP {name} {self.help_text.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        for name in sorted({key[0] for key in histograms}):
+            lines.append(f"# HELP {name} {self.help_text.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), values):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {values[-1]}")
+                lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    """Format label pairs as a Prometheus label set."""
+    if not labels:
+        return ''
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """Return the shared Metrics registry."""
+    return _metrics
+
+
+def process_job_request(method, path):
+    """
+    Answer GET and DELETE on /jobs/<id>; shared by every server engine.
+    Returns (status_code, response_data).
+    """
+    job_id = path[len('/jobs/'):]
+    if method == 'DELETE':
+        job, cancelled = get_job_manager().cancel(job_id)
+        if job is None:
+            return 404, error_response_data(f"Unknown job: {job_id}")
+        if not cancelled:
+            return 409, dict(error_response_data(f"Job is already {job.state}"), job=job.to_dict())
+        return 200, {'success': True, 'message': "Job cancelled", 'job': job.to_dict()}
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return 404, error_response_data(f"Unknown job: {job_id}")
+    return 200, dict(job.to_dict(), success=True)
+
+
+def error_response_data(message):
+    """Build the JSON body used for every error response."""
+    return {
+        'success': False,
+        'message': message
+    }
+
+
+def process_get_request(path, accept=''):
+    """
+    Answer a GET request; shared by every server engine. /status is JSON when
+    the Accept header asks for it, plain text otherwise.
+    Returns (status_code, headers, payload).
+    """
+    if path == '/' or path == '/status':
+        prewarmer = get_outlook_prewarmer()
+        if 'application/json' in accept:
+            return json_route_response(200, {'status': 'running', 'outlook': prewarmer.status(),
+                                             'watching': _downloads_watcher is not None})
+        payload = STATUS_TEXT + f"\nOutlook: {prewarmer.describe()}".encode('utf-8')
+        return 200, [('Content-Type', 'text/plain; charset=utf-8')], payload
+    if path == '/rules':
+        return json_route_response(200, get_document_rules().describe())
+    if path == '/metrics':
+        payload = get_metrics().render().encode('utf-8')
+        return 200, [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')], payload
+    if path.startswith('/jobs/'):
+        return json_route_response(*process_job_request('GET', path), cross_origin=False)
+    if path.split('?', 1)[0] == '/history':
+        return json_route_response(*process_history_request(path), cross_origin=False)
+    return 404, [], b''
+
+
+def process_delete_request(path):
+    """
+    Answer a DELETE request; shared by every server engine.
+    Returns (status_code, headers, payload).
+    """
+    if path.startswith('/jobs/'):
+        return json_route_response(*process_job_request('DELETE', path), cross_origin=False)
+    return 404, [], b''
+
+
+def json_route_response(status_code, response_data, cross_origin=True):
+    """
+    Encode a JSON route result as (status_code, headers, payload). Routes
+    that expose attach data (job results, history) pass cross_origin=False:
+    without Access-Control-Allow-Origin, web pages cannot read them, while
+    the extension still can through its host permission.
+    """
+    payload = json.dumps(response_data, ensure_ascii=False).encode('utf-8')
+    headers = [('Content-Type', 'application/json; charset=utf-8')]
+    if cross_origin:
+        headers.append(('Access-Control-Allow-Origin', '*'))
+    return status_code, headers, payload
+
+
+# Streams the file in the request body instead of naming a path; it also
+# counts against the attach slots, but the engines feed it the body in chunks
+UPLOAD_ROUTE = '/attach/upload'
+
+# POST routes that run attach work and count against the attach slots
+ATTACH_ROUTES = {
+    '/attach': process_attach_request,
+    '/attach/batch': process_attach_batch_request,
+}
+
+
+class AttachHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP request handler for /attach endpoint."""
+    
+    def log_message(self, format, *args):
+        """Override to use custom log format with timestamp."""
+        timestamp = datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")
+        sys.stderr.write(f"{timestamp} {format % args}\n")
+    
+    def do_OPTIONS(self):
+        """
+        Handle CORS preflight requests. No origin is allowed, so web pages
+        cannot post attaches or read their results; the extension's host
+        permission lets it skip CORS.
+        """
+        self.send_response(200)
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Expose-Headers', 'Server-Timing')
+        self.end_headers()
+    
+    def do_POST(self):
+        """Handle POST requests to /attach, /attach/batch and /attach/upload."""
+        route = self.path.split('?', 1)[0]
+        process_request = process_upload_request if route == UPLOAD_ROUTE else ATTACH_ROUTES.get(self.path)
+        if process_request is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        
+        # Keep a worker free for /status; the pool is shared with other routes
+        attach_slots = getattr(self.server, 'attach_slots', None)
+        if attach_slots is not None and not attach_slots.acquire(blocking=False):
+            self.send_error_response(503, "Server busy, too many attaches in progress")
+            return
+        try:
+            if route == UPLOAD_ROUTE:
+                self.handle_upload()
+            else:
+                self.handle_attach(process_request)
+        finally:
+            if attach_slots is not None:
+                attach_slots.release()
+    
+    def handle_attach(self, process_request, route=None, body=None, start=None):
+        """Read the posted body and run it through the attach pipeline."""
+        if body is None:
+            content_length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(content_length)
         
+        status_code, response_data, log_entry, trace = run_attach_route(route or self.path, process_request,
+                                                                        body, start)
+        write_start = time.perf_counter()
+        self.send_json_response(status_code, response_data, [('Server-Timing', trace.server_timing())])
+        finish_attach_response(trace, status_code, write_start)
+        if log_entry:
+            self.log_message("%s", log_entry)
+    
+    def handle_upload(self):
+        """Stream the posted file to disk, then run it through the attach pipeline."""
+        length = self.headers.get('Content-Length')
+        try:
+            receiver, params = start_upload(self.path, int(length) if length is not None else None)
+            with get_idle_monitor().busy():
+                upload = receiver.receive(self.rfile.read)
+        except (UploadError, ValueError) as e:
+            # The body was not read, so the connection cannot be reused
+            self.close_connection = True
+            status_code = e.status_code if isinstance(e, UploadError) else 400
+            self.send_error_response(status_code, str(e))
+            return
+        self.handle_attach(process_upload_request, UPLOAD_ROUTE, (upload, params), upload.started)
+    
+    def send_json_response(self, status_code, response_data, extra_headers=()):
+        """Send a JSON response (attach results are not readable cross-origin)."""
         self.send_response(status_code)
         self.send_header('Content-Type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in extra_headers:
+            self.send_header(name, value)
         self.end_headers()
         self.wfile.write(json.dumps(response_data).encode('utf-8'))
     
+    def send_error_response(self, status_code, message):
+        """Send an error response with JSON body."""
+        self.send_json_response(status_code, error_response_data(message))
+    
     def do_GET(self):
-        """Handle GET requests - return simple status."""
-        if self.path == '/' or self.path == '/status':
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Outlook Auto Attach Server is running')
-        else:
-            self.send_response(404)
-            self.end_headers()
+        """Handle GET requests - status, read-only JSON routes and the event stream."""
+        if self.path == '/events':
+            self.stream_events()
+            return
+        self.send_route_response(*process_get_request(self.path, self.headers.get('Accept', '')))
+    
+    def stream_events(self):
+        """Stream job events to the client until it disconnects or the server closes."""
+        event_slots = getattr(self.server, 'event_slots', None)
+        if event_slots is None or not event_slots.acquire(blocking=False):
+            self.send_error_response(503, "Too many event streams")
+            return
+        try:
+            subscription = get_event_bus().subscribe()
+            if subscription is None:
+                self.send_error_response(503, "Too many event streams")
+                return
+            self.server.event_subscriptions.add(subscription)
+            try:
+                self.send_response(200)
+                for name, value in EVENT_STREAM_HEADERS:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(b'retry: 2000\n\n')
+                while not subscription.closed:
+                    events = subscription.wait(EVENT_HEARTBEAT)
+                    self.wfile.write(b''.join(format_event(e) for e in events) or b': keep-alive\n\n')
+                    self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                self.server.event_subscriptions.discard(subscription)
+                subscription.close()
+                self.close_connection = True
+        finally:
+            event_slots.release()
+    
+    def do_DELETE(self):
+        """Handle DELETE requests - cancel queued jobs."""
+        self.send_route_response(*process_delete_request(self.path))
+    
+    def send_route_response(self, status_code, headers, payload):
+        """Send a (status_code, headers, payload) result from a shared route."""
+        self.send_response(status_code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class AsyncAttachServer:
+    """
+    asyncio server engine with the same routes and CORS behavior as AttachHandler.
+    Connections are persistent HTTP/1.1, so the extension reuses one TCP
+    connection across requests; blocking copy and Outlook work runs in a
+    thread pool executor. Exposes the serve_forever/shutdown/server_close
+    interface of socketserver so callers can treat both engines alike.
+    """
+
+    # Seconds an idle keep-alive connection is held open
+    keepalive_timeout = 15
+    # Header lines per request, the limit http.server applies too
+    max_header_lines = 100
+
+    def __init__(self, server_address, max_workers=MAX_WORKERS, sock=None):
+        self.max_workers = max(2, int(max_workers))
+        self.log_callback = None
+        self.socket = sock if sock is not None else socket.create_server(server_address)
+        self.server_address = self.socket.getsockname()
+        self._loop = None
+        self._stop = None
+        self._stopped = threading.Event()
+        self._shutdown_requested = False
+        self._executor = None
+        self._attach_slots = None
+        self._connections = {}
+        self._event_subscriptions = set()
+
+    def log_message(self, format, *args):
+        """Log with the same format as AttachHandler, forwarding to log_callback if set."""
+        timestamp = datetime.now().strftime("[%d/%b/%Y %H:%M:%S]")
+        message = f"{timestamp} {format % args}"
+        sys.stderr.write(message + "\n")
+        if self.log_callback is not None:
+            self.log_callback(message)
+
+    def serve_forever(self):
+        """Run the event loop until shutdown() is called."""
+        import asyncio
+        self._stopped.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._stopped.set()
+
+    def shutdown(self):
+        """Stop serve_forever and wait for it to return. Safe to call from any thread."""
+        self._shutdown_requested = True
+        loop, stop = self._loop, self._stop
+        if loop is not None and stop is not None:
+            loop.call_soon_threadsafe(stop.set)
+            self._stopped.wait()
+
+    def server_close(self):
+        """Close the listening socket."""
+        self.socket.close()
+
+    async def _serve(self):
+        import asyncio
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers,
+            thread_name_prefix='attach-worker'
+        )
+        self._attach_slots = asyncio.Semaphore(self.max_workers)
+        server = await asyncio.start_server(self._handle_connection, sock=self.socket)
+        try:
+            if not self._shutdown_requested:
+                await self._stop.wait()
+        finally:
+            server.close()
+            for subscription in list(self._event_subscriptions):
+                subscription.close()
+            # Idle keep-alive connections would otherwise hold wait_closed open
+            for writer in list(self._connections):
+                writer.close()
+            if self._connections:
+                await asyncio.wait(list(self._connections.values()), timeout=5)
+            await server.wait_closed()
+            self._executor.shutdown(wait=False)
+            self._loop = None
+            self._stop = None
+
+    async def _handle_connection(self, reader, writer):
+        """Serve requests on one connection until the client or timeout closes it."""
+        import asyncio
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                except ValueError:
+                    # Longer than the stream limit (64 KiB), answered like BaseHTTPRequestHandler
+                    await self._write_response(writer, 414, [], b'', False)
+                    break
+                if not request_line:
+                    break
+                get_idle_monitor().touch()
+                
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    await self._write_response(writer, 400, [], b'', False)
+                    break
+                method, path, version = parts
+                
+                headers = {}
+                header_lines = 0
+                too_large = False
+                while True:
+                    try:
+                        line = await reader.readline()
+                    except ValueError:
+                        too_large = True
+                        break
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    header_lines += 1
+                    if header_lines > self.max_header_lines:
+                        too_large = True
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if too_large:
+                    await self._write_response(writer, 431, [], b'', False)
+                    break
+                
+                connection = headers.get('connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = connection != 'close'
+                else:
+                    keep_alive = connection == 'keep-alive'
+                
+                try:
+                    content_length = int(headers.get('content-length', 0))
+                except ValueError:
+                    content_length = -1
+                if content_length < 0:
+                    await self._write_response(writer, 400, [], b'', False)
+                    break
+                
+                if method == 'POST' and path.split('?', 1)[0] == UPLOAD_ROUTE:
+                    length = content_length if 'content-length' in headers else None
+                    status_code, response_headers, payload, trace, consumed = await self._handle_upload(
+                        reader, path, length
+                    )
+                    keep_alive = keep_alive and consumed
+                else:
+                    body = await reader.readexactly(content_length) if content_length else b''
+                    
+                    if method == 'GET' and path == '/events':
+                        await self._stream_events(writer)
+                        self.log_message('"%s" 200 -', request_line.decode('latin-1').strip())
+                        break
+                    
+                    status_code, response_headers, payload, trace = await self._dispatch(
+                        method, path, body, headers.get('accept', '')
+                    )
+                write_start = time.perf_counter()
+                await self._write_response(writer, status_code, response_headers, payload, keep_alive)
+                if trace is not None:
+                    finish_attach_response(trace, status_code, write_start)
+                self.log_message('"%s" %s -', request_line.decode('latin-1').strip(), str(status_code))
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _stream_events(self, writer):
+        """Stream job events on this connection until the client or the server closes it."""
+        import asyncio
+        loop = self._loop
+        ready = asyncio.Event()
+        
+        def wakeup():
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                pass  # event loop already closed
+        
+        subscription = get_event_bus().subscribe(wakeup=wakeup)
+        if subscription is None:
+            data = error_response_data("Too many event streams")
+            await self._write_response(writer, 503, [('Content-Type', 'application/json')],
+                                       json.dumps(data).encode('utf-8'), False)
+            return
+        self._event_subscriptions.add(subscription)
+        try:
+            lines = ["HTTP/1.1 200 OK"]
+            for name, value in EVENT_STREAM_HEADERS:
+                lines.append(f"{name}: {value}")
+            lines.append("Connection: close")
+            lines.append(f"Date: {formatdate(usegmt=True)}")
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + b'retry: 2000\n\n')
+            await writer.drain()
+            while not subscription.closed:
+                try:
+                    await asyncio.wait_for(ready.wait(), EVENT_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    pass
+                ready.clear()
+                events = subscription.drain()
+                writer.write(b''.join(format_event(e) for e in events) or b': keep-alive\n\n')
+                await writer.drain()
+        finally:
+            self._event_subscriptions.discard(subscription)
+            subscription.close()
+
+    async def _dispatch(self, method, path, body, accept=''):
+        """
+        Route a request the same way AttachHandler does.
+        Returns (status_code, headers, payload, trace); trace is only set for attach routes.
+        """
+        json_headers = [('Content-Type', 'application/json')]
+        
+        if method == 'OPTIONS':
+            return 200, [
+                ('Access-Control-Allow-Methods', 'GET, POST, DELETE, OPTIONS'),
+                ('Access-Control-Allow-Headers', 'Content-Type'),
+                ('Access-Control-Expose-Headers', 'Server-Timing'),
+            ], b'', None
+        
+        if method == 'GET':
+            if path.split('?', 1)[0] == '/history':
+                # SQLite queries block, so they stay off the event loop
+                return await self._loop.run_in_executor(self._executor, process_get_request, path, accept) + (None,)
+            return process_get_request(path, accept) + (None,)
+        
+        if method == 'DELETE':
+            return process_delete_request(path) + (None,)
+        
+        if method == 'POST':
+            process_request = ATTACH_ROUTES.get(path)
+            if process_request is None:
+                return 404, [], b'', None
+            if self._attach_slots.locked():
+                data = error_response_data("Server busy, too many attaches in progress")
+                return 503, json_headers, json.dumps(data).encode('utf-8'), None
+            async with self._attach_slots:
+                status_code, response_data, log_entry, trace = await self._loop.run_in_executor(
+                    self._executor, run_attach_route, path, process_request, body
+                )
+            if log_entry:
+                self.log_message("%s", log_entry)
+            headers = json_headers + [('Server-Timing', trace.server_timing())]
+            return status_code, headers, json.dumps(response_data).encode('utf-8'), trace
+        
+        return 501, [], b'', None
+
+    async def _handle_upload(self, reader, path, content_length):
+        """
+        Stream an /attach/upload body to disk chunk by chunk, then run it
+        through the attach pipeline like AttachHandler.handle_upload.
+        Returns (status_code, headers, payload, trace, consumed); consumed is
+        False when the body was not read to the end, so the connection must
+        not be reused.
+        """
+        json_headers = [('Content-Type', 'application/json')]
+        
+        def error(status_code, message):
+            return status_code, json_headers, json.dumps(error_response_data(message)).encode('utf-8'), None, False
+        
+        if self._attach_slots.locked():
+            return error(503, "Server busy, too many attaches in progress")
+        async with self._attach_slots:
+            try:
+                receiver, params = start_upload(path, content_length)
+            except UploadError as e:
+                return error(e.status_code, str(e))
+            try:
+                with get_idle_monitor().busy():
+                    while receiver.remaining:
+                        chunk = await reader.read(min(UPLOAD_CHUNK_SIZE, receiver.remaining))
+                        if not chunk:
+                            break
+                        await self._loop.run_in_executor(self._executor, receiver.write, chunk)
+                    upload = receiver.finish()
+            except UploadError as e:
+                return error(e.status_code, str(e))
+            except BaseException:
+                receiver.abort()
+                raise
+            status_code, response_data, log_entry, trace = await self._loop.run_in_executor(
+                self._executor, run_attach_route, UPLOAD_ROUTE, process_upload_request, (upload, params),
+                upload.started
+            )
+        if log_entry:
+            self.log_message("%s", log_entry)
+        headers = json_headers + [('Server-Timing', trace.server_timing())]
+        return status_code, headers, json.dumps(response_data).encode('utf-8'), trace, True
+
+    async def _write_response(self, writer, status_code, headers, payload, keep_alive):
+        """Write a complete HTTP/1.1 response."""
+        reason = http.HTTPStatus(status_code).phrase
+        lines = [f"HTTP/1.1 {status_code} {reason}"]
+        for name, value in headers:
+            lines.append(f"{name}: {value}")
+        lines.append(f"Content-Length: {len(payload)}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        lines.append(f"Date: {formatdate(usegmt=True)}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + payload)
+        await writer.drain()
+
+
+class IdleMonitor:
+    """
+    Tracks request and job activity and shuts a server down once it has been
+    idle for idle_seconds. Open /events streams do not count as activity: the
+    extension only holds one while it waits for a job, and the job counts.
+    """
+
+    def __init__(self):
+        self.last_activity = time.monotonic()
+        self._busy = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def touch(self):
+        """Note activity now."""
+        self.last_activity = time.monotonic()
+
+    @contextmanager
+    def busy(self):
+        """Keep the server from idling out while the block runs."""
+        with self._lock:
+            self._busy += 1
+        self.touch()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._busy -= 1
+            self.touch()
+
+    def idle_for(self, now=None):
+        """Seconds since the last activity, or 0 while anything is in progress."""
+        if self._busy:
+            return 0
+        return (now if now is not None else time.monotonic()) - self.last_activity
+
+    def watch(self, server, idle_seconds, log=None):
+        """Shut server down from a background thread after idle_seconds idle."""
+        self.unwatch()
+        self.touch()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(server, idle_seconds, log or log_to_stderr, self._stop),
+            name='attach-idle-exit', daemon=True
+        )
+        self._thread.start()
+
+    def unwatch(self):
+        """Stop watching; the server keeps running."""
+        self._stop.set()
+        self._thread = None
+
+    def _run(self, server, idle_seconds, log, stop):
+        interval = min(5.0, max(0.1, idle_seconds / 4))
+        while not stop.wait(interval):
+            idle = self.idle_for()
+            if idle >= idle_seconds:
+                log(f"Idle for {idle:.0f}s, exiting")
+                server.shutdown()
+                return
+
+
+def get_idle_monitor():
+    """Return the shared IdleMonitor."""
+    global _idle_monitor
+    with _idle_monitor_lock:
+        if _idle_monitor is None:
+            _idle_monitor = IdleMonitor()
+        return _idle_monitor
+
+
+def inherited_listen_socket():
+    """
+    Return the listening socket passed in by systemd, launchd or the service
+    stub, or None when the server should bind its own.
+    """
+    listen_fd = os.environ.pop('OUTLOOK_ATTACH_LISTEN_FD', None)
+    if listen_fd == 'share':
+        return socket.fromshare(sys.stdin.buffer.read())
+    if listen_fd:
+        return socket.socket(fileno=int(listen_fd))
+    
+    # systemd socket activation; the variables are not passed on to children
+    listen_pid = os.environ.pop('LISTEN_PID', None)
+    listen_fds = os.environ.pop('LISTEN_FDS', None)
+    os.environ.pop('LISTEN_FDNAMES', None)
+    if listen_pid and listen_fds and listen_pid == str(os.getpid()) and int(listen_fds) > 0:
+        return socket.socket(fileno=SD_LISTEN_FDS_START)
+    
+    # launchd sets XPC_SERVICE_NAME for the jobs it starts
+    if sys.platform == 'darwin' and os.environ.get('XPC_SERVICE_NAME', '0') != '0':
+        return launchd_listen_socket(LAUNCHD_SOCKET_NAME)
+    return None
+
+
+def launchd_listen_socket(name):
+    """Return the first socket launchd holds for the job under name, or None."""
+    # Imported here: ctypes is only needed when started by launchd
+    import ctypes
+    libc = get_libc()
+    if libc is None or not hasattr(libc, 'launch_activate_socket'):
+        return None
+    fds = ctypes.POINTER(ctypes.c_int)()
+    count = ctypes.c_size_t(0)
+    if libc.launch_activate_socket(name.encode('utf-8'), ctypes.byref(fds), ctypes.byref(count)) != 0:
+        return None  # not a launchd job, or no socket under that name
+    try:
+        if count.value == 0:
+            return None
+        for i in range(1, count.value):
+            os.close(fds[i])
+        return socket.socket(fileno=fds[0])
+    finally:
+        libc.free(fds)
+
+
+def create_server(server_address, handler_class=None, engine=None, max_workers=MAX_WORKERS, sock=None):
+    """
+    Create a server for the chosen engine ('threaded' or 'asyncio'), serving
+    sock instead of binding server_address when a listening socket is given.
+    handler_class only applies to the threaded engine; the asyncio engine
+    reports its log lines through its log_callback attribute instead.
+    """
+    engine = engine or ENGINE
+    if engine == 'asyncio':
+        return AsyncAttachServer(server_address, max_workers=max_workers, sock=sock)
+    if engine != 'threaded':
+        raise ValueError(f"Unknown server engine: {engine}")
+    return PooledHTTPServer(server_address, handler_class or AttachHandler, max_workers=max_workers,
+                            sock=sock)
 
 
 def main():
     """Start the HTTP server."""
+    parser = argparse.ArgumentParser(description="Outlook Auto Attach Server")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help=f"worker threads serving requests (default: {MAX_WORKERS})")
+    parser.add_argument('--engine', choices=ENGINES, default=ENGINE,
+                        help=f"server engine (default: {ENGINE})")
+    parser.add_argument('--backend', choices=BACKENDS, default=BACKEND,
+                        help=f"automation backend (default: {BACKEND})")
+    parser.add_argument('--simulated-latency', type=float, default=SIMULATED_LATENCY,
+                        help=f"seconds per simulated attach (default: {SIMULATED_LATENCY})")
+    parser.add_argument('--simulated-failure-rate', type=float, default=SIMULATED_FAILURE_RATE,
+                        help=f"fraction of simulated attaches that fail (default: {SIMULATED_FAILURE_RATE})")
+    parser.add_argument('--trace-file', default=TRACE_FILE,
+                        help="append per-request trace spans to this JSONL file")
+    parser.add_argument('--profile-dir', default=PROFILE_DIR,
+                        help="profile requests with cProfile and keep the slowest here")
+    parser.add_argument('--profile-keep', type=int, default=PROFILE_KEEP,
+                        help=f"number of slowest request profiles to keep (default: {PROFILE_KEEP})")
+    parser.add_argument('--journal', default=JOURNAL_FILE,
+                        help="SQLite journal of finished attaches for GET /history ('' turns it off)")
+    parser.add_argument('--idle-exit', type=float, default=IDLE_EXIT,
+                        help="exit after this many idle seconds (default: 0, stay running)")
+    parser.add_argument('--prewarm', action='store_true', default=PREWARM,
+                        help="start Outlook in the background so the first attach is fast")
+    parser.add_argument('--watch', action='append', nargs='?', const=default_downloads_dir(), metavar='DIR',
+                        help="attach matching new files in DIR (default: ~/Downloads); repeatable")
+    args = parser.parse_args()
+    configure_diagnostics(args.trace_file, args.profile_dir, args.profile_keep)
+    configure_journal(args.journal)
+    configure_backend(args.backend, args.simulated_latency, failure_rate=args.simulated_failure_rate)
+    
     server_address = ('127.0.0.1', PORT)
-    httpd = http.server.HTTPServer(server_address, AttachHandler)
+    sock = inherited_listen_socket()
+    httpd = create_server(server_address, engine=args.engine, max_workers=args.workers, sock=sock)
+    start_background_tasks(prewarm=args.prewarm, watch=args.watch)
+    if args.idle_exit > 0:
+        get_idle_monitor().watch(httpd, args.idle_exit)
     
-    print(f"Outlook Auto Attach server started on http://localhost:{PORT}")
+    print(f"Outlook Auto Attach server started on http://localhost:{httpd.server_address[1]} "
+          f"({args.engine} engine, {httpd.max_workers} workers, {args.backend} backend"
+          f"{', inherited socket' if sock is not None else ''})")
     print("Press Ctrl+C to stop the server")
     
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print("\nServer stopped")
-        httpd.shutdown()
+    finally:
+        get_idle_monitor().unwatch()
+        stop_background_tasks()
+        httpd.server_close()
+        configure_diagnostics()
 
 
 if __name__ == '__main__':
     main()
-
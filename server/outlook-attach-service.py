@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Outlook Auto Attach Service
+Headless entry point for shared machines: runs the attach server without the
+Tk launcher and logs to a rotating file (~/.outlook-attach/service.log).
+
+Budget, per service process (checked by --check-budget, which tests/test_service_budget.py runs):
+    startup, process start to listening:  STARTUP_BUDGET_SECONDS (1.5 s)
+    resident memory while serving:        MEMORY_BUDGET_MB (40 MB)
+
+To stay inside it the service never imports tkinter, loads only the server
+module, and leaves the asyncio engine, ctypes and cProfile unloaded unless
+they are used.
+
+On demand (--on-demand), a small stub holds the listening socket and starts
+the service on the first connection; the service exits after --idle-exit
+seconds without requests (ON_DEMAND_IDLE_EXIT by default) and the stub waits
+for the next connection, so between uses only the stub stays resident.
+systemd socket activation and launchd Sockets (named "Listeners") work the
+same way without the stub, e.g. as user units:
+
+    outlook-attach.socket:   [Socket] ListenStream=127.0.0.1:8765
+    outlook-attach.service:  [Service] ExecStart=/usr/bin/python3 .../outlook-attach-service.py --idle-exit 300
+
+Usage:
+    python3 outlook-attach-service.py [--engine threaded|asyncio] [--workers N] [--log-file PATH]
+                                      [--idle-exit SECONDS] [--on-demand]
+    python3 outlook-attach-service.py --check-budget [--on-demand]
+"""
+
+import argparse
+import json
+import logging
+import logging.handlers
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+STARTUP_BUDGET_SECONDS = 1.5
+MEMORY_BUDGET_MB = 40
+STUB_MEMORY_BUDGET_MB = 20
+
+DEFAULT_LOG_FILE = os.path.join(os.path.expanduser("~"), ".outlook-attach", "service.log")
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+
+# Idle seconds before an on-demand service exits, and the pause before the
+# stub starts it again after a failed run
+ON_DEMAND_IDLE_EXIT = 300
+RESTART_BACKOFF = 1.0
+
+
+def load_server_module():
+    """Load outlook-attach-server.py from next to this file (or the PyInstaller bundle)."""
+    import importlib.util
+    base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(
+        "outlook_attach_server",
+        os.path.join(base_path, "outlook-attach-server.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def resident_memory_kb(pid):
+    """Return the resident memory of process pid in KB, or None where it cannot be read."""
+    if sys.platform.startswith('linux'):
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+        return None
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in (
+                    'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                    'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage',
+                    'PagefileUsage', 'PeakPagefileUsage')
+            ]
+
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        kernel32 = ctypes.windll.kernel32
+        kernel32.OpenProcess.restype = wintypes.HANDLE
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return None
+        try:
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            if not kernel32.K32GetProcessMemoryInfo(wintypes.HANDLE(handle), ctypes.byref(counters), counters.cb):
+                return None
+            return counters.WorkingSetSize // 1024
+        finally:
+            kernel32.CloseHandle(wintypes.HANDLE(handle))
+    try:
+        output = subprocess.run(['ps', '-o', 'rss=', '-p', str(pid)], capture_output=True, text=True)
+        return int(output.stdout.strip())
+    except (OSError, ValueError):
+        return None
+
+
+def setup_logging(log_file):
+    """Log to a rotating file; returns the logger."""
+    os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8'
+    )
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger = logging.getLogger('outlook-attach-service')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    return logger
+
+
+def serve(args):
+    """Run the server until interrupted."""
+    server_module = load_server_module()
+    logger = setup_logging(args.log_file or DEFAULT_LOG_FILE)
+
+    def log(message):
+        logger.info(message)
+
+    class ServiceAttachHandler(server_module.AttachHandler):
+        """Request handler that logs to the service log instead of stderr."""
+
+        def log_message(self, format, *args):
+            logger.info(format % args)
+
+    sock = server_module.inherited_listen_socket()
+    httpd = server_module.create_server(
+        ('127.0.0.1', args.port), ServiceAttachHandler, engine=args.engine, max_workers=args.workers,
+        sock=sock
+    )
+    if args.engine == 'asyncio':
+        httpd.log_message = lambda format, *a: logger.info(format % a)
+    port = httpd.server_address[1]
+    log(f"Listening on 127.0.0.1:{port} ({args.engine} engine, {httpd.max_workers} workers"
+        f"{', inherited socket' if sock is not None else ''})")
+
+    if args.report_ready:
+        # One JSON line for --check-budget: readiness plus what was imported
+        print(json.dumps({
+            'port': port,
+            'modules': len(sys.modules),
+            'tkinter': 'tkinter' in sys.modules,
+        }), flush=True)
+
+    server_module.start_background_tasks(log, prewarm=args.prewarm, watch=args.watch)
+    if args.idle_exit > 0:
+        server_module.get_idle_monitor().watch(httpd, args.idle_exit, log)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server_module.get_idle_monitor().unwatch()
+        server_module.stop_background_tasks()
+        httpd.server_close()
+        log("Service stopped")
+
+
+def run_on_demand(args):
+    """
+    Hold the listening socket and run the service in a child process whenever
+    a connection arrives; the child exits once idle and the stub waits again.
+    Deliberately does not load the server module.
+    """
+    log_file = args.log_file or DEFAULT_LOG_FILE
+    logger = setup_logging(os.path.splitext(log_file)[0] + "-stub.log")
+    idle_exit = args.idle_exit if args.idle_exit > 0 else ON_DEMAND_IDLE_EXIT
+    sock = socket.create_server(('127.0.0.1', args.port))
+    port = sock.getsockname()[1]
+    logger.info(f"Waiting for connections on 127.0.0.1:{port}")
+    if args.report_ready:
+        print(json.dumps({
+            'port': port,
+            'modules': len(sys.modules),
+            'tkinter': 'tkinter' in sys.modules,
+        }), flush=True)
+    
+    def stop(signum, frame):
+        raise SystemExit(0)
+    
+    signal.signal(signal.SIGTERM, stop)
+    command = [sys.executable, os.path.abspath(__file__), '--engine', args.engine,
+               '--workers', str(args.workers), '--log-file', log_file, '--idle-exit', str(idle_exit)]
+    child = None
+    try:
+        while True:
+            # A connection waiting to be accepted is what starts the service;
+            # it stays queued on the socket until the child accepts it
+            select.select([sock], [], [])
+            env = dict(os.environ)
+            started = time.monotonic()
+            if sys.platform == 'win32':
+                env['OUTLOOK_ATTACH_LISTEN_FD'] = 'share'
+                child = subprocess.Popen(command, env=env, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+                child.stdin.write(sock.share(child.pid))
+                child.stdin.close()
+            else:
+                env['OUTLOOK_ATTACH_LISTEN_FD'] = str(sock.fileno())
+                child = subprocess.Popen(command, env=env, pass_fds=(sock.fileno(),),
+                                         stdout=subprocess.DEVNULL)
+            logger.info(f"Started service (pid {child.pid})")
+            returncode = child.wait()
+            child = None
+            logger.info(f"Service exited with {returncode} after {time.monotonic() - started:.0f}s")
+            if returncode != 0:
+                time.sleep(RESTART_BACKOFF)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if child is not None:
+            child.terminate()
+            child.wait(timeout=10)
+        sock.close()
+
+
+def timed_status_request(port):
+    """GET /status; returns (status_code, seconds)."""
+    import http.client
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        conn.request('GET', '/status')
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def check_budget(args):
+    """
+    Start the service (or with --on-demand, the stub) in a child process and
+    check its startup time and resident memory against the budget. On demand,
+    the first request has to start the service within the startup budget, and
+    a request after it has idled out has to start it again.
+    Returns the exit status (0 = within budget).
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory(prefix='attach-service-') as log_dir:
+        command = [sys.executable, os.path.abspath(__file__), '--port', '0', '--report-ready',
+                   '--engine', args.engine, '--log-file', os.path.join(log_dir, 'service.log')]
+        if args.on_demand:
+            command += ['--on-demand', '--idle-exit', '1']
+        start = time.perf_counter()
+        child = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        try:
+            line = child.stdout.readline()
+            startup = time.perf_counter() - start
+            if not line:
+                print("Service exited before it was listening")
+                return 1
+            report = json.loads(line)
+
+            status, first_request = timed_status_request(report['port'])
+            # Measured while serving, so engine and worker threads are included
+            # (on demand: the stub alone, which is what stays resident)
+            rss_kb = resident_memory_kb(child.pid)
+            if args.on_demand:
+                time.sleep(3)
+                restart_status, restart_request = timed_status_request(report['port'])
+        finally:
+            child.terminate()
+            child.wait(timeout=10)
+
+    memory_budget = STUB_MEMORY_BUDGET_MB if args.on_demand else MEMORY_BUDGET_MB
+    rss_mb = rss_kb / 1024 if rss_kb is not None else None
+    checks = [
+        ('startup', f"{startup:.2f} s", f"{STARTUP_BUDGET_SECONDS} s", startup <= STARTUP_BUDGET_SECONDS),
+        ('resident memory', f"{rss_mb:.1f} MB" if rss_mb is not None else "unknown",
+         f"{memory_budget} MB", rss_mb is None or rss_mb <= memory_budget),
+        ('tkinter not imported', str(not report['tkinter']), "True", not report['tkinter']),
+        ('GET /status', str(status), "200", status == 200),
+    ]
+    if args.on_demand:
+        checks += [
+            ('first request', f"{first_request:.2f} s", f"{STARTUP_BUDGET_SECONDS} s",
+             first_request <= STARTUP_BUDGET_SECONDS),
+            ('request after idle exit', f"{restart_status} in {restart_request:.2f} s", "200",
+             restart_status == 200 and restart_request <= STARTUP_BUDGET_SECONDS),
+        ]
+    for name, measured, budget, ok in checks:
+        print(f"{'OK  ' if ok else 'FAIL'} {name}: {measured} (budget {budget})")
+    print(f"     modules loaded: {report['modules']}")
+    return 0 if all(ok for *_, ok in checks) else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Outlook Auto Attach headless service")
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'),
+                        default=os.environ.get('OUTLOOK_ATTACH_ENGINE', 'threaded'),
+                        help="server engine (default: threaded)")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('OUTLOOK_ATTACH_WORKERS', '8')),
+                        help="worker threads serving requests (default: 8)")
+    parser.add_argument('--port', type=int, default=8765, help="port to listen on (default: 8765)")
+    parser.add_argument('--log-file', default=None,
+                        help="log file (default: ~/.outlook-attach/service.log)")
+    parser.add_argument('--report-ready', action='store_true',
+                        help="print one JSON line with the port and loaded modules once listening")
+    parser.add_argument('--idle-exit', type=float,
+                        default=float(os.environ.get('OUTLOOK_ATTACH_IDLE_EXIT', '0')),
+                        help=f"exit after this many idle seconds (default: 0, stay running; "
+                             f"{ON_DEMAND_IDLE_EXIT} with --on-demand)")
+    parser.add_argument('--prewarm', action='store_true',
+                        default=os.environ.get('OUTLOOK_ATTACH_PREWARM', '0') == '1',
+                        help="start Outlook in the background so the first attach is fast")
+    parser.add_argument('--watch', action='append', nargs='?', metavar='DIR',
+                        const=os.path.join(os.path.expanduser("~"), "Downloads"),
+                        help="attach matching new files in DIR (default: ~/Downloads); repeatable")
+    parser.add_argument('--on-demand', action='store_true',
+                        help="hold the port in a small stub and start the service on the first connection")
+    parser.add_argument('--check-budget', action='store_true',
+                        help="start the service and check it against the startup and memory budget")
+    args = parser.parse_args()
+    if args.watch and args.on_demand:
+        parser.error("--watch needs a resident service, it cannot be combined with --on-demand")
+
+    if args.check_budget:
+        return check_budget(args)
+    if args.on_demand:
+        run_on_demand(args)
+    else:
+        serve(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
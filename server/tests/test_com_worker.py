@@ -0,0 +1,119 @@
+"""
+Drive OutlookComWorker with a fake Outlook.Application, so its reconnect,
+timeout and no-retry paths run on any platform.
+
+Run from the server folder:
+    python -m unittest discover -s tests
+"""
+
+import importlib.util
+import os
+import threading
+import unittest
+
+
+def load_server_module():
+    """Load outlook-attach-server.py from the folder above this one."""
+    base_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(
+        "outlook_attach_server",
+        os.path.join(base_path, "outlook-attach-server.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+server_module = load_server_module()
+
+
+class FakeOutlook:
+    """Stands in for Outlook.Application; Version fails once Outlook has 'quit'."""
+
+    def __init__(self):
+        self.quit = False
+
+    @property
+    def Version(self):
+        if self.quit:
+            raise RuntimeError("The RPC server is unavailable")
+        return "16.0"
+
+
+class OutlookComWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatched = []
+        self.worker = server_module.OutlookComWorker(dispatch=self.dispatch, job_timeout=2)
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def dispatch(self, prog_id):
+        self.assertEqual(prog_id, "Outlook.Application")
+        outlook = FakeOutlook()
+        self.dispatched.append(outlook)
+        return outlook
+
+    def test_cold_start_connects_once(self):
+        self.assertEqual(self.worker.state, 'cold')
+        self.assertEqual(self.worker.submit(lambda outlook: (True, "first")), (True, "first"))
+        self.assertEqual(self.worker.submit(lambda outlook: (True, "second")), (True, "second"))
+        self.assertEqual(len(self.dispatched), 1)
+        self.assertEqual(self.worker.status()['state'], 'warm')
+        self.assertEqual(self.worker.status()['jobsDone'], 2)
+
+    def test_reconnects_when_version_probe_fails(self):
+        self.worker.submit(lambda outlook: (True, "ok"))
+        self.dispatched[0].quit = True
+        seen = []
+        result = self.worker.submit(lambda outlook: seen.append(outlook) or (True, "ok"))
+        self.assertEqual(result, (True, "ok"))
+        self.assertEqual(len(self.dispatched), 2)
+        self.assertEqual(seen, [self.dispatched[1]])
+        self.assertEqual(self.worker.connects, 2)
+
+    def test_failing_job_is_not_run_twice(self):
+        calls = []
+
+        def attach(outlook):
+            calls.append(outlook)
+            raise RuntimeError("Attachments.Add failed")
+
+        success, message = self.worker.submit(attach)
+        self.assertFalse(success)
+        self.assertIn("Attachments.Add failed", message)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(self.dispatched), 1)
+
+    def test_timed_out_job_is_cancelled(self):
+        release = threading.Event()
+        started = threading.Event()
+        queued_ran = []
+
+        def blocking(outlook):
+            started.set()
+            release.wait(5)
+            return True, "blocking"
+
+        blocker = threading.Thread(target=self.worker.submit, args=(blocking,), kwargs={'timeout': 10})
+        blocker.start()
+        self.assertTrue(started.wait(2))
+        result = self.worker.submit(lambda outlook: queued_ran.append(1) or (True, "late"), timeout=0.2)
+        self.assertEqual(result, (False, "Timeout waiting for Outlook"))
+        release.set()
+        blocker.join(5)
+        # The worker is free again and the cancelled job was skipped
+        self.assertEqual(self.worker.submit(lambda outlook: (True, "after")), (True, "after"))
+        self.assertEqual(queued_ran, [])
+
+    def test_timed_out_running_job_is_reported(self):
+        release = threading.Event()
+        success, message = self.worker.submit(lambda outlook: (release.wait(5), (True, "done"))[1], timeout=0.2)
+        release.set()
+        self.assertFalse(success)
+        self.assertIn("still running", message)
+
+
+if __name__ == '__main__':
+    unittest.main()
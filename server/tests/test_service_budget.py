@@ -0,0 +1,39 @@
+"""
+Run outlook-attach-service.py --check-budget for both engines and for
+--on-demand, and fail when the service is over its startup or memory budget.
+
+Run from the server folder:
+    python -m unittest discover -s tests
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SERVICE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "outlook-attach-service.py")
+
+
+class ServiceBudgetTest(unittest.TestCase):
+
+    def check_budget(self, *flags):
+        # A scratch home keeps the service's journal and state out of the user's
+        with tempfile.TemporaryDirectory(prefix='attach-budget-') as home:
+            env = dict(os.environ, HOME=home, USERPROFILE=home)
+            result = subprocess.run([sys.executable, SERVICE, '--check-budget', *flags],
+                                    capture_output=True, text=True, env=env, timeout=120)
+        self.assertEqual(result.returncode, 0, f"over budget:\n{result.stdout}{result.stderr}")
+
+    def test_threaded_engine(self):
+        self.check_budget('--engine', 'threaded')
+
+    def test_asyncio_engine(self):
+        self.check_budget('--engine', 'asyncio')
+
+    def test_on_demand(self):
+        self.check_budget('--on-demand')
+
+
+if __name__ == '__main__':
+    unittest.main()